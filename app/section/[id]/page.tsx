@@ -10,7 +10,7 @@ export default function SectionPage() {
     <main className="container mx-auto p-4 space-y-4">
       <DemoBanner />
       <h1 className="text-xl font-semibold">Section {id}</h1>
-      <LiveMap />
+      <LiveMap section={id} />
     </main>
   )
 }
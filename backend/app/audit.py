@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+# Entries kept in memory; older ones only live in the persisted log
+AUDIT_CAPACITY = 1000
+# Writer flushes after this many entries or this many wall seconds, whichever first
+FLUSH_BATCH = 256
+FLUSH_INTERVAL = 1.0
+# Serialized entries waiting for the writer; when full, further entries are
+# dropped (and counted) rather than stall the tick
+WRITE_BACKLOG = 10_000
+# Bytes read per step when loading the tail of the persisted log
+TAIL_CHUNK = 1 << 16
+
+
+def _trains(payload) -> List[str]:
+    """Train ids an audit payload refers to"""
+    if not isinstance(payload, dict):
+        return []
+    out = [payload[k] for k in ('train', 'train_id') if isinstance(payload.get(k), str)]
+    trains = payload.get('trains')
+    if isinstance(trains, list):
+        out.extend(t for t in trains if isinstance(t, str))
+    return out
+
+
+def _tail(path, n):
+    """The last ``n`` lines of a file, reading back from its end only as far as they reach"""
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos, data = end, b''
+        # One more newline than lines wanted, so the first kept line is whole
+        while pos > 0 and data.count(b'\n') <= n:
+            step = min(TAIL_CHUNK, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    if pos > 0:
+        lines = lines[1:]
+    return lines[-n:]
+
+
+class AuditWriter:
+    """Background thread appending audit entries to a JSON-lines file in batches.
+
+    Entries are queued already serialized, so the thread never reads
+    payloads the simulator may still be changing. A failed write is logged
+    and its batch counted in ``failed``; the file is reopened for the next.
+    """
+
+    def __init__(self, path, backlog=WRITE_BACKLOG):
+        self.path = path
+        self.queue: 'queue.Queue[Optional[str]]' = queue.Queue(maxsize=backlog)
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, entry):
+        """Queue ``entry`` as one JSON line; never blocks, dropping (and counting) it if the writer is backed up"""
+        line = json.dumps(entry, default=str) + '\n'
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+            # Logged at the 1st, 2nd, 4th, 8th... drop; sim_audit_dropped_total has the count
+            if self.dropped & (self.dropped - 1) == 0:
+                log.warning('Audit writer backlog full, dropping entries (%d so far)', self.dropped)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        f = None
+        stop = False
+        while not stop:
+            try:
+                batch = [self.queue.get(timeout=FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(batch) < FLUSH_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stop = True
+                batch = [line for line in batch if line is not None]
+            if not batch:
+                continue
+            try:
+                if f is None:
+                    f = open(self.path, 'a', encoding='utf-8')
+                f.write(''.join(batch))
+                f.flush()
+                self.written += len(batch)
+            except Exception:
+                log.exception('Audit writer failed to persist %d entries to %s', len(batch), self.path)
+                self.failed += len(batch)
+                if f is not None:
+                    try:
+                        f.close()
+                    except OSError:
+                        pass
+                    f = None
+        if f is not None:
+            f.close()
+
+
+class AuditLog:
+    """Fixed-capacity ring buffer of audit entries with indexes by action and train.
+
+    Every entry gets a monotonically increasing ``seq`` that doubles as the
+    pagination cursor. Index lists hold seqs in order and are trimmed from
+    the front as the ring overwrites old entries, so appends are O(1).
+    With a ``path``, entries are also persisted by an :class:`AuditWriter`
+    and the newest ones are reloaded on start.
+    """
+
+    def __init__(self, capacity=AUDIT_CAPACITY, path=None):
+        self.capacity = capacity
+        self.ring: List[Optional[Dict[str, Any]]] = [None] * capacity
+        # Train ids of each slot's entry, so evictions need not re-parse payloads
+        self.ring_trains: List[List[str]] = [[] for _ in range(capacity)]
+        self.next_seq = 0
+        self.by_action: Dict[str, Deque[int]] = {}
+        self.by_train: Dict[str, Deque[int]] = {}
+        self.writer = None
+        if path is not None:
+            self._load(path)
+            self.writer = AuditWriter(path)
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return
+        for line in _tail(path, self.capacity):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # torn last line from a crash
+            # Keep numbering on from the previous run
+            self.next_seq = max(self.next_seq, entry.get('seq', self.next_seq))
+            self._insert(entry)
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    @property
+    def first_seq(self):
+        return max(0, self.next_seq - self.capacity)
+
+    def __iter__(self):
+        for seq in range(self.first_seq, self.next_seq):
+            yield self.ring[seq % self.capacity]
+
+    def append(self, action, payload, ts):
+        entry = {'seq': self.next_seq, 'ts': ts, 'action': action, 'payload': payload}
+        self._insert(entry)
+        if self.writer is not None:
+            self.writer.put(entry)
+        return entry
+
+    def _insert(self, entry):
+        seq = entry['seq'] = self.next_seq
+        slot = seq % self.capacity
+        old = self.ring[slot]
+        if old is not None:
+            self._unindex(self.by_action, old['action'], old['seq'])
+            for t in self.ring_trains[slot]:
+                self._unindex(self.by_train, t, old['seq'])
+        trains = _trains(entry['payload'])
+        self.ring[slot] = entry
+        self.ring_trains[slot] = trains
+        self._index(self.by_action, entry['action'], seq)
+        for t in trains:
+            self._index(self.by_train, t, seq)
+        self.next_seq += 1
+
+    @staticmethod
+    def _index(index, key, seq):
+        seqs = index.get(key)
+        if seqs is None:
+            seqs = index[key] = deque()
+        seqs.append(seq)
+
+    @staticmethod
+    def _unindex(index, key, seq):
+        seqs = index.get(key)
+        # Overwritten entries are always the oldest in their index
+        while seqs and seqs[0] <= seq:
+            seqs.popleft()
+        if seqs is not None and not seqs:
+            del index[key]
+
+    def restore(self, entries):
+        """Re-insert checkpointed entries newer than any this log holds"""
+        for entry in entries:
+            if entry['seq'] >= self.next_seq:
+                self.next_seq = entry['seq']
+                self._insert(dict(entry))
+
+    def get(self, seq):
+        if self.first_seq <= seq < self.next_seq:
+            return self.ring[seq % self.capacity]
+        return None
+
+    def _seqs(self, action, train, cursor):
+        """Candidate seqs, newest first"""
+        if action is None and train is None:
+            top = self.next_seq if cursor is None else min(cursor, self.next_seq)
+            return range(top - 1, self.first_seq - 1, -1)
+        lists = []
+        if action is not None:
+            lists.append(self.by_action.get(action, ()))
+        if train is not None:
+            lists.append(self.by_train.get(train, ()))
+        return reversed(min(lists, key=len))
+
+    def query(self, action=None, train=None, since=None, until=None, cursor=None, limit=50):
+        """Up to ``limit`` matching entries older than ``cursor``, oldest first.
+
+        ``since``/``until`` bound the entry timestamp. ``next_cursor`` pages
+        further back and is None once the buffer is exhausted.
+        """
+        out = []
+        more = False
+        for seq in self._seqs(action, train, cursor):
+            if cursor is not None and seq >= cursor:
+                continue
+            entry = self.ring[seq % self.capacity]
+            if until is not None and entry['ts'] > until:
+                continue
+            # Timestamps never decrease, so nothing older can match either
+            if since is not None and entry['ts'] < since:
+                break
+            if action is not None and entry['action'] != action:
+                continue
+            if train is not None and train not in self.ring_trains[seq % self.capacity]:
+                continue
+            if len(out) == limit:
+                more = True
+                break
+            out.append(entry)
+        out.reverse()
+        return {
+            'entries': out,
+            'next_cursor': out[0]['seq'] if more and out else None
+        }
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Dict, Any, List
+
+import numpy as np
+
+from .wire import Frame, JSON, KIND_KEYFRAME, KIND_DELTA
+
+# Frames buffered per client before the oldest ones are dropped
+CLIENT_QUEUE_SIZE = 32
+# Every Nth tick carries full positions/tracks instead of deltas
+KEYFRAME_INTERVAL = 10
+
+
+class ClientWrapper:
+    """One WebSocket client with its own bounded send queue.
+
+    Frames are serialized once by the caller and enqueued encoded; a
+    per-client task drains the queue so a slow socket only delays itself.
+    When the queue is full the oldest frame is dropped and the client is
+    flagged for a keyframe, since the deltas it still holds are incomplete.
+    ``send_seconds`` (a histogram labelled by format) and ``dropped_total``
+    (a counter), when given, record queue-to-socket latency and drops.
+    """
+
+    def __init__(self, ws, max_queue=CLIENT_QUEUE_SIZE, send_seconds=None, dropped_total=None):
+        self.ws = ws
+        # (perf_counter when queued, encoded frame)
+        self.queue: deque = deque(maxlen=max_queue)
+        self.send_seconds = send_seconds
+        self.dropped_total = dropped_total
+        self.ready = asyncio.Event()
+        self.resync = True
+        # Negotiated wire format, and the train-id dictionary version it holds
+        self.format = JSON
+        self.ids_structure = None
+        # Subscribed Area, or None for the whole network
+        self.area = None
+        self.dropped = 0
+        self.closed = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def enqueue(self, data):
+        """Queue an encoded frame: str goes out as text, bytes as binary"""
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            self.resync = True
+            if self.dropped_total is not None:
+                self.dropped_total.inc()
+        self.queue.append((time.perf_counter(), data))
+        self.ready.set()
+
+    def send_frame(self, frame: Frame):
+        self.enqueue(frame.encode(self.format))
+
+    async def send_json(self, msg: Dict[str, Any]):
+        self.enqueue(json.dumps(msg))
+
+    async def _run(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue:
+                    queued, data = self.queue.popleft()
+                    if isinstance(data, bytes):
+                        await self.ws.send_bytes(data)
+                    else:
+                        await self.ws.send_text(data)
+                    if self.send_seconds is not None:
+                        self.send_seconds.observe(time.perf_counter() - queued, self.format)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True
+
+
+class FrameBuilder:
+    """Builds keyframe and delta frames for one view of the simulator.
+
+    A view is either the whole network (``rows=None``) or the trains and
+    blocks of one subscribed area. Position entries omit the route; routes
+    are sent once in 'routes' messages keyed by route id and referenced
+    via ``route_id``. Frames are wire.Frame objects so each encoding is
+    produced once per view no matter how many clients receive it.
+    """
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self._routes_sent = 0
+        self._prev = None
+        self._keyframe = None
+
+    @staticmethod
+    def position_entries(ts, rows, pos, speed):
+        """Entries for ``rows``; ``pos``/``speed`` are lists aligned with ``rows``"""
+        route = ts.route
+        out = {}
+        for i, row in enumerate(rows):
+            k = ts.ids[row]
+            out[k] = {
+                'id': k, 'label': ts.meta[row].get('label', k), 'route_id': int(route[row]),
+                'position': pos[i], 'speed': speed[i], 'next_section': 'secX'
+            }
+        return out
+
+    @staticmethod
+    def _select(sim, rows):
+        pos = sim.position_array()
+        if rows is None:
+            return np.arange(len(pos)), pos, sim.trains.speed.copy()
+        return rows, pos[rows], sim.trains.speed[rows]
+
+    @staticmethod
+    def tracks_for(sim, blocks):
+        if blocks is None:
+            return list(sim.tracks.values())
+        ids = sim.occupancy.block_ids
+        return [sim.tracks[ids[b]] for b in sorted(blocks)]
+
+    def _positions_frame(self, ts, rows, pos, speed):
+        seq = self.seq
+
+        def build():
+            payload = self.position_entries(ts, rows.tolist(), pos.tolist(), speed.tolist())
+            return {'type': 'positions', 'payload': payload, 'keyframe': True, 'seq': seq}
+        return Frame(build, (KIND_KEYFRAME, seq, rows, pos, speed))
+
+    def keyframe(self, sim, rows=None, blocks=None) -> List[Frame]:
+        """Full routes, positions and tracks; built once per state version"""
+        ts = sim.trains
+        key = (ts.changes, sim.occupancy.version)
+        if self._keyframe is None or self._keyframe[0] != key:
+            rows, pos, speed = self._select(sim, rows)
+            routes = {i: r for i, r in enumerate(ts.routes)}
+            self._keyframe = (key, [
+                Frame({'type': 'routes', 'payload': routes}),
+                self._positions_frame(ts, rows, pos, speed),
+                Frame({'type': 'tracks', 'payload': self.tracks_for(sim, blocks)}),
+            ], len(routes))
+        # Until this view has sent a tick, every client of it starts from a
+        # keyframe, so its routes need not go out again. Afterwards clients
+        # already following the view still rely on the per-tick routes.
+        if self.seq == 0:
+            self._routes_sent = max(self._routes_sent, self._keyframe[2])
+        return self._keyframe[1]
+
+    def position_frames(self, sim, rows=None) -> List[Frame]:
+        """Frames for this tick: new routes plus a positions keyframe or delta"""
+        ts = sim.trains
+        self.seq += 1
+        frames = []
+        if len(ts.routes) > self._routes_sent:
+            new = {i: ts.routes[i] for i in range(self._routes_sent, len(ts.routes))}
+            self._routes_sent = len(ts.routes)
+            frames.append(Frame({'type': 'routes', 'payload': new}))
+
+        whole = rows is None
+        rows, pos, speed = self._select(sim, rows)
+        ids = ts.ids if whole else [ts.ids[r] for r in rows.tolist()]
+        prev = self._prev
+        self._prev = (ts.structure, list(ids), pos, speed)
+        # Trains added/removed invalidate packed train indexes, so resend everything
+        if prev is None or prev[0] != ts.structure or self.seq % self.keyframe_interval == 0:
+            frames.append(self._positions_frame(ts, rows, pos, speed))
+            return frames
+
+        _, prev_ids, prev_pos, prev_speed = prev
+        if whole:
+            # Same rows as last tick: compare columns directly
+            changed = (pos != prev_pos).any(axis=1) | (speed != prev_speed)
+            removed = []
+        else:
+            prev_rows = {k: i for i, k in enumerate(prev_ids)}
+            at = np.array([prev_rows.get(k, -1) for k in ids], dtype=np.int64)
+            changed = at < 0
+            if len(prev_ids):
+                safe = np.where(changed, 0, at)
+                changed |= (pos != prev_pos[safe]).any(axis=1) | (speed != prev_speed[safe])
+            current = set(ids)
+            removed = [k for k in prev_ids if k not in current]
+        changed = np.flatnonzero(changed)
+        if not len(changed) and not removed:
+            return frames
+        c_rows, c_pos, c_speed = rows[changed], pos[changed], speed[changed]
+        seq = self.seq
+
+        def build():
+            entries = self.position_entries(ts, c_rows.tolist(), c_pos.tolist(), c_speed.tolist())
+            return {'type': 'positions_delta', 'payload': {'changed': entries, 'removed': removed}, 'seq': seq}
+        removed_rows = [ts.index[k] for k in removed]
+        frames.append(Frame(build, (KIND_DELTA, seq, c_rows, c_pos, c_speed, removed_rows)))
+        return frames
+
+    def track_frames(self, sim, dirty, blocks=None) -> List[Frame]:
+        """Tracks keyframe, or only the blocks in ``dirty`` whose occupancy changed"""
+        if self.seq % self.keyframe_interval == 0:
+            return [Frame({'type': 'tracks', 'payload': self.tracks_for(sim, blocks)})]
+        if blocks is not None:
+            dirty = dirty & blocks
+        if not dirty:
+            return []
+        changed = self.tracks_for(sim, dirty)
+        return [Frame({'type': 'tracks_delta', 'payload': {'changed': changed}})]
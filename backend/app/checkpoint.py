@@ -0,0 +1,243 @@
+"""Periodic checkpoints of the full simulator state, and restoring them.
+
+A checkpoint is one binary file: a fixed header (magic, CRC-32 of the rest,
+metadata and index lengths), the zlib-compressed JSON metadata, a JSON
+index of the arrays, then the raw train columns and route waypoints, each
+aligned so a restore can use them straight from a read-only memory map.
+"""
+import glob
+import json
+import mmap
+import os
+import threading
+import time
+import zlib
+import struct
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from .events import EventScheduler
+from .routes import RouteGeometry
+from .trainstate import STATUS_NAMES, TrainState, status_code
+
+# Simulated seconds between periodic checkpoints
+CHECKPOINT_INTERVAL = 30.0
+# Checkpoint files kept; older ones are removed after each write
+CHECKPOINT_KEEP = 3
+
+# magic, CRC-32 of everything after the header, metadata length, index length
+_HEADER = struct.Struct('<8sIII')
+_MAGIC = b'TCKPT001'
+# Arrays start on this boundary so they can be used straight from the map
+_ALIGN = 64
+# Simulator timers restored as-is, in simulated seconds
+_TIMERS = ('_next_metrics', '_next_forecast', '_next_event')
+_PATTERN = 'checkpoint-*.ckpt'
+
+
+def _pad(n):
+    return -n % _ALIGN
+
+
+def capture(sim):
+    """Everything needed to resume ``sim``, as (metadata bytes, arrays).
+
+    Runs on the simulator's own thread so the state is consistent; the
+    metadata is serialized right away and the arrays are copies, so
+    writing can happen elsewhere while the simulation carries on.
+    """
+    ts = sim.trains
+    n = len(ts)
+    flat = ts.geometry.flat()
+    arrays = {name: arr[:n].copy() for name, arr in ts._data.items()}
+    arrays['route_pts'] = flat['pts'].copy()
+    arrays['route_lens'] = flat['lens'].copy()
+    rng = sim.rng.getstate()
+    meta = {
+        'saved_at': time.time(),
+        'ids': ts.ids, 'meta': ts.meta, 'status_names': STATUS_NAMES,
+        'tracks': sim.tracks, 'sections': sim.sections,
+        'closed': [sim.occupancy.block_ids[b] for b in sim.occupancy.closed],
+        'clock': [sim.clock.now, sim.clock.epoch],
+        'timers': {name: getattr(sim, name) for name in _TIMERS},
+        'rng': [rng[0], list(rng[1]), rng[2]],
+        'holds': sim.holds, 'stats': sim.stats, 'system_metrics': sim.system_metrics,
+        'active_recommendation': sim.active_recommendation,
+        'pending_tickets': sim.pending_tickets,
+        'scheduler': sim.scheduler.state(),
+        'restrictions': sim.restrictions, 'base_max_speed': sim.base_max_speed,
+        'audit': list(sim.audit)
+    }
+    return json.dumps(meta, default=str).encode(), arrays
+
+
+def write(path, blob, arrays, level=1):
+    """Write a checkpoint atomically: to a temporary file, fsynced, then renamed over ``path``"""
+    meta = zlib.compress(blob, level)
+    # Array offsets are relative to the (aligned) end of the index
+    layout, offset = {}, 0
+    for name, arr in arrays.items():
+        layout[name] = [arr.dtype.str, list(arr.shape), offset]
+        offset += arr.nbytes + _pad(arr.nbytes)
+    index = json.dumps(layout).encode()
+    parts = [meta, index, bytes(_pad(_HEADER.size + len(meta) + len(index)))]
+    for arr in arrays.values():
+        parts.append(memoryview(np.ascontiguousarray(arr)).cast('B'))
+        parts.append(bytes(_pad(arr.nbytes)))
+    crc = 0
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, 0, len(meta), len(index)))
+        for part in parts:
+            f.write(part)
+            crc = zlib.crc32(part, crc)
+        f.seek(0)
+        f.write(_HEADER.pack(_MAGIC, crc, len(meta), len(index)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read(path):
+    """(metadata, arrays) of a checkpoint file; arrays are read-only views of a memory map.
+
+    Raises ValueError for a truncated or corrupt file.
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < _HEADER.size:
+        raise ValueError(f'{path}: truncated checkpoint')
+    magic, crc, meta_len, index_len = _HEADER.unpack_from(mm, 0)
+    if magic != _MAGIC and magic[:5] == _MAGIC[:5]:
+        raise ValueError(f'{path}: checkpoint format {magic[5:].decode(errors="replace")} is not supported')
+    view = memoryview(mm)
+    try:
+        valid = magic == _MAGIC and zlib.crc32(view[_HEADER.size:]) == crc
+    finally:
+        view.release()
+    if not valid:
+        raise ValueError(f'{path}: not a checkpoint or failed its checksum')
+    start = _HEADER.size
+    meta = json.loads(zlib.decompress(mm[start:start + meta_len]))
+    layout = json.loads(mm[start + meta_len:start + meta_len + index_len])
+    base = start + meta_len + index_len
+    base += _pad(base)
+    arrays = {}
+    for name, (dtype, shape, offset) in layout.items():
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=base + offset).reshape(shape)
+    return meta, arrays
+
+
+def restore(sim, meta, arrays):
+    """Put ``sim`` back in the state a checkpoint captured"""
+    lut = np.array([status_code(name) for name in meta['status_names']], dtype=np.int8)
+    columns = {name: arr for name, arr in arrays.items() if not name.startswith('route_')}
+    columns['status'] = lut[arrays['status']]
+    geometry = RouteGeometry.from_flat(np.array(arrays['route_pts']), arrays['route_lens'])
+    waypoints = arrays['route_pts'].tolist()
+    cuts = np.cumsum(arrays['route_lens']).tolist()
+    routes = [waypoints[a:b] for a, b in zip([0] + cuts[:-1], cuts)]
+    trains = TrainState()
+    trains.load(meta['ids'], meta['meta'], routes, columns, geometry)
+    sim.load_state(trains, meta['tracks'], meta['sections'])
+    for block_id in meta['closed']:
+        sim.occupancy.close(block_id)
+    sim.clock.now, sim.clock.epoch = meta['clock']
+    for name, value in meta['timers'].items():
+        setattr(sim, name, value)
+    version, internal, gauss = meta['rng']
+    sim.rng.setstate((version, tuple(internal), gauss))
+    sim.holds = meta['holds']
+    sim.stats = meta['stats']
+    sim.system_metrics = meta['system_metrics']
+    sim.active_recommendation = meta['active_recommendation']
+    sim.pending_tickets = meta['pending_tickets']
+    sim.scheduler = EventScheduler.from_state(meta['scheduler'])
+    sim.restrictions = meta['restrictions']
+    sim.base_max_speed = meta['base_max_speed']
+    sim.audit.restore(meta['audit'])
+    sim.bump()
+
+
+def checkpoints(directory):
+    """Checkpoint files in ``directory``, oldest first"""
+    return sorted(glob.glob(os.path.join(directory, _PATTERN)))
+
+
+def restore_latest(sim, directory) -> Optional[str]:
+    """Restore the newest readable checkpoint in ``directory``; returns its path or None"""
+    for path in reversed(checkpoints(directory)):
+        try:
+            meta, arrays = read(path)
+            restore(sim, meta, arrays)
+        except (OSError, ValueError):
+            continue
+        return path
+    return None
+
+
+class Checkpointer:
+    """Tick hook writing a checkpoint every ``interval`` simulated seconds.
+
+    The state is captured on the simulator's thread between ticks and
+    written by a background thread, so the loop only pays for the copy.
+    A round is skipped while the previous write is still in progress.
+    """
+
+    def __init__(self, sim, directory, interval=CHECKPOINT_INTERVAL, keep=CHECKPOINT_KEEP):
+        self.sim = sim
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        existing = checkpoints(directory)
+        self._seq = int(os.path.basename(existing[-1])[11:-5]) if existing else 0
+        self._next = sim.clock.now + interval
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Any] = {'written': 0, 'errors': 0, 'last_path': None,
+                                      'capture_ms': None, 'write_ms': None, 'bytes': None}
+
+    def __call__(self, messages=None):
+        if self.sim.clock.now >= self._next and not self.busy():
+            self._next = self.sim.clock.now + self.interval
+            self.save(wait=False)
+
+    def busy(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def save(self, wait=True):
+        """Checkpoint now; returns the file path (written in the background unless ``wait``)"""
+        t0 = time.perf_counter()
+        blob, arrays = capture(self.sim)
+        self.stats['capture_ms'] = round((time.perf_counter() - t0) * 1000, 2)
+        self._seq += 1
+        path = os.path.join(self.directory, f'checkpoint-{self._seq:010d}.ckpt')
+        if wait:
+            self._write(path, blob, arrays)
+        else:
+            self._thread = threading.Thread(target=self._write, args=(path, blob, arrays),
+                                            name='checkpoint-writer', daemon=True)
+            self._thread.start()
+        return path
+
+    def _write(self, path, blob, arrays):
+        t0 = time.perf_counter()
+        with self._lock:
+            try:
+                write(path, blob, arrays)
+                for old in checkpoints(self.directory)[:-self.keep]:
+                    os.remove(old)
+            except OSError:
+                self.stats['errors'] += 1
+                return
+        self.stats.update(written=self.stats['written'] + 1, last_path=path, bytes=os.path.getsize(path),
+                          write_ms=round((time.perf_counter() - t0) * 1000, 2))
+
+    def close(self):
+        """Wait for a write in progress, then take a final checkpoint"""
+        if self._thread is not None:
+            self._thread.join()
+        self.save(wait=True)
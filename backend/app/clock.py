@@ -0,0 +1,31 @@
+import asyncio
+import time
+
+# Simulated seconds covered by one simulator tick
+TICK_SECONDS = 1.0
+
+
+class SimClock:
+    """Simulated time, decoupled from the wall clock.
+
+    ``now`` is seconds since the simulation started and only moves when the
+    simulator advances it. ``rate`` is simulated seconds per wall second
+    used to pace the live loop; ``None`` means run flat out (headless).
+    """
+
+    def __init__(self, start=0.0, epoch=None, rate=1.0):
+        self.now = start
+        self.epoch = time.time() if epoch is None else epoch
+        self.rate = rate
+
+    def advance(self, dt):
+        self.now += dt
+
+    def time(self):
+        """Unix timestamp for the current simulated instant"""
+        return self.epoch + self.now
+
+    async def wait(self, dt):
+        """Sleep for the wall time that ``dt`` simulated seconds take at ``rate``"""
+        # Flat-out clocks still yield so other tasks get to run
+        await asyncio.sleep(dt / self.rate if self.rate else 0)
@@ -0,0 +1,72 @@
+import asyncio
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+# Most commands accepted in one bulk request
+MAX_COMMANDS = 5000
+# Per-train control actions and network-wide events a command may carry
+TRAIN_ACTIONS = ('speed', 'stop', 'start')
+EVENT_ACTIONS = ('add_train', 'emergency_stop')
+# Fields an add_train payload may set besides its route, and the type each is coerced to
+TRAIN_FIELDS = {'label': str, 'type': str, 'priority': str, 'status': str, 'cargo': str,
+                'speed': float, 'max_speed': float, 'delay': float, 'dist': float, 'idx': int, 'passengers': int}
+PRIORITIES = ('high', 'medium', 'low')
+# Statuses a new train may start in ('held' only comes from holds)
+TRAIN_STATUSES = ('running', 'stopped', 'emergency_stop')
+
+
+def check(commands) -> Optional[str]:
+    """Why a bulk request is malformed as a whole, or None"""
+    if not isinstance(commands, list):
+        return "Commands must be a list"
+    if len(commands) > MAX_COMMANDS:
+        return f"At most {MAX_COMMANDS} commands per request"
+    return None
+
+
+def train_fields(data) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Coerced add_train fields from ``data`` (route keys excluded), or why they are invalid"""
+    fields: Dict[str, Any] = {}
+    for key, value in data.items():
+        kind = TRAIN_FIELDS.get(key)
+        if kind is None:
+            return {}, f"Unknown train field {key!r}"
+        if kind is str:
+            if not isinstance(value, str):
+                return {}, f"Train field {key!r} must be a string"
+        elif isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            return {}, f"Train field {key!r} must be a number"
+        elif value < 0 or (key == 'max_speed' and value == 0):
+            return {}, f"Train field {key!r} out of range"
+        elif kind is int and value != int(value):
+            return {}, f"Train field {key!r} must be a whole number"
+        fields[key] = kind(value)
+    if fields.get('priority', 'medium') not in PRIORITIES:
+        return {}, f"Priority must be one of {', '.join(PRIORITIES)}"
+    if fields.get('status', 'running') not in TRAIN_STATUSES:
+        return {}, f"Status must be one of {', '.join(TRAIN_STATUSES)}"
+    return fields, None
+
+
+class CommandQueue:
+    """Train commands waiting to be applied at the start of the next tick.
+
+    Each submitted batch gets a future resolving to its per-command results
+    once the simulator has drained the queue, so many commands cost one
+    tick and never interleave with a tick in progress.
+    """
+
+    def __init__(self):
+        self.pending: List[Tuple[List[Dict[str, Any]], Optional[asyncio.Future]]] = []
+
+    def __len__(self):
+        return sum(len(batch) for batch, _ in self.pending)
+
+    def submit(self, commands, future=None):
+        self.pending.append((list(commands), future))
+        return future
+
+    def drain(self):
+        """All queued batches, oldest first, leaving the queue empty"""
+        pending, self.pending = self.pending, []
+        return pending
@@ -0,0 +1,193 @@
+import heapq
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+from .commands import EVENT_ACTIONS, TRAIN_ACTIONS
+
+# Scheduled event types: disruptions, plus any command action applied when due
+DISRUPTIONS = ('delay', 'speed_restriction', 'maintenance')
+EVENT_TYPES = DISRUPTIONS + TRAIN_ACTIONS + EVENT_ACTIONS
+# Most events accepted in one scheduling request
+MAX_EVENTS = 100000
+# Most events dispatched in one tick; the rest follow on the next ticks
+DISPATCH_LIMIT = 5000
+# Data fields each disruption accepts and the type they must have, and the ones it needs
+DISRUPTION_FIELDS = {
+    'delay': {'train_id': str, 'minutes': float},
+    'maintenance': {'block_id': str, 'duration_s': float},
+    'speed_restriction': {'section_id': str, 'train_ids': list, 'max_speed': float, 'duration_s': float},
+}
+REQUIRED_FIELDS = {'delay': ('train_id',), 'maintenance': ('block_id',)}
+
+
+def check(events) -> Optional[str]:
+    """Why a scheduling request is malformed, or None; every event must pass :func:`event_spec`"""
+    if not isinstance(events, list):
+        return "Events must be a list"
+    if len(events) > MAX_EVENTS:
+        return f"At most {MAX_EVENTS} events per request"
+    for i, spec in enumerate(events):
+        error = event_spec(spec)[1]
+        if error:
+            return f"Event {i}: {error}"
+    return None
+
+
+def _number(value):
+    return not isinstance(value, bool) and isinstance(value, (int, float)) and math.isfinite(value)
+
+
+def event_data(event_type, data) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Coerced ``data`` for an event of ``event_type``, or why it is invalid.
+
+    Disruption fields are checked against DISRUPTION_FIELDS; numbers must
+    be finite and non-negative. Command actions need a string ``train_id``
+    when they act on a train; add_train payloads are checked when applied.
+    """
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return {}, "Event data must be an object"
+    fields = DISRUPTION_FIELDS.get(event_type)
+    if fields is None:
+        if event_type in TRAIN_ACTIONS and not isinstance(data.get('train_id'), str):
+            return {}, "train_id must be a string"
+        if event_type == 'speed' and not _number(data.get('value')):
+            return {}, "Speed needs a numeric value"
+        return dict(data), None
+    out: Dict[str, Any] = {}
+    for key, value in data.items():
+        kind = fields.get(key)
+        if kind is None:
+            return {}, f"Unknown {event_type} field {key!r}"
+        if kind is str and not isinstance(value, str):
+            return {}, f"{key} must be a string"
+        if kind is list and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+            return {}, f"{key} must be a list of strings"
+        if kind is float:
+            if not _number(value) or value < 0:
+                return {}, f"{key} must be a non-negative number"
+            value = float(value)
+        out[key] = value
+    missing = [key for key in REQUIRED_FIELDS.get(event_type, ()) if key not in out]
+    if missing:
+        return {}, f"{missing[0]} is required"
+    return out, None
+
+
+def event_spec(spec) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """A ``{'type', 'at' | 'in_s', 'data'}`` request with its data coerced, or why it is invalid"""
+    if not isinstance(spec, dict) or spec.get('type') not in EVENT_TYPES:
+        return None, "Unknown event type"
+    for key in ('at', 'in_s'):
+        if spec.get(key) is not None and not _number(spec[key]):
+            return None, f"{key} must be a number"
+    data, error = event_data(spec['type'], spec.get('data'))
+    if error:
+        return None, error
+    return {'type': spec['type'], 'at': spec.get('at'), 'in_s': spec.get('in_s') or 0, 'data': data}, None
+
+
+class EventScheduler:
+    """Pending events in a binary heap keyed on simulated time.
+
+    Events are dicts with an ``id``, the simulated second ``at`` which they
+    fall due, a ``type`` and type-specific ``data``. Ties keep scheduling
+    order. Cancelling only drops the event from ``events``; its heap entry
+    is skipped when it surfaces, and the heap is rebuilt once such dead
+    entries outnumber the live ones.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, str]] = []
+        self.events: Dict[str, Dict[str, Any]] = {}
+        # Sequence number of the next scheduled event: its id and heap tie-break
+        self._next_seq = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def next_seq(self):
+        """Sequence number the next scheduled event gets"""
+        return self._next_seq
+
+    def __contains__(self, event_id):
+        return event_id in self.events
+
+    def schedule(self, at, event_type, data=None, internal=False):
+        seq = self._next_seq
+        self._next_seq += 1
+        event = {'id': f'E{seq}', 'at': float(at), 'type': event_type, 'data': data or {}}
+        if internal:
+            event['internal'] = True
+        self.events[event['id']] = event
+        heapq.heappush(self.heap, (event['at'], seq, event['id']))
+        return event
+
+    def cancel(self, event_id):
+        event = self.events.pop(event_id, None)
+        if event is not None and len(self.heap) > 2 * len(self.events) + 64:
+            self.heap = [e for e in self.heap if e[2] in self.events]
+            heapq.heapify(self.heap)
+        return event
+
+    def next_at(self):
+        """When the earliest pending event falls due, or None"""
+        while self.heap and self.heap[0][2] not in self.events:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def due(self, now, limit=DISPATCH_LIMIT):
+        """Pop up to ``limit`` events due by ``now``, earliest first"""
+        out = []
+        heap, events = self.heap, self.events
+        while heap and heap[0][0] <= now and len(out) < limit:
+            event = events.pop(heapq.heappop(heap)[2], None)
+            if event is not None:
+                out.append(event)
+        return out
+
+    def upcoming(self, limit=50, event_type=None, until=None):
+        """The next ``limit`` pending events, optionally of one type or due by ``until``.
+
+        Walks the heap in time order from the root with a small frontier
+        heap, so listing the next few never sorts every pending event.
+        """
+        heap, events = self.heap, self.events
+        out = []
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier and len(out) < limit:
+            entry, i = heapq.heappop(frontier)
+            if until is not None and entry[0] > until:
+                break
+            event = events.get(entry[2])
+            if event is not None and (event_type is None or event['type'] == event_type):
+                out.append(event)
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+        return out
+
+    def state(self):
+        """Pending events and the next sequence number, for checkpoints"""
+        return {'events': list(self.events.values()), 'next_seq': self._next_seq}
+
+    @classmethod
+    def from_state(cls, state):
+        """Scheduler holding the events of a :meth:`state`"""
+        scheduler = cls()
+        for event in state['events']:
+            scheduler.events[event['id']] = event
+            scheduler.heap.append((event['at'], int(event['id'][1:]), event['id']))
+        heapq.heapify(scheduler.heap)
+        scheduler._next_seq = state['next_seq']
+        return scheduler
+
+    def copy(self):
+        """Independent scheduler with the same pending events, for forks"""
+        twin = EventScheduler()
+        twin.heap = list(self.heap)
+        twin.events = dict(self.events)
+        twin._next_seq = self._next_seq
+        return twin
@@ -0,0 +1,184 @@
+from typing import Any, Dict, List
+
+import numpy as np
+
+from .optimizer import PRIORITY_WEIGHTS
+from .spatial import GridIndex
+from .trainstate import status_code
+
+# Default look-ahead, simulated seconds
+FORECAST_HORIZON_S = 900.0
+# Trains closer than this at the same instant are a headway violation; the
+# tick stalls a train that would get this close to a train ahead
+HEADWAY = 0.05
+# Conflicts this close count as imminent: 'high' severity, and the
+# recommendation engine sequences them together with current ones
+IMMINENT_S = 120.0
+# Simulated seconds between projected instants; trains close at most about a
+# kilometre in that time, well inside the headway
+FORECAST_STEP_S = 30.0
+# Cap on projected (train, instant) samples; long horizons over many trains
+# are sampled more sparsely instead
+MAX_SAMPLES = 2_000_000
+# Shifts each projected instant far enough apart in longitude that one
+# grid never pairs points from different instants
+_TIME_SHIFT = 1000.0
+
+
+def _csr(rows, size):
+    """(start, count) of each row's run in ``rows``, which must be sorted"""
+    count = np.bincount(rows, minlength=size).astype(np.int64)
+    start = np.zeros(size, dtype=np.int64)
+    np.cumsum(count[:-1], out=start[1:])
+    return start, count
+
+
+class Forecaster:
+    """Projects every train along its route and finds the conflicts ahead.
+
+    Running trains cover ``max_speed`` km/h along their route geometry,
+    held trains start when their hold ends and other trains stay put, as
+    the tick would move them absent any interaction. All projected
+    instants are checked in one sweep: headway by a single grid query over
+    every (train, instant) position, blocks by counting occupants per
+    (block, instant).
+    """
+
+    def __init__(self):
+        self._cache = None
+        self._cache_key = None
+
+    def _tables(self, ts, occupancy):
+        """Blocks touched at each flattened route waypoint, rebuilt when routes change.
+
+        Keyed on the flattened geometry and the block index, which copies of
+        a TrainState and a BlockOccupancy share until a route is added or the
+        network replaced, so forecasting on a snapshot reuses it.
+        """
+        flat = ts.geometry.flat()
+        key = self._cache_key
+        if key is None or key[0] is not flat or key[1] is not occupancy.grid:
+            per_point = [b for rid in range(len(ts.routes))
+                         for b in occupancy.route_blocks(ts.routes, rid)]
+            self._cache = {
+                'blocks': _csr(np.repeat(np.arange(len(per_point)), [len(b) for b in per_point]), len(per_point))
+                + (np.array([b for bs in per_point for b in bs], dtype=np.int64),)
+            }
+            self._cache_key = (flat, occupancy.grid)
+        return self._cache
+
+    def project(self, ts, holds, now, horizon_s, step_s=FORECAST_STEP_S):
+        """(times, flat, points): seconds ahead of each projected instant, and the
+        flattened route waypoint last passed and position of every train then,
+        shapes (instants, n) and (instants, n, 2)"""
+        _, offs, _ = ts._flat_routes()
+        n = len(ts)
+        total = ts.route_totals()
+        # Seconds before each train starts moving; trains that never move wait forever
+        wait = np.full(n, np.inf)
+        wait[ts.status == status_code('running')] = 0.0
+        for train_id, until in holds.items():
+            row = ts.index.get(train_id)
+            if row is not None:
+                wait[row] = max(0.0, until - now)
+        speed = np.maximum(ts.max_speed, 0.0) / 3600.0
+        left = total - ts.dist
+        moving = (wait <= horizon_s) & (left > 0) & (speed > 0)
+        # Nothing changes once every train has stopped at its route end
+        last = min(horizon_s, float((wait + left / np.where(speed > 0, speed, 1.0))[moving].max())) if moving.any() else 0.0
+        step = max(step_s, last * n / MAX_SAMPLES)
+        times = np.arange(0.0, last + step, step)
+        times[-1] = min(times[-1], last)
+        run = np.clip(times[:, None] - wait[None, :], 0.0, None)
+        dist = np.minimum(ts.dist[None, :] + np.where(moving, speed, 0.0)[None, :] * run, total[None, :])
+        route = np.broadcast_to(ts.route, dist.shape).ravel()
+        idx, points = ts.geometry.locate(route, dist.ravel())
+        flat = (offs[route] + idx).reshape(dist.shape)
+        return times, flat, points.reshape(dist.shape + (2,))
+
+    def forecast(self, ts, occupancy, holds, now, horizon_s=FORECAST_HORIZON_S, limit=None, step_s=FORECAST_STEP_S):
+        """(total, conflicts): train pairs coming into conflict within ``horizon_s``.
+
+        Pairs already in conflict now are left out; each remaining pair is
+        reported once per kind (headway, block) at its first violation.
+        Only the ``limit`` soonest (heaviest first on ties) are built.
+        """
+        n = len(ts)
+        if n < 2:
+            return 0, []
+        times, flat, points = self.project(ts, holds, now, horizon_s, step_s)
+        tables = self._tables(ts, occupancy)
+        found = [self._headway(points, n), self._blocks_shared(tables, occupancy, flat, n)]
+        a, b, k, extra = (np.concatenate(cols) for cols in zip(*found))
+        kind = np.repeat([0, 1], [len(found[0][0]), len(found[1][0])])
+        weights = np.array([PRIORITY_WEIGHTS.get(m.get('priority'), 1.0) for m in ts.meta])
+        weight = weights[a] + weights[b]
+        order = np.lexsort((kind, -weight, k))[:limit]
+        out: List[Dict[str, Any]] = []
+        for r in order.tolist():
+            i, j, t = int(a[r]), int(b[r]), int(k[r])
+            entry = {
+                'trains': [ts.ids[i], ts.ids[j]],
+                'type': ('headway', 'block')[kind[r]],
+                'time_s': float(times[t]),
+                'position': points[t, i].tolist(),
+                'weight': float(weight[r]),
+                'severity': 'high' if times[t] <= IMMINENT_S else 'medium'
+            }
+            if kind[r] == 0:
+                entry['distance'] = round(float(extra[r]), 4)
+            else:
+                entry['block'] = occupancy.block_ids[int(extra[r])]
+            out.append(entry)
+        return len(a), out
+
+    @staticmethod
+    def _first(i, j, k, extra, n):
+        """First instant of each pair, dropping pairs that are already in conflict now"""
+        code = np.minimum(i, j) * n + np.maximum(i, j)
+        order = np.lexsort((k, code))
+        code, k, extra = code[order], k[order], extra[order]
+        head = np.ones(len(code), dtype=bool)
+        head[1:] = code[1:] != code[:-1]
+        code, k, extra = code[head], k[head], extra[head]
+        keep = k > 0
+        return code[keep] // n, code[keep] % n, k[keep], extra[keep]
+
+    def _headway(self, points, n):
+        # Every (instant, train) sample in one grid, instants kept apart
+        shifted = points.copy()
+        shifted[:, :, 1] += np.arange(len(points))[:, None] * _TIME_SHIFT
+        samples = shifted.reshape(-1, 2)
+        # A pair can only start conflicting when one of its trains moves, so
+        # only the first instant and moved samples look for neighbours
+        moved = np.ones(len(samples), dtype=bool)
+        moved[n:] = (points[1:] != points[:-1]).any(axis=2).ravel()
+        query = np.flatnonzero(moved)
+        ii, jj, d = GridIndex(samples).query(samples[query], HEADWAY)
+        ii = query[ii]
+        keep = ii % n != jj % n
+        ii, jj, d = ii[keep], jj[keep], d[keep]
+        return self._first(ii % n, jj % n, ii // n, d, n)
+
+    def _blocks_shared(self, tables, occupancy, flat, n):
+        start, counts, blocks = tables['blocks']
+        samples = flat.ravel()
+        c = counts[samples]
+        sample = np.repeat(np.arange(len(samples)), c)
+        pos = np.arange(len(sample)) - np.repeat(np.cumsum(c) - c, c)
+        block = blocks[start[samples[sample]] + pos]
+        k, train = sample // n, sample % n
+        # Occupants of each (instant, block); samples are in (instant, train)
+        # order already, so a stable sort keeps trains in row order
+        slot = k * len(occupancy.block_ids) + block
+        order = np.argsort(slot, kind='stable')
+        slot, train, block, k = slot[order], train[order], block[order], k[order]
+        first = np.ones(len(slot), dtype=bool)
+        first[1:] = slot[1:] != slot[:-1]
+        group = np.cumsum(first) - 1
+        size = np.bincount(group)[group]
+        over = size > occupancy.capacity[block]
+        # Pair each overfull slot's first occupant with every other one
+        lead = np.flatnonzero(first)[group]
+        pick = over & ~first
+        return self._first(train[lead[pick]], train[pick], k[pick], block[pick], n)
@@ -0,0 +1,30 @@
+import time
+
+
+def summarize(sim):
+    """Outcome measures for a (headless) simulator run"""
+    ts = sim.trains
+    delay = ts.delay
+    finished = ts.dist >= ts.route_totals()
+    return {
+        'sim_time_s': sim.clock.now,
+        'ticks': sim.stats['ticks'],
+        'total_delay': round(float(delay.sum()), 2),
+        'avg_delay': round(float(delay.mean()), 2) if len(ts) else 0.0,
+        'max_delay': round(float(delay.max()), 2) if len(ts) else 0.0,
+        'trains_finished': int(finished.sum()),
+        'conflict_events': sim.stats['conflict_events'],
+        'kpis': sim.kpis()
+    }
+
+
+def run(sim, duration_s):
+    """Run ``sim`` headless for ``duration_s`` simulated seconds and summarize it"""
+    started = time.perf_counter()
+    ticks = sim.run_headless(duration_s)
+    elapsed = time.perf_counter() - started
+    out = summarize(sim)
+    out['wall_time_s'] = round(elapsed, 4)
+    out['ticks_per_s'] = round(ticks / elapsed, 1) if elapsed > 0 else None
+    return out
+
@@ -0,0 +1,356 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .trainstate import STATUS_NAMES
+
+# Rows per chunk: ticks of train state, and metrics samples
+TRAIN_CHUNK_ROWS = 120
+METRIC_CHUNK_ROWS = 1024
+# Compressed chunks kept in memory; older ones spill to segment files
+HISTORY_MEMORY_BYTES = 64 * 1024 * 1024
+# History older than this is dropped, in simulated seconds
+HISTORY_RETENTION_S = 7 * 24 * 3600.0
+# Segment files roll over at this size
+SEGMENT_BYTES = 256 * 1024 * 1024
+# zlib level; chunks are sealed on the tick, so favour speed
+COMPRESS_LEVEL = 1
+# Fixed-point scales: ~1 m positions, 0.1 km/h speeds, 0.01 min delays
+POS_SCALE = 1e5
+SPEED_SCALE = 10.0
+DELAY_SCALE = 100.0
+
+# Replays send at most this many frames per wall second, fetched this many at a time
+REPLAY_FPS = 10
+REPLAY_PAGE = 50
+
+_UINT = {4: np.uint32, 8: np.uint64}
+
+
+def encode(arr, level=COMPRESS_LEVEL):
+    """Compress rows of ``arr`` against the row before them.
+
+    Integers are stored as deltas and floats as the XOR of their bits with
+    the previous row, so slowly changing columns become runs of zero bytes;
+    the bytes are then grouped by significance before zlib.
+    """
+    a = np.ascontiguousarray(arr)
+    if a.dtype.kind == 'f':
+        bits = a.view(_UINT[a.itemsize])
+        d = bits.copy()
+        d[1:] ^= bits[:-1]
+    else:
+        d = a.copy()
+        d[1:] -= a[:-1]
+    planes = d.view(np.uint8).reshape(-1, a.itemsize).T
+    return zlib.compress(np.ascontiguousarray(planes).tobytes(), level)
+
+
+def decode(blob, dtype, shape):
+    """Inverse of :func:`encode`"""
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(dtype.itemsize, -1)
+    d = np.ascontiguousarray(planes.T).view(dtype).reshape(shape)
+    if dtype.kind == 'f':
+        bits = d.view(_UINT[dtype.itemsize])
+        np.bitwise_xor.accumulate(bits, axis=0, out=bits)
+        return d
+    return np.cumsum(d, axis=0, dtype=dtype)
+
+
+class _Series:
+    """Append-only rows in chunks: the open chunk is a set of preallocated
+    arrays, sealed chunks are compressed columns in memory or on disk.
+
+    A chunk is also sealed whenever its ``static`` part changes (train ids
+    and routes, or metric names), so every row in a chunk shares one.
+    """
+
+    def __init__(self, store, rows_per_chunk):
+        self.store = store
+        self.rows_per_chunk = rows_per_chunk
+        self.chunks: List[Dict[str, Any]] = []
+        self._open: Optional[Dict[str, Any]] = None
+
+    def append(self, t, static_key, static, columns):
+        chunk = self._open
+        if chunk is not None and (chunk['key'] != static_key or chunk['rows'] == self.rows_per_chunk):
+            self.seal()
+            chunk = None
+        if chunk is None:
+            chunk = self._open = {
+                'key': static_key, 'static': static, 'rows': 0,
+                't': np.zeros(self.rows_per_chunk),
+                'columns': {name: np.zeros((self.rows_per_chunk,) + np.shape(v), dtype=np.asarray(v).dtype)
+                            for name, v in columns.items()}
+            }
+        row = chunk['rows']
+        chunk['t'][row] = t
+        for name, v in columns.items():
+            chunk['columns'][name][row] = v
+        chunk['rows'] = row + 1
+
+    def seal(self):
+        chunk, self._open = self._open, None
+        if chunk is None or not chunk['rows']:
+            return
+        rows = chunk['rows']
+        columns = dict(chunk['columns'], t=chunk['t'])
+        blobs = {name: encode(arr[:rows]) for name, arr in columns.items()}
+        sealed = {
+            't0': float(chunk['t'][0]), 't1': float(chunk['t'][rows - 1]), 'rows': rows,
+            'static': chunk['static'],
+            'layout': {name: (arr.dtype.str, (rows,) + arr.shape[1:]) for name, arr in columns.items()},
+            'blobs': blobs, 'bytes': sum(len(b) for b in blobs.values()), 'location': None
+        }
+        self.chunks.append(sealed)
+        self.store._sealed(sealed)
+
+    def read(self, since, until):
+        """(times, static, columns) of each chunk overlapping [since, until], oldest first"""
+        for chunk in list(self.chunks):
+            if chunk['t1'] < since or chunk['t0'] > until:
+                continue
+            blobs = chunk['blobs'] or self.store._load(chunk)
+            columns = {name: decode(blobs[name], dtype, shape) for name, (dtype, shape) in chunk['layout'].items()}
+            yield columns.pop('t'), chunk['static'], columns
+        chunk = self._open
+        if chunk is not None and chunk['rows'] and chunk['t'][0] <= until and chunk['t'][chunk['rows'] - 1] >= since:
+            rows = chunk['rows']
+            yield chunk['t'][:rows].copy(), chunk['static'], {n: a[:rows].copy() for n, a in chunk['columns'].items()}
+
+    def drop_before(self, t):
+        keep = [c for c in self.chunks if c['t1'] >= t]
+        dropped = self.chunks[:len(self.chunks) - len(keep)]
+        self.chunks = keep
+        return dropped
+
+
+class HistoryStore:
+    """Per-tick train states and periodic metrics, compressed and memory-bounded.
+
+    Train state is stored per tick as fixed-point positions, speed and
+    delay plus status codes; metrics as float columns. Both fill chunks of
+    rows that are compressed column by column when full (see
+    :func:`encode`). Compressed chunks stay in memory up to
+    ``memory_bytes``, after which the oldest are appended to segment files
+    under ``directory`` (a temporary one by default) and read back on
+    demand. Rows older than ``retention_s`` are dropped, and segment files
+    with them.
+    """
+
+    def __init__(self, directory=None, memory_bytes=HISTORY_MEMORY_BYTES, retention_s=HISTORY_RETENTION_S):
+        self.directory = directory
+        self._own_directory = False
+        self.memory_bytes = memory_bytes
+        self.retention_s = retention_s
+        self.trains = _Series(self, TRAIN_CHUNK_ROWS)
+        self.metrics = _Series(self, METRIC_CHUNK_ROWS)
+        self.stats = {'rows': 0, 'chunks': 0, 'raw_bytes': 0, 'memory_bytes': 0, 'disk_bytes': 0, 'spilled': 0}
+        self._in_memory: List[Dict[str, Any]] = []
+        self._segments: List[Dict[str, Any]] = []
+        self._static = None
+
+    # -- recording ----------------------------------------------------------
+    def record(self, sim):
+        """Append the current train state of ``sim``"""
+        ts = sim.trains
+        if self._static is None or self._static[0] != ts.structure:
+            self._static = (ts.structure, {'ids': list(ts.ids), 'routes': ts.route.copy()})
+        pos = sim.position_array()
+        now = sim.clock.now
+        self.trains.append(now, ts.structure, self._static[1], {
+            'lat': np.round(pos[:, 0] * POS_SCALE).astype(np.int32),
+            'lon': np.round(pos[:, 1] * POS_SCALE).astype(np.int32),
+            'speed': np.round(ts.speed * SPEED_SCALE).astype(np.int16),
+            'delay': np.round(ts.delay * DELAY_SCALE).astype(np.int32),
+            'status': ts.status.copy()
+        })
+        self.stats['rows'] += 1
+        self.stats['raw_bytes'] += 15 * len(ts) + 8
+        self._expire(now)
+
+    def record_metrics(self, now, values):
+        """Append one sample of numeric metrics (a dict of name -> number)"""
+        names = tuple(sorted(k for k, v in values.items() if isinstance(v, (int, float))))
+        self.metrics.append(now, names, list(names), {n: float(values[n]) for n in names})
+
+    # -- queries ------------------------------------------------------------
+    def span(self):
+        """(first, last) recorded tick time, or None"""
+        series, opened = self.trains, self.trains._open
+        first = series.chunks[0]['t0'] if series.chunks else None
+        last = series.chunks[-1]['t1'] if series.chunks else None
+        if opened is not None and opened['rows']:
+            first = opened['t'][0] if first is None else first
+            last = opened['t'][opened['rows'] - 1]
+        return None if first is None else (float(first), float(last))
+
+    def trends(self, since, until, points=200, names=None):
+        """Metrics between ``since`` and ``until``, averaged into at most ``points`` time buckets"""
+        times, parts = [], []
+        for t, static, columns in self.metrics.read(since, until):
+            keep = (t >= since) & (t <= until)
+            times.append(t[keep])
+            parts.append({n: columns[n][keep] for n in static if names is None or n in names})
+        if not sum(len(t) for t in times):
+            return {'since': since, 'until': until, 't': [], 'series': {}}
+        t = np.concatenate(times)
+        # Buckets of equal time span; empty ones are skipped
+        edges = np.unique(np.searchsorted(t, np.linspace(t[0], t[-1], min(points, len(t)) + 1)[:-1]))
+        counts = np.diff(np.append(edges, len(t)))
+        series = {}
+        for name in sorted({n for p in parts for n in p}):
+            col = np.concatenate([p.get(name, np.full(len(x), np.nan)) for x, p in zip(times, parts)])
+            have = np.add.reduceat(~np.isnan(col), edges)
+            mean = np.add.reduceat(np.nan_to_num(col), edges) / np.maximum(have, 1)
+            series[name] = [round(float(v), 4) if k else None for v, k in zip(mean, have)]
+        return {
+            'since': since, 'until': until,
+            't': np.round(np.add.reduceat(t, edges) / counts, 3).tolist(),
+            'series': series
+        }
+
+    def page(self, since, until, gap=0.0, limit=100):
+        """Up to ``limit`` recorded ticks from ``since``, at least ``gap`` seconds apart.
+
+        Returns ``{'frames': [...], 'next': t}``, ``next`` being where the
+        following page starts (None once ``until`` is reached). Frames are
+        columnar: per-train lists aligned with ``ids``, which is only
+        included in a page's first frame and when the set of trains changes.
+        """
+        frames = []
+        last = None
+        # Train set of the last emitted frame; chunks of one train set share it
+        sent = None
+        names = np.array(STATUS_NAMES)
+        for t, static, columns in self.trains.read(since, until):
+            ids = static['ids']
+            routes = static['routes'].tolist()
+            for row in range(len(t)):
+                now = float(t[row])
+                if now < since or now > until or (last is not None and now - last < gap):
+                    continue
+                if len(frames) == limit:
+                    return {'frames': frames, 'next': now}
+                frame = {
+                    't': now,
+                    'route_id': routes,
+                    'position': (np.stack([columns['lat'][row], columns['lon'][row]], axis=1) / POS_SCALE).tolist(),
+                    'speed': (columns['speed'][row] / SPEED_SCALE).tolist(),
+                    'delay': (columns['delay'][row] / DELAY_SCALE).tolist(),
+                    'status': names[columns['status'][row]].tolist()
+                }
+                if static is not sent:
+                    frame['ids'] = ids
+                    sent = static
+                last = now
+                frames.append(frame)
+        return {'frames': frames, 'next': None}
+
+    def summary(self):
+        span = self.span()
+        return dict(self.stats, since=span[0] if span else None, until=span[1] if span else None,
+                    segments=len(self._segments))
+
+    # -- memory bound and retention -----------------------------------------
+    def _sealed(self, chunk):
+        self.stats['chunks'] += 1
+        self.stats['memory_bytes'] += chunk['bytes']
+        self._in_memory.append(chunk)
+        while self.stats['memory_bytes'] > self.memory_bytes and self._in_memory:
+            self._spill(self._in_memory.pop(0))
+
+    def _spill(self, chunk):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='train-history-')
+            self._own_directory = True
+        os.makedirs(self.directory, exist_ok=True)
+        seg = self._segments[-1] if self._segments else None
+        if seg is None or seg['bytes'] >= SEGMENT_BYTES:
+            path = os.path.join(self.directory, f'history-{os.getpid()}-{len(self._segments)}-{id(self):x}.seg')
+            seg = {'path': path, 'bytes': 0, 'chunks': 0, 't1': chunk['t1']}
+            self._segments.append(seg)
+        names = list(chunk['blobs'])
+        with open(seg['path'], 'ab') as f:
+            offset = seg['bytes']
+            for name in names:
+                f.write(chunk['blobs'][name])
+        chunk['location'] = (seg['path'], offset, [(n, len(chunk['blobs'][n])) for n in names])
+        seg['bytes'] += chunk['bytes']
+        seg['chunks'] += 1
+        seg['t1'] = max(seg['t1'], chunk['t1'])
+        chunk['blobs'] = None
+        self.stats['memory_bytes'] -= chunk['bytes']
+        self.stats['disk_bytes'] += chunk['bytes']
+        self.stats['spilled'] += 1
+
+    def _load(self, chunk):
+        path, offset, sizes = chunk['location']
+        out = {}
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for name, size in sizes:
+                out[name] = f.read(size)
+        return out
+
+    def _expire(self, now):
+        cutoff = now - self.retention_s
+        dropped = self.trains.drop_before(cutoff) + self.metrics.drop_before(cutoff)
+        if not dropped:
+            return
+        gone = {id(c) for c in dropped}
+        for chunk in dropped:
+            if chunk['blobs'] is not None:
+                self.stats['memory_bytes'] -= chunk['bytes']
+            self.stats['chunks'] -= 1
+        self._in_memory = [c for c in self._in_memory if id(c) not in gone]
+        # Segments fill in time order, so whole files expire from the front
+        while len(self._segments) > 1 and self._segments[0]['t1'] < cutoff:
+            seg = self._segments.pop(0)
+            self.stats['disk_bytes'] -= seg['bytes']
+            try:
+                os.remove(seg['path'])
+            except OSError:
+                pass
+
+    def close(self):
+        """Delete spilled segments; history does not outlive the process"""
+        for seg in self._segments:
+            try:
+                os.remove(seg['path'])
+            except OSError:
+                pass
+        self._segments = []
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+async def replay(send, page, since, until, speed=1.0):
+    """Send recorded frames from ``since`` to ``until`` at ``speed`` times real time.
+
+    ``page`` is a HistoryStore.page-like callable, ``send`` an async
+    callable taking one message. Fast replays skip ticks rather than fall
+    behind. Returns the number of frames sent.
+    """
+    loop = asyncio.get_running_loop()
+    gap = max(0.0, speed / REPLAY_FPS - 1e-9)
+    start = loop.time()
+    sent = 0
+    at = since
+    while at is not None:
+        result = page(at, until, gap, REPLAY_PAGE)
+        for frame in result['frames']:
+            wait = start + (frame['t'] - since) / speed - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await send({'type': 'replay', 'payload': frame})
+            sent += 1
+        at = result['next']
+    await send({'type': 'replay_end', 'payload': {'since': since, 'until': until, 'frames': sent}})
+    return sent
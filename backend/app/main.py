@@ -1,30 +1,89 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import Body, Path, Query
+from fastapi import Body, Path, Query, Request
+from fastapi.responses import JSONResponse, Response
 import uvicorn
+import asyncio
+import inspect
 import os
+import tempfile
 import time
 import jwt
-from .simulator import DemoSimulator
+from contextlib import asynccontextmanager
+from . import scenarios
+from .checkpoint import Checkpointer, restore_latest
+from .commands import check as command_check
+from .events import check as event_check
+from .history import replay
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestTimer
+from .network import load as read_network
+from .partition import make_simulator
+from .wire import JSON, MSGPACK, MSGPACK_MEDIA_TYPE, negotiate, encode
 
 DEMO_MODE = os.getenv("DEMO_MODE", "true").lower() == "true"
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret")
 JWT_ISSUER = os.getenv("OIDC_ISSUER", "demo-issuer")
+AUDIT_LOG_PATH = os.getenv("AUDIT_LOG_PATH", "audit.jsonl")
+# Where tick history spills once over its memory budget; empty for a temp dir
+HISTORY_DIR = os.getenv("HISTORY_DIR", "")
+# Processes to split the simulation tick across (see app.partition)
+SIM_PARTITIONS = int(os.getenv("SIM_PARTITIONS", "1"))
+# 'local': this process runs the simulator; 'worker': mirror app.sim_server (multi-worker)
+SIM_MODE = os.getenv("SIM_MODE", "local")
 
-app = FastAPI(title='AI Train Traffic - Prototype')
+# Periodic state checkpoints, restored on startup; empty disables them
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+# Network to load on startup when there is no checkpoint (see app.network); empty for the demo
+NETWORK_PATH = os.getenv("NETWORK_PATH", "")
+
+if SIM_MODE == "worker":
+    from .shared import SimReplica
+    sim = SimReplica.connect()
+else:
+    # Started by the lifespan hook, on the server's own loop, after any restore
+    sim = make_simulator(SIM_PARTITIONS, audit_path=AUDIT_LOG_PATH or None, history_dir=HISTORY_DIR or None,
+                         autostart=False)
+
+@asynccontextmanager
+async def lifespan(app):
+    checkpointer = None
+    if SIM_MODE != "worker":
+        restored = restore_latest(sim, CHECKPOINT_DIR) if CHECKPOINT_DIR else None
+        if restored is None and NETWORK_PATH:
+            sim.load_network(read_network(NETWORK_PATH))
+        if CHECKPOINT_DIR:
+            checkpointer = Checkpointer(sim, CHECKPOINT_DIR)
+            sim.tick_hooks.append(checkpointer)
+        # Workers share the machine; let their pools start on first use instead
+        scenarios.warm_up()
+    sim.start()
+    try:
+        yield
+    finally:
+        scenarios.shutdown()
+        if checkpointer is not None:
+            checkpointer.close()
+        sim.close()
+
+app = FastAPI(title='AI Train Traffic - Prototype', lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-sim = DemoSimulator()
+# Outermost, so the latency it records includes every other middleware
+app.add_middleware(RequestTimer)
 
 @app.get('/api/health')
 async def health():
     return { 'status': 'ok', 'demo_mode': DEMO_MODE }
 
+@app.get('/api/metrics')
+async def metrics():
+    """Tick phase, broadcast, client send, encoding and HTTP timings plus queue depths, in Prometheus text format"""
+    return Response(content=await resolved(sim.render_metrics()), media_type=METRICS_CONTENT_TYPE)
+
 @app.post('/api/auth/login')
 async def login(email: str = Body(...), role: str = Body("Observer")):
     # demo-only JWT (HS256)
@@ -40,24 +99,91 @@ async def login(email: str = Body(...), role: str = Body("Observer")):
     token = jwt.encode(claims, JWT_SECRET, algorithm="HS256")
     return {"access_token": token, "token_type": "bearer"}
 
+async def resolved(value):
+    """``value``, awaited first when it is a coroutine: worker replicas answer
+    calls that round-trip to the simulator process off the event loop"""
+    return await value if inspect.isawaitable(value) else value
+
+def cached(request: Request, name, build, fmt=JSON):
+    """Response memoized per state version, with an ETag so unchanged polls get a bodiless 304"""
+    etag = f'"{sim.state_version()}-{fmt}"'
+    match = request.headers.get('if-none-match')
+    if match and (match.strip() == '*' or etag in [m.strip() for m in match.split(',')]):
+        return Response(status_code=304, headers={'ETag': etag})
+    content = sim.memo((name, fmt), lambda: encode(build(), fmt))
+    media_type = MSGPACK_MEDIA_TYPE if fmt == MSGPACK else 'application/json'
+    return Response(content=content, media_type=media_type, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
 @app.get('/api/kpis')
-async def kpis():
-    return sim.kpis()
+async def kpis(request: Request):
+    return cached(request, 'kpis', sim.kpis)
+
+@app.get('/api/kpis/trends')
+async def kpi_trends(since: float = Query(None), until: float = Query(None), points: int = Query(200)):
+    """KPIs and system metrics between two simulated times (default: the last hour), bucket-averaged"""
+    return await resolved(sim.kpi_trends(since, until, max(1, min(points, 5000))))
+
+@app.get('/api/sections')
+async def sections():
+    return {"sections": list(sim.sections.values())}
 
 @app.get('/api/section/{section_id}/status')
 async def section_status(section_id: str = Path(...)):
-    return {"section_id": section_id, "positions": sim.get_positions(), "conflicts": []}
+    status = sim.section_status(section_id)
+    return status or {"error": "Section not found"}
 
 @app.post('/api/optimize')
-async def optimize():
-    rec = sim.generate_recommendation()
+async def optimize(horizon_min: float = Body(30.0), budget_ms: float = Body(1500.0), section_id: str = Body(None)):
+    """Evaluate candidate interventions in parallel and recommend the best measured plan"""
+    if section_id is not None and section_id not in sim.sections:
+        return {"error": "Section not found"}
+    rec = sim.generate_recommendation(section_id)
+    plans = scenarios.candidate_plans(sim, rec=rec)
+    run = await scenarios.run_plans(sim, plans, horizon_min * 60.0, budget_ms / 1000.0)
+    best = scenarios.best_plan(run)
+    baseline = next((r for r in run['results'] if r['plan']['action'] == 'none'), None)
+    if best is not None:
+        rec['summary'] = scenarios.describe(best['plan'])
+        rec['plan'] = best['plan']
+        if baseline is not None:
+            rec['metric']['time_saved_min'] = round(baseline['total_delay'] - best['total_delay'], 1)
+        rec['metric']['projected'] = {k: best[k] for k in ('total_delay', 'conflict_events', 'trains_finished')}
+    rec['scenarios'] = {k: run[k] for k in ('submitted', 'evaluated', 'timed_out', 'errors', 'elapsed_ms',
+                                            'horizon_s', 'seed')}
     return rec
 
 @app.post('/api/simulate')
-async def simulate(train_id: str = Body(...), delay_min: float = Body(...)):
-    # demo: log only; sim loop already ticking
+async def simulate(train_id: str = Body(...), delay_min: float = Body(...),
+                   horizon_min: float = Body(60.0), seed: int = Body(None), budget_ms: float = Body(5000.0)):
+    """What-if: replay the next ``horizon_min`` minutes headless with and without the delay"""
     sim.log_audit("simulate_called", {"train_id": train_id, "delay_min": delay_min})
-    return {"status": "started"}
+    if train_id not in sim.trains:
+        return {"error": "Train not found"}
+    plans = [{'action': 'none'}, {'action': 'hold', 'train': train_id, 'value': delay_min * 60.0}]
+    run = await scenarios.run_plans(sim, plans, horizon_min * 60.0, budget_ms / 1000.0, seed)
+    by_action = {r['plan']['action']: r for r in run['results']}
+    base, what = by_action.get('none'), by_action.get('hold')
+    if base is None or what is None:
+        if run['errors']:
+            return {"status": "error", "errors": run['errors'], "seed": run['seed'], "elapsed_ms": run['elapsed_ms']}
+        return {"status": "timeout", "seed": run['seed'], "elapsed_ms": run['elapsed_ms']}
+    return {
+        "status": "completed" if base['complete'] and what['complete'] else "partial",
+        "seed": run['seed'],
+        "train_id": train_id,
+        "delay_min": delay_min,
+        "baseline": base,
+        "scenario": what,
+        "impact": {k: round(what[k] - base[k], 2) for k in ('total_delay', 'conflict_events', 'trains_finished')},
+        "elapsed_ms": run['elapsed_ms']
+    }
+
+@app.get('/api/conflicts/forecast')
+async def conflicts_forecast(request: Request, horizon_s: float = Query(900.0), limit: int = Query(100)):
+    """Conflicts projected within ``horizon_s`` simulated seconds, soonest first"""
+    horizon_s = max(1.0, min(horizon_s, 4 * 3600.0))
+    limit = max(1, min(limit, 1000))
+    return cached(request, ('forecast', horizon_s, limit), lambda: sim.forecast_conflicts(horizon_s, limit))
 
 @app.get('/api/recommendations/active')
 async def recommendations_active():
@@ -65,7 +191,7 @@ async def recommendations_active():
 
 @app.post('/api/recommendation/{rec_id}/accept')
 async def accept_rec(rec_id: str = Path(...)):
-    return sim.accept_recommendation(rec_id)
+    return await resolved(sim.accept_recommendation(rec_id))
 
 @app.post('/api/recommendation/{rec_id}/request_supervisor')
 async def request_supervisor(rec_id: str = Path(...)):
@@ -89,8 +215,11 @@ async def reject(ticket_id: str = Path(...), comment: str = Body("Rejected")):
     return t or {"status": "not_found"}
 
 @app.get('/api/audit')
-async def audit(limit: int = Query(50)):
-    return {"entries": sim.audit[-limit:]}
+async def audit(limit: int = Query(50), action: str = Query(None), train: str = Query(None),
+                since: float = Query(None), until: float = Query(None), cursor: int = Query(None)):
+    """Newest audit entries matching the filters; pass ``next_cursor`` back as ``cursor`` for older ones"""
+    return sim.audit.query(action=action, train=train, since=since, until=until,
+                           cursor=cursor, limit=max(1, min(limit, 1000)))
 
 @app.get('/api/model/version')
 async def model_version():
@@ -98,84 +227,130 @@ async def model_version():
     return {"name": "heuristic-v0", "hash": "demo123", "deployed_at": int(time.time())}
 
 @app.get('/api/trains')
-async def get_trains():
+async def get_trains(request: Request):
     """Get all trains with detailed information"""
-    return {"trains": list(sim.trains.values())}
+    return cached(request, 'trains_body', lambda: {"trains": sim.memo('trains', sim.trains.to_list)})
 
 @app.get('/api/tracks')
-async def get_tracks():
+async def get_tracks(request: Request):
     """Get all tracks with current status"""
-    return {"tracks": list(sim.tracks.values())}
+    return cached(request, 'tracks_body', lambda: {"tracks": list(sim.tracks.values())})
+
+@app.get('/api/tracks/{block_id}/adjacent')
+async def adjacent_tracks(block_id: str = Path(...)):
+    """Blocks sharing an endpoint with this one"""
+    adjacent = sim.adjacent_blocks(block_id)
+    if adjacent is None:
+        return {"error": "Block not found"}
+    return {"block": block_id, "adjacent": adjacent}
+
+@app.post('/api/network/import')
+async def import_network(request: Request):
+    """Replace the running network with an uploaded one (see app.network).
+
+    The body, JSON Lines or (as application/zip) a zip of the CSV files, is
+    streamed to a temporary file, validated and swapped in; validation
+    problems come back as ``errors`` and leave the running network as is.
+    """
+    zipped = request.headers.get('content-type', '').startswith('application/zip')
+    fd, path = tempfile.mkstemp(prefix='network-', suffix='.zip' if zipped else '.jsonl')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async for chunk in request.stream():
+                f.write(chunk)
+        return await sim.import_network(path)
+    finally:
+        os.unlink(path)
+
+@app.get('/api/routes')
+async def get_routes():
+    """Id, waypoint count and length of every route; positions refer to routes by id"""
+    return {"routes": sim.memo('routes', sim.trains.geometry.summary)}
+
+@app.get('/api/routes/{route_id}')
+async def get_route(route_id: int = Path(...)):
+    """Geometry of one route (waypoints, cumulative km, bearings), fetched once per id by clients"""
+    return sim.trains.geometry.describe(route_id) or {"error": "Route not found"}
 
 @app.post('/api/train/{train_id}/control')
 async def control_train(train_id: str = Path(...), action: str = Body(...), value: float = Body(None)):
-    """Control individual train (speed, stop, start)"""
-    if train_id not in sim.trains:
-        return {"error": "Train not found"}
-    
-    train = sim.trains[train_id]
-    
-    if action == "speed":
-        train['speed'] = max(0, min(train['max_speed'], value))
-        sim.log_audit('train_speed_changed', {'train': train_id, 'new_speed': value})
-    elif action == "stop":
-        train['status'] = 'stopped'
-        train['speed'] = 0
-        sim.log_audit('train_stopped', {'train': train_id})
-    elif action == "start":
-        train['status'] = 'running'
-        sim.log_audit('train_started', {'train': train_id})
-    
-    return {"status": "success", "train": train}
+    """Control individual train (speed, stop, start), applied at the next tick"""
+    results = await sim.execute_commands([{'action': action, 'train_id': train_id, 'value': value}])
+    return results[0]
 
 @app.get('/api/system/status')
-async def system_status():
-    """Get comprehensive system status"""
-    return {
-        "trains": list(sim.trains.values()),
-        "tracks": list(sim.tracks.values()),
-        "metrics": sim.system_metrics,
-        "active_conflicts": len(sim._detect_all_conflicts()),
-        "timestamp": time.time()
-    }
+async def system_status(request: Request, format: str = Query(None)):
+    """Get comprehensive system status (JSON, or msgpack via ?format= / Accept)"""
+    fmt = MSGPACK if negotiate(format, request.headers.get('accept')) == MSGPACK else JSON
+    return cached(request, 'system_status', sim.system_status, fmt)
 
 @app.post('/api/simulation/event')
 async def trigger_event(event_type: str = Body(...), data: dict = Body({})):
-    """Manually trigger simulation events"""
-    if event_type == "add_train":
-        # Add a new train dynamically
-        new_id = f"T{len(sim.trains) + 1}"
-        sim.trains[new_id] = {
-            'id': new_id, 'label': f'Train {new_id}', 'type': 'passenger',
-            'route': [[20.0, 74.0], [20.0, 74.5], [20.0, 75.0]], 
-            'idx': 0, 'speed': 40, 'max_speed': 70, 'priority': 'medium',
-            'passengers': 200, 'status': 'running', 'delay': 0
-        }
-        sim.log_audit('train_added', {'train': new_id})
-        return {"status": "success", "train": sim.trains[new_id]}
-    
-    elif event_type == "emergency_stop":
-        # Emergency stop all trains
-        for train in sim.trains.values():
-            train['status'] = 'emergency_stop'
-            train['speed'] = 0
-        sim.log_audit('emergency_stop', {'reason': 'manual_trigger'})
-        return {"status": "success", "message": "All trains stopped"}
-    
-    return {"error": "Unknown event type"}
+    """Manually trigger simulation events, applied at the next tick"""
+    results = await sim.execute_commands([{'action': event_type, 'data': data}])
+    return results[0]
+
+@app.post('/api/commands')
+async def bulk_commands(commands: list = Body(..., embed=True)):
+    """Apply many speed/stop/start/add_train commands together at the next tick.
+
+    Each command is ``{"action", "train_id", "value", "data"}``; results come
+    back in the same order, with ``{"error": ...}`` for any that failed.
+    """
+    error = command_check(commands)
+    if error:
+        return {"error": error}
+    return {"results": await sim.execute_commands(commands)}
+
+@app.post('/api/events')
+async def schedule_events(events: list = Body(..., embed=True)):
+    """Schedule disruptions or commands at simulated times.
+
+    Each event is ``{"type", "at" | "in_s", "data"}`` with type one of
+    delay/speed_restriction/maintenance or a command action; returns the
+    scheduled events (with ids) or an error per event, in order. A request
+    with any malformed event is refused whole with a 400.
+    """
+    error = event_check(events)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+    return {"results": sim.schedule_events(events)}
+
+@app.get('/api/events')
+async def upcoming_events(limit: int = Query(50), type: str = Query(None), until: float = Query(None)):
+    """Earliest pending scheduled events"""
+    return sim.upcoming_events(max(1, min(limit, 1000)), type, until)
+
+@app.delete('/api/events/{event_id}')
+async def cancel_event(event_id: str = Path(...)):
+    return sim.cancel_event(event_id)
+
+async def send_command_results(client, request_id, commands):
+    results = await sim.execute_commands(commands)
+    await client.send_json({'type':'command_results', 'payload': {'id': request_id, 'results': results}})
 
 @app.websocket('/ws/sim')
-async def websocket_sim(ws: WebSocket):
+async def websocket_sim(ws: WebSocket, format: str = Query(None)):
     await ws.accept()
     client = sim.register_client(ws)
+    client.format = negotiate(format)
     try:
-        # initial positions
-        await client.send_json({'type':'positions', 'payload': sim.get_positions()})
+        # initial routes, positions and tracks; later frames are deltas
+        sim.send_keyframe(client)
         while True:
             msg = await ws.receive_json()
             t = msg.get('type')
             if t == 'subscribe':
-                await client.send_json({'type':'positions', 'payload': sim.get_positions()})
+                error = sim.subscribe(client, msg.get('payload'), msg.get('format'))
+                if error:
+                    await client.send_json({'type':'audit', 'payload': {'action':'invalid_subscription', 'error': error}})
+            elif t == 'commands':
+                error = command_check(msg.get('payload'))
+                if error:
+                    await client.send_json({'type':'command_results', 'payload': {'id': msg.get('id'), 'error': error}})
+                else:
+                    # Reply once the tick has applied them; keep reading meanwhile
+                    asyncio.ensure_future(send_command_results(client, msg.get('id'), msg['payload']))
             elif t == 'request_approval':
                 payload = msg.get('payload')
                 ticket = sim.request_approval(payload)
@@ -185,5 +360,20 @@ async def websocket_sim(ws: WebSocket):
     except WebSocketDisconnect:
         sim.unregister_client(client)
 
+@app.websocket('/ws/replay')
+async def websocket_replay(ws: WebSocket, since: float = Query(...), until: float = Query(None),
+                           speed: float = Query(1.0)):
+    """Replay recorded train states between two simulated times at ``speed`` times real time"""
+    await ws.accept()
+    if speed <= 0:
+        await ws.send_json({'type': 'replay_end', 'payload': {'error': 'Speed must be positive'}})
+        await ws.close()
+        return
+    try:
+        await replay(ws.send_json, sim.history_page, since, sim.clock.now if until is None else until, speed)
+        await ws.close()
+    except WebSocketDisconnect:
+        pass
+
 if __name__ == '__main__':
     uvicorn.run('app.main:app', host='0.0.0.0', port=8000, reload=True)
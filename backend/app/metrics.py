@@ -0,0 +1,211 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Histograms keep per-bucket counts for fixed bounds, so an observation is
+one bisect and a few additions with no allocation; nothing is aggregated
+until a scrape renders them. Families may carry labels, each combination
+getting its own child on first use, so label values must stay few.
+"""
+import bisect
+import math
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Wall-time buckets in seconds, from sub-millisecond tick phases to multi-second stalls
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _number(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _ValueChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1.0):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Family:
+    kind = ''
+
+    def __init__(self, name, help, labels=(), fn: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.labelnames: Tuple[str, ...] = tuple(labels)
+        # Unlabelled counters and gauges may be read from ``fn`` at scrape time instead
+        self.fn = fn
+        self.children: Dict[tuple, object] = {}
+
+    def labels(self, *values):
+        """Child for one combination of label values, created on first use"""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._child()
+        return child
+
+    def _labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def lines(self):
+        if self.fn is not None:
+            yield f'{self.name} {_number(self.fn())}'
+            return
+        for values, child in self.children.items():
+            yield f'{self.name}{self._labels(values)} {_number(child.value)}'
+
+
+class Histogram(_Family):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        if not labels:
+            self.labels()
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value, *labels):
+        self.labels(*labels).observe(value)
+
+    def lines(self):
+        bounds = self.buckets + (math.inf,)
+        for values, child in self.children.items():
+            total = 0
+            for bound, n in zip(bounds, child.counts):
+                total += n
+                yield f'{self.name}_bucket{self._labels(values, [("le", _number(bound))])} {total}'
+            yield f'{self.name}_sum{self._labels(values)} {_number(child.sum)}'
+            yield f'{self.name}_count{self._labels(values)} {child.count}'
+
+
+class Counter(_Family):
+    kind = 'counter'
+
+    def _child(self):
+        return _ValueChild()
+
+    def inc(self, amount=1.0, *labels):
+        self.labels(*labels).inc(amount)
+
+
+class Gauge(_Family):
+    kind = 'gauge'
+
+    def _child(self):
+        return _ValueChild()
+
+    def set(self, value, *labels):
+        self.labels(*labels).set(value)
+
+
+class Registry:
+    """Named metric families, rendered together in registration order"""
+
+    def __init__(self):
+        self.families: Dict[str, _Family] = {}
+
+    def _add(self, family):
+        existing = self.families.get(family.name)
+        if existing is not None:
+            if existing.kind != family.kind:
+                raise ValueError(f'metric {family.name} already registered as a {existing.kind}')
+            return existing
+        self.families[family.name] = family
+        return family
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def counter(self, name, help, labels=(), fn=None) -> Counter:
+        return self._add(Counter(name, help, labels, fn))
+
+    def gauge(self, name, help, labels=(), fn=None) -> Gauge:
+        return self._add(Gauge(name, help, labels, fn))
+
+    def render(self, include=None, exclude=()):
+        """Text exposition of every family, or only those named in ``include``"""
+        out = []
+        for name, family in self.families.items():
+            if (include is not None and name not in include) or name in exclude:
+                continue
+            out.append(f'# HELP {name} {family.help}')
+            out.append(f'# TYPE {name} {family.kind}')
+            out.extend(family.lines())
+        return '\n'.join(out) + '\n' if out else ''
+
+
+def lap(child, since):
+    """Observe the time since ``since`` (a perf_counter reading) and return the current reading"""
+    now = time.perf_counter()
+    child.observe(now - since)
+    return now
+
+
+# Families about the whole process rather than one simulator
+PROCESS = Registry()
+ENCODE_SECONDS = PROCESS.histogram('wire_encode_seconds', 'Time to encode one outgoing message', ('format',))
+HTTP_SECONDS = PROCESS.histogram('http_request_seconds', 'HTTP request latency by route template',
+                                 ('method', 'route', 'status'))
+
+
+class RequestTimer:
+    """ASGI middleware observing HTTP_SECONDS for every request.
+
+    Requests are labelled with the matched route's path template (or
+    'unmatched'), never the raw path, to keep the label set bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = []
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            await send(message)
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            HTTP_SECONDS.observe(time.perf_counter() - started, scope['method'], route,
+                                 str(status[0]) if status else '500')
@@ -0,0 +1,503 @@
+"""Streaming import of network topology and timetables.
+
+Two layouts are accepted, as a directory, a zip archive or a single file:
+
+* GTFS-style CSV files: ``blocks.csv`` (id, from_lat, from_lon, to_lat,
+  to_lon[, capacity, speed_limit]), ``route_points.csv`` (route_id,
+  sequence, lat, lon - like GTFS ``shapes.txt``), ``trains.csv`` (id,
+  route_id[, label, type, priority, speed, max_speed, delay, dist, status,
+  depart_s]; other columns are kept as train metadata) and optionally
+  ``sections.csv`` (id, name, lat_min, lon_min, lat_max, lon_max).
+* JSON Lines with one ``{"kind": "block" | "route" | "train" | "section"}``
+  record per line and the same fields. Blocks may give ``from``/``to``
+  pairs, routes carry ``points`` and trains may embed a ``route``.
+
+Records are read and validated in chunks of CHUNK_ROWS into compact
+arrays, so peak memory follows the size of the network, not of the file.
+Waypoints shared by several routes or blocks are stored once, identical
+routes are interned, and which blocks touch which is worked out once here.
+``depart_s`` is a timetabled departure, in seconds after the load, until
+which the train is held at its origin.
+"""
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+import zipfile
+from typing import Any, Dict, List
+
+import numpy as np
+
+from .routes import RouteGeometry
+from .trainstate import COLUMNS, TrainState, status_code
+
+# Records parsed and validated per batch
+CHUNK_ROWS = 20000
+# Problems collected before an import is abandoned
+MAX_ERRORS = 50
+# Defaults for optional fields
+DEFAULT_CAPACITY = 1
+DEFAULT_SPEED_LIMIT = 80.0
+DEFAULT_MAX_SPEED = 80.0
+PRIORITIES = ('high', 'medium', 'low')
+# Statuses a train may be imported with ('held' comes from depart_s)
+STATUSES = ('running', 'stopped', 'emergency_stop')
+
+_CSV_FILES = ('blocks', 'sections', 'route_points', 'trains')
+# Train fields stored in columns or used by the import itself, not kept as metadata
+_TRAIN_FIELDS = ('kind', 'id', 'route_id', 'route', 'status', 'depart_s') + tuple(COLUMNS)
+
+
+class NetworkError(ValueError):
+    """An import failed validation; ``errors`` lists the problems with their source lines"""
+
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} problem(s) importing network, first: {errors[0]}')
+        self.errors = errors
+
+
+class Network:
+    """An imported network, ready for :meth:`DemoSimulator.load_network`"""
+
+    def __init__(self, trains, tracks, sections, adjacency, departures, summary):
+        self.trains: TrainState = trains
+        self.tracks: Dict[str, Dict[str, Any]] = tracks
+        self.sections: Dict[str, Dict[str, Any]] = sections
+        # CSR (indptr, indices) over the blocks in ``tracks`` order
+        self.adjacency = adjacency
+        # train id -> seconds after loading at which it may leave
+        self.departures: Dict[str, float] = departures
+        self.summary: Dict[str, Any] = summary
+
+
+def block_adjacency(nodes, n_blocks):
+    """Blocks sharing an endpoint, as CSR (indptr, indices).
+
+    ``nodes`` holds interned endpoint ids, from and to of each block in
+    turn (length 2 * n_blocks). Neighbours of a block come out sorted.
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    order = np.argsort(nodes, kind='stable')
+    sorted_nodes = nodes[order]
+    first = np.searchsorted(sorted_nodes, sorted_nodes, side='left')
+    counts = np.searchsorted(sorted_nodes, sorted_nodes, side='right') - first
+    # Every endpoint paired with every endpoint at the same node
+    total = int(counts.sum())
+    a = np.repeat(order, counts)
+    b = order[np.repeat(first, counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)]
+    a, b = a // 2, b // 2
+    keep = a != b
+    pairs = np.unique(a[keep] * n_blocks + b[keep])
+    src, dst = np.divmod(pairs, max(n_blocks, 1))
+    return np.searchsorted(src, np.arange(n_blocks + 1)), dst
+
+
+def _blank(value):
+    return value is None or value == ''
+
+
+class _Chunk:
+    """A batch of records (dicts) and the source line of each, for error messages"""
+
+    def __init__(self, source, records, lines, errors):
+        self.source = source
+        self.records = records
+        self.lines = lines
+        self.errors = errors
+        self.ok = np.ones(len(records), dtype=bool)
+
+    def fail(self, i, message):
+        self.ok[i] = False
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(f'{self.source}:{self.lines[i]}: {message}')
+
+    def numbers(self, key, default=None, valid=None):
+        """Field ``key`` of every record as floats; bad or missing values fail the record"""
+        values = [r.get(key) for r in self.records]
+        if default is not None:
+            values = [default if _blank(v) else v for v in values]
+        try:
+            arr = np.array(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            arr = np.full(len(values), np.nan)
+            for i, v in enumerate(values):
+                try:
+                    arr[i] = float(v)
+                except (TypeError, ValueError):
+                    pass
+        bad = ~np.isfinite(arr)
+        if valid is not None:
+            bad |= ~valid(np.nan_to_num(arr))
+        for i in np.flatnonzero(bad).tolist():
+            self.fail(i, f'invalid {key} {values[i]!r}')
+        return arr
+
+    def strings(self, key, default=None):
+        """Field ``key`` of every record as strings; missing values fail the record unless defaulted"""
+        out = []
+        for i, r in enumerate(self.records):
+            v = r.get(key)
+            if _blank(v):
+                if default is None:
+                    self.fail(i, f'missing {key}')
+                    v = ''
+                else:
+                    v = default if not callable(default) else default(r)
+            out.append(str(v))
+        return out
+
+
+class _Builder:
+    """Accumulates validated chunks; :meth:`finish` turns them into simulator structures"""
+
+    def __init__(self):
+        self.errors: List[str] = []
+        self.block_ids: List[str] = []
+        self.block_seen: Dict[str, None] = {}
+        self.block_ends: List[np.ndarray] = []
+        self.block_capacity: List[np.ndarray] = []
+        self.block_limit: List[np.ndarray] = []
+        self.sections: Dict[str, Dict[str, Any]] = {}
+        # external route id -> route number; points keyed by route number
+        self.route_keys: Dict[str, int] = {}
+        self.point_route: List[np.ndarray] = []
+        self.point_seq: List[np.ndarray] = []
+        self.point_xy: List[np.ndarray] = []
+        self.train_ids: List[str] = []
+        self.train_seen: Dict[str, None] = {}
+        self.train_routes: List[str] = []
+        self.train_lines: List[str] = []
+        self.train_meta: List[Dict[str, Any]] = []
+        self.train_status: List[str] = []
+        self.train_cols: Dict[str, List[np.ndarray]] = {k: [] for k in ('speed', 'max_speed', 'delay', 'dist', 'depart_s')}
+
+    def _unique(self, chunk, ids, seen, what):
+        for i, v in enumerate(ids):
+            if v in seen and chunk.ok[i]:
+                chunk.fail(i, f'duplicate {what} id {v!r}')
+            seen[v] = None
+
+    # -- record kinds -------------------------------------------------------
+    def blocks(self, chunk):
+        for r in chunk.records:
+            if 'from' in r and 'to' in r:
+                try:
+                    r['from_lat'], r['from_lon'] = r['from']
+                    r['to_lat'], r['to_lon'] = r['to']
+                except (TypeError, ValueError):
+                    pass
+        ids = chunk.strings('id')
+        lat = lambda a: np.abs(a) <= 90
+        lon = lambda a: np.abs(a) <= 180
+        ends = np.stack([chunk.numbers('from_lat', valid=lat), chunk.numbers('from_lon', valid=lon),
+                         chunk.numbers('to_lat', valid=lat), chunk.numbers('to_lon', valid=lon)], axis=1)
+        capacity = chunk.numbers('capacity', DEFAULT_CAPACITY, lambda a: (a >= 1) & (a == np.floor(a)))
+        limit = chunk.numbers('speed_limit', DEFAULT_SPEED_LIMIT, lambda a: a > 0)
+        self._unique(chunk, ids, self.block_seen, 'block')
+        ok = chunk.ok
+        self.block_ids.extend(itertools.compress(ids, ok.tolist()))
+        self.block_ends.append(ends[ok])
+        self.block_capacity.append(capacity[ok].astype(np.int64))
+        self.block_limit.append(limit[ok])
+
+    def route_points(self, chunk):
+        keys = chunk.strings('route_id')
+        seq = chunk.numbers('sequence')
+        lat = chunk.numbers('lat', valid=lambda a: np.abs(a) <= 90)
+        lon = chunk.numbers('lon', valid=lambda a: np.abs(a) <= 180)
+        ok = chunk.ok
+        rid = np.array([self.route_keys.setdefault(k, len(self.route_keys)) for k in itertools.compress(keys, ok.tolist())],
+                       dtype=np.int64)
+        self.point_route.append(rid)
+        self.point_seq.append(seq[ok])
+        self.point_xy.append(np.stack([lat[ok], lon[ok]], axis=1))
+
+    def routes(self, chunk):
+        """JSON Lines routes: ``{"id", "points": [[lat, lon], ...]}``, expanded into route points"""
+        expanded, lines = [], []
+        for i, r in enumerate(chunk.records):
+            points = r.get('points')
+            if _blank(r.get('id')) or not isinstance(points, list):
+                chunk.fail(i, 'route needs an id and a points list')
+                continue
+            for k, p in enumerate(points):
+                ok = isinstance(p, (list, tuple)) and len(p) == 2
+                expanded.append({'route_id': r['id'], 'sequence': k,
+                                 'lat': p[0] if ok else None, 'lon': p[1] if ok else None})
+                lines.append(chunk.lines[i])
+        if expanded:
+            self.route_points(_Chunk(chunk.source, expanded, lines, self.errors))
+
+    def trains(self, chunk):
+        inline, lines = [], []
+        for i, r in enumerate(chunk.records):
+            if _blank(r.get('route_id')) and isinstance(r.get('route'), list) and not _blank(r.get('id')):
+                # Embedded route: registered under a private key, interned with the rest
+                r['route_id'] = f'\0{r["id"]}'
+                inline.append({'id': r['route_id'], 'points': r['route']})
+                lines.append(chunk.lines[i])
+        if inline:
+            self.routes(_Chunk(chunk.source, inline, lines, self.errors))
+        ids = chunk.strings('id')
+        routes = chunk.strings('route_id')
+        max_speed = chunk.numbers('max_speed', DEFAULT_MAX_SPEED, lambda a: a > 0)
+        # Trains without a speed start at their maximum
+        given = np.array([not _blank(r.get('speed')) for r in chunk.records], dtype=bool)
+        speed = np.where(given, chunk.numbers('speed', 0.0), max_speed)
+        delay = chunk.numbers('delay', 0.0, lambda a: a >= 0)
+        dist = chunk.numbers('dist', 0.0, lambda a: a >= 0)
+        depart = chunk.numbers('depart_s', 0.0, lambda a: a >= 0)
+        status = chunk.strings('status', 'running')
+        for i in np.flatnonzero((speed < 0) | (speed > max_speed)).tolist():
+            chunk.fail(i, f'speed {speed[i]} outside 0..max_speed')
+        for i, (s, r) in enumerate(zip(status, chunk.records)):
+            if s not in STATUSES:
+                chunk.fail(i, f'unknown status {s!r}')
+            if not _blank(r.get('priority')) and r['priority'] not in PRIORITIES:
+                chunk.fail(i, f'unknown priority {r.get("priority")!r}')
+        self._unique(chunk, ids, self.train_seen, 'train')
+        ok = chunk.ok
+        keep = ok.tolist()
+        self.train_ids.extend(itertools.compress(ids, keep))
+        self.train_routes.extend(itertools.compress(routes, keep))
+        self.train_status.extend(itertools.compress(status, keep))
+        self.train_lines.extend(f'{chunk.source}:{line}' for line in itertools.compress(chunk.lines, keep))
+        for r, t in zip(itertools.compress(chunk.records, keep), itertools.compress(ids, keep)):
+            meta = {k: v for k, v in r.items() if k not in _TRAIN_FIELDS and not _blank(v)}
+            meta.setdefault('label', t)
+            meta.setdefault('type', 'passenger')
+            meta.setdefault('priority', 'medium')
+            self.train_meta.append(meta)
+        for name, arr in (('speed', speed), ('max_speed', max_speed), ('delay', delay),
+                          ('dist', dist), ('depart_s', depart)):
+            self.train_cols[name].append(arr[ok])
+
+    def section_records(self, chunk):
+        for r in chunk.records:
+            if isinstance(r.get('bounds'), list):
+                try:
+                    (r['lat_min'], r['lon_min']), (r['lat_max'], r['lon_max']) = r['bounds']
+                except (TypeError, ValueError):
+                    pass
+        ids = chunk.strings('id')
+        names = chunk.strings('name', lambda r: r.get('id'))
+        box = [chunk.numbers(k) for k in ('lat_min', 'lon_min', 'lat_max', 'lon_max')]
+        for i in np.flatnonzero((box[0] > box[2]) | (box[1] > box[3])).tolist():
+            chunk.fail(i, 'section bounds are inverted')
+        self._unique(chunk, ids, self.sections, 'section')
+        for i in np.flatnonzero(chunk.ok).tolist():
+            self.sections[ids[i]] = {'id': ids[i], 'name': names[i],
+                                     'bounds': [[box[0][i], box[1][i]], [box[2][i], box[3][i]]]}
+
+    # -- assembly -----------------------------------------------------------
+    def _routes(self):
+        """Waypoints of each referenced route, interned, as (pts, lens, route of each train)"""
+        n_routes = len(self.route_keys)
+        rid = np.concatenate(self.point_route) if self.point_route else np.zeros(0, dtype=np.int64)
+        seq = np.concatenate(self.point_seq) if self.point_seq else np.zeros(0)
+        xy = np.concatenate(self.point_xy) if self.point_xy else np.zeros((0, 2))
+        order = np.lexsort((seq, rid))
+        rid, seq, xy = rid[order], seq[order], xy[order]
+        dup = np.flatnonzero((rid[1:] == rid[:-1]) & (seq[1:] == seq[:-1]))
+        names = list(self.route_keys)
+        for k in dup[:MAX_ERRORS].tolist():
+            self.errors.append(f'route {names[rid[k]]!r}: sequence {seq[k]:g} given twice')
+        starts = np.searchsorted(rid, np.arange(n_routes + 1))
+        # Identical waypoint sequences become one interned route
+        interned: Dict[bytes, int] = {}
+        remap = np.full(n_routes, -1, dtype=np.int64)
+        slices = []
+        train_route = np.zeros(len(self.train_ids), dtype=np.int32)
+        for row, key in enumerate(self.train_routes):
+            r = self.route_keys.get(key)
+            if r is None:
+                self.errors.append(f'{self.train_lines[row]}: unknown route_id {key!r}')
+                continue
+            if remap[r] < 0:
+                a, b = starts[r], starts[r + 1]
+                if b - a < 2:
+                    self.errors.append(f'{self.train_lines[row]}: route {key.lstrip(chr(0))!r} has fewer than 2 points')
+                    remap[r] = 0
+                    continue
+                remap[r] = interned.setdefault(xy[a:b].tobytes(), len(interned))
+                if remap[r] == len(slices):
+                    slices.append((a, b))
+            train_route[row] = remap[r]
+            if len(self.errors) >= MAX_ERRORS:
+                break
+        pts = np.concatenate([xy[a:b] for a, b in slices]) if slices else np.zeros((0, 2))
+        lens = np.array([b - a for a, b in slices], dtype=np.int64)
+        return pts, lens, train_route
+
+    def finish(self, started):
+        ends = np.concatenate(self.block_ends) if self.block_ends else np.zeros((0, 4))
+        pts, lens, train_route = self._routes()
+        if not self.block_ids:
+            # Nothing could run on it, and per-block metrics divide by the count
+            self.errors.append('network has no blocks')
+        if self.errors:
+            raise NetworkError(self.errors)
+        n_blocks = len(self.block_ids)
+        # One table of distinct coordinates; blocks and routes share its [lat, lon] lists
+        coords = np.concatenate([ends.reshape(-1, 2), pts])
+        uniq, inverse = np.unique(np.ascontiguousarray(coords).view(np.complex128).ravel(), return_inverse=True)
+        inverse = inverse.ravel()
+        table = uniq.view(np.float64).reshape(-1, 2).tolist()
+        nodes = inverse[:2 * n_blocks]
+        capacity = np.concatenate(self.block_capacity).tolist() if n_blocks else []
+        limit = np.concatenate(self.block_limit).tolist() if n_blocks else []
+        node_list = nodes.tolist()
+        tracks = {}
+        for b, block_id in enumerate(self.block_ids):
+            tracks[block_id] = {'id': block_id, 'from': table[node_list[2 * b]], 'to': table[node_list[2 * b + 1]],
+                                'status': 'free', 'capacity': capacity[b], 'speed_limit': limit[b]}
+        adjacency = block_adjacency(nodes, n_blocks)
+
+        point_list = inverse[2 * n_blocks:].tolist()
+        cuts = np.cumsum(lens).tolist()
+        routes = [[table[k] for k in point_list[a:b]] for a, b in zip([0] + cuts[:-1], cuts)]
+        geometry = RouteGeometry.from_flat(pts, lens)
+        cols = {name: np.concatenate(arrs) if arrs else np.zeros(0) for name, arrs in self.train_cols.items()}
+        # Trains start where ``dist`` puts them, clipped to their route
+        dist = np.minimum(cols['dist'], geometry.flat()['total'][train_route]) if len(train_route) else cols['dist']
+        idx = geometry.locate(train_route, dist)[0] if len(train_route) else np.zeros(0, dtype=np.int64)
+        depart = cols['depart_s']
+        waiting = (depart > 0) & np.array([s == 'running' for s in self.train_status], dtype=bool)
+        status = np.array([status_code(s) for s in self.train_status], dtype=np.int8)
+        status[waiting] = status_code('held')
+        trains = TrainState()
+        trains.load(self.train_ids, self.train_meta, routes, {
+            'idx': idx, 'speed': cols['speed'], 'max_speed': cols['max_speed'], 'delay': cols['delay'],
+            'dist': dist, 'status': status, 'route': train_route
+        }, geometry)
+        departures = dict(zip(itertools.compress(self.train_ids, waiting.tolist()), depart[waiting].tolist()))
+
+        sections = self.sections
+        if not sections and len(coords):
+            # Without sections, one covering everything keeps subscriptions and partitions working
+            lo, hi = coords.min(axis=0).tolist(), coords.max(axis=0).tolist()
+            sections = {'ALL': {'id': 'ALL', 'name': 'Whole network', 'bounds': [lo, hi]}}
+        degree = np.diff(adjacency[0])
+        summary = {
+            'blocks': n_blocks, 'sections': len(sections), 'trains': len(trains),
+            'routes': len(lens), 'route_points': int(lens.sum()), 'distinct_points': len(table),
+            'adjacent_pairs': int(len(adjacency[1]) // 2), 'isolated_blocks': int((degree == 0).sum()),
+            'departures': len(departures),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+        }
+        return Network(trains, tracks, sections, adjacency, departures, summary)
+
+
+# -- sources ------------------------------------------------------------------
+def _chunks(records, source, errors):
+    """Group (line, record) pairs into _Chunks of CHUNK_ROWS"""
+    while True:
+        batch = list(itertools.islice(records, CHUNK_ROWS))
+        if not batch:
+            return
+        lines, recs = zip(*batch)
+        yield _Chunk(source, list(recs), list(lines), errors)
+        if len(errors) >= MAX_ERRORS:
+            raise NetworkError(errors)
+
+
+def _csv_records(f):
+    reader = csv.reader(f)
+    header = [h.strip() for h in next(reader, [])]
+    for line, row in enumerate(reader, start=2):
+        if row:
+            yield line, {k: v.strip() for k, v in zip(header, row)}
+
+
+def _jsonl_records(f, errors, source):
+    for line, text in enumerate(f, start=1):
+        text = text.strip()
+        if not text:
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            errors.append(f'{source}:{line}: {e}')
+            if len(errors) >= MAX_ERRORS:
+                raise NetworkError(errors)
+            continue
+        if not isinstance(record, dict):
+            errors.append(f'{source}:{line}: expected an object')
+            continue
+        yield line, record
+
+
+def _read_csv(builder, opened):
+    """Feed CSV files, given as name -> open() callables, to the builder"""
+    missing = [name for name in ('blocks', 'route_points', 'trains') if name not in opened]
+    if missing:
+        raise NetworkError([f'missing {name}.csv' for name in missing])
+    handlers = {'blocks': builder.blocks, 'sections': builder.section_records,
+                'route_points': builder.route_points, 'trains': builder.trains}
+    for name in _CSV_FILES:
+        if name in opened:
+            with opened[name]() as f:
+                for chunk in _chunks(_csv_records(f), f'{name}.csv', builder.errors):
+                    handlers[name](chunk)
+
+
+def _read_jsonl(builder, f, source):
+    handlers = {'block': builder.blocks, 'section': builder.section_records,
+                'route': builder.routes, 'train': builder.trains}
+    for chunk in _chunks(_jsonl_records(f, builder.errors, source), source, builder.errors):
+        # One pass per kind keeps each batch vectorized however the lines interleave
+        for kind, handler in handlers.items():
+            picked = [i for i, r in enumerate(chunk.records) if r.get('kind') == kind]
+            if picked:
+                handler(_Chunk(source, [chunk.records[i] for i in picked], [chunk.lines[i] for i in picked],
+                               builder.errors))
+        for i, r in enumerate(chunk.records):
+            if r.get('kind') not in handlers:
+                chunk.fail(i, f'unknown kind {r.get("kind")!r}')
+
+
+def load(path) -> Network:
+    """Import a network from a CSV directory, a zip of CSV files or a JSON Lines file.
+
+    Raises NetworkError listing the problems (with file and line) when
+    anything fails validation; nothing is returned half-built.
+    """
+    started = time.perf_counter()
+    builder = _Builder()
+    if os.path.isdir(path):
+        opened = {name: (lambda p=os.path.join(path, f'{name}.csv'): open(p, newline='', encoding='utf-8'))
+                  for name in _CSV_FILES if os.path.exists(os.path.join(path, f'{name}.csv'))}
+        _read_csv(builder, opened)
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            members = {os.path.basename(m)[:-4]: m for m in zf.namelist() if m.endswith('.csv')}
+            opened = {name: (lambda m=members[name]: io.TextIOWrapper(zf.open(m), encoding='utf-8', newline=''))
+                      for name in _CSV_FILES if name in members}
+            _read_csv(builder, opened)
+    else:
+        with open(path, encoding='utf-8') as f:
+            _read_jsonl(builder, f, os.path.basename(path))
+    return builder.finish(started)
+
+
+def main(argv=None):
+    """Validate a network file and print its summary: ``python -m app.network PATH``"""
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print('usage: python -m app.network PATH', file=sys.stderr)
+        return 2
+    try:
+        network = load(argv[0])
+    except (OSError, NetworkError) as e:
+        for line in getattr(e, 'errors', [str(e)]):
+            print(line, file=sys.stderr)
+        return 1
+    print(json.dumps(network.summary, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+from typing import Dict, Any, List
+
+import numpy as np
+
+from .spatial import GridIndex
+
+# A train occupies every block with an endpoint within this distance
+OCCUPANCY_RADIUS = 0.1
+
+
+class BlockOccupancy:
+    """Route waypoint -> block index with per-block occupancy counters.
+
+    For each interned route the blocks near every waypoint are looked up
+    once, so moving a train only touches the blocks it leaves and enters.
+    A block is 'occupied' once its occupant count reaches its ``capacity``.
+    """
+
+    def __init__(self, tracks: Dict[str, Dict[str, Any]]):
+        self.tracks = tracks
+        self.block_ids: List[str] = list(tracks)
+        self.block_index = {b: i for i, b in enumerate(self.block_ids)}
+        ends = [p for t in tracks.values() for p in (t['from'], t['to'])]
+        self.grid = GridIndex(ends)
+        self.capacity = np.array([t.get('capacity', 1) for t in tracks.values()], dtype=np.int32)
+        self.count = np.zeros(len(self.block_ids), dtype=np.int32)
+        # Insertion-ordered occupant sets; the first entry is reported as occupied_by
+        self.occupants: List[Dict[str, None]] = [{} for _ in self.block_ids]
+        # train id -> (route id, waypoint idx, blocks)
+        self.placed: Dict[str, tuple] = {}
+        self._route_blocks: Dict[int, List[tuple]] = {}
+        self._structure = None
+        # Blocks changed since the last drain_dirty(), and a change counter
+        self.dirty = set()
+        self.version = 0
+        # Blocks closed for maintenance, and an index of their endpoints
+        self.closed: Dict[int, None] = {}
+        self._closed_grid = None
+        for b in range(len(self.block_ids)):
+            self._refresh(b)
+
+    def route_blocks(self, routes, rid):
+        """Blocks touched at each waypoint of route ``rid``, computed once per route"""
+        blocks = self._route_blocks.get(rid)
+        if blocks is None:
+            pts = np.asarray(routes[rid], dtype=np.float64)
+            ii, jj, _ = self.grid.query(pts, OCCUPANCY_RADIUS)
+            per_point: List[set] = [set() for _ in range(len(pts))]
+            for i, b in zip(ii.tolist(), (jj // 2).tolist()):
+                per_point[i].add(b)
+            blocks = [tuple(sorted(s)) for s in per_point]
+            self._route_blocks[rid] = blocks
+        return blocks
+
+    def compile_routes(self, geometry):
+        """Look up the blocks of every compiled route not seen yet in one batched query"""
+        f = geometry.flat()
+        todo = np.array([rid for rid in range(len(f['lens'])) if rid not in self._route_blocks], dtype=np.int64)
+        if not len(todo):
+            return
+        lens = f['lens'][todo]
+        first = np.repeat(f['offs'][todo] - (np.cumsum(lens) - lens), lens)
+        pts = f['pts'][first + np.arange(int(lens.sum()))]
+        # Routes overlap heavily, so look up each distinct waypoint once
+        uniq, inverse = np.unique(np.ascontiguousarray(pts).view(np.complex128).ravel(), return_inverse=True)
+        uniq = uniq.view(np.float64).reshape(-1, 2)
+        ii, jj, _ = self.grid.query(uniq, OCCUPANCY_RADIUS)
+        # Pairs come back ordered by (waypoint, endpoint), so block ids are
+        # ordered per waypoint and duplicates (both ends of a block) adjacent
+        key = ii * len(self.block_ids) + jj // 2
+        keep = np.ones(len(key), dtype=bool)
+        keep[1:] = key[1:] != key[:-1]
+        point, block = ii[keep], (jj // 2)[keep]
+        cuts = np.searchsorted(point, np.arange(len(uniq) + 1)).tolist()
+        block = block.tolist()
+        shared = [tuple(block[a:b]) for a, b in zip(cuts[:-1], cuts[1:])]
+        per_point = [shared[k] for k in inverse.ravel().tolist()]
+        start = 0
+        for rid, n in zip(todo.tolist(), lens.tolist()):
+            self._route_blocks[rid] = per_point[start:start + n]
+            start += n
+
+    def place(self, train_id, routes, rid, idx, touched=None):
+        """Move a train to waypoint ``idx`` of route ``rid``.
+
+        Changed blocks are refreshed right away, or collected in ``touched``
+        for the caller to refresh once when placing many trains.
+        """
+        prev = self.placed.get(train_id)
+        if prev and prev[0] == rid and prev[1] == idx:
+            return
+        old = prev[2] if prev else ()
+        new = self.route_blocks(routes, rid)[idx]
+        self.placed[train_id] = (rid, idx, new)
+        changed = []
+        for b in old:
+            if b not in new:
+                del self.occupants[b][train_id]
+                self.count[b] -= 1
+                changed.append(b)
+        for b in new:
+            if b not in old:
+                self.occupants[b][train_id] = None
+                self.count[b] += 1
+                changed.append(b)
+        if touched is None:
+            for b in changed:
+                self._refresh(b)
+        else:
+            touched.update(changed)
+
+    def remove(self, train_id):
+        prev = self.placed.pop(train_id, None)
+        for b in (prev[2] if prev else ()):
+            del self.occupants[b][train_id]
+            self.count[b] -= 1
+            self._refresh(b)
+
+    def sync(self, trains, rows=None):
+        """Update occupancy for ``rows`` (or every train after adds/removes)"""
+        if rows is None or trains.structure != self._structure:
+            self._structure = trains.structure
+            for train_id in [t for t in self.placed if t not in trains]:
+                self.remove(train_id)
+            rows = range(len(trains))
+            self.compile_routes(trains.geometry)
+        ids, route, idx = trains.ids, trains.route, trains.idx
+        touched = set()
+        for row in rows:
+            self.place(ids[row], trains.routes, int(route[row]), int(idx[row]), touched)
+        for b in touched:
+            self._refresh(b)
+
+    def copy(self):
+        """Independent snapshot of the occupancy; the block geometry is shared"""
+        twin = BlockOccupancy.__new__(BlockOccupancy)
+        twin.__dict__.update(self.__dict__)
+        twin.tracks = {b: dict(t) for b, t in self.tracks.items()}
+        twin.capacity = self.capacity.copy()
+        twin.count = self.count.copy()
+        twin.occupants = [dict(o) for o in self.occupants]
+        twin.placed = dict(self.placed)
+        twin._route_blocks = dict(self._route_blocks)
+        twin.dirty = set(self.dirty)
+        twin.closed = dict(self.closed)
+        return twin
+
+    def reset(self):
+        """Forget every train; the next sync() places them all again. Closures are kept."""
+        self.placed.clear()
+        self._structure = None
+        self.count[:] = 0
+        for b, occupants in enumerate(self.occupants):
+            if occupants:
+                occupants.clear()
+                self._refresh(b)
+
+    def assign(self, block_id, occupants):
+        """Set a block's occupants as computed elsewhere (a partition worker)"""
+        b = self.block_index[block_id]
+        self.occupants[b] = dict.fromkeys(occupants)
+        self.count[b] = len(occupants)
+        self._refresh(b)
+
+    def close(self, block_id, closed=True):
+        """Close a block for maintenance, or reopen it; False for unknown blocks"""
+        b = self.block_index.get(block_id)
+        if b is None:
+            return False
+        if closed:
+            self.closed[b] = None
+        else:
+            self.closed.pop(b, None)
+        closed = [self.tracks[self.block_ids[c]] for c in self.closed]
+        ends = [p for t in closed for p in (t['from'], t['to'])]
+        self._closed_grid = GridIndex(ends) if ends else None
+        self._refresh(b)
+        return True
+
+    def closed_ahead(self, points, rows):
+        """Rows among ``rows`` that would reach a closed block at ``points`` (one per row)"""
+        if self._closed_grid is None or not len(rows):
+            return rows[:0]
+        ii, _, _ = self._closed_grid.query(points, OCCUPANCY_RADIUS)
+        return rows[np.unique(ii)]
+
+    def occupied(self):
+        """Number of blocks at or over capacity"""
+        return int((self.count >= self.capacity).sum())
+
+    def drain_dirty(self):
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def _refresh(self, b):
+        self.dirty.add(b)
+        self.version += 1
+        track = self.tracks[self.block_ids[b]]
+        occ = self.occupants[b]
+        if b in self.closed:
+            track['status'] = 'maintenance'
+        else:
+            track['status'] = 'occupied' if self.count[b] >= self.capacity[b] else 'free'
+        track['occupancy'] = int(self.count[b])
+        if occ:
+            track['occupied_by'] = next(iter(occ))
+        else:
+            track.pop('occupied_by', None)
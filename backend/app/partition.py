@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import multiprocessing
+from typing import Any, Dict, List
+
+import numpy as np
+
+from .clock import TICK_SECONDS
+from .occupancy import BlockOccupancy
+from .sections import TILE_SIZE, _tile_keys
+from .simulator import DemoSimulator, step_trains
+from .spatial import GridIndex
+from .trainstate import TrainState, status_code
+
+log = logging.getLogger(__name__)
+
+# Neighbour offsets of a tile, itself included
+_NX = np.repeat(np.arange(-1, 2), 3)
+_NY = np.tile(np.arange(-1, 2), 3)
+
+
+def _tiles(points, tile=TILE_SIZE):
+    t = np.floor(np.asarray(points, dtype=np.float64).reshape(-1, 2) / tile).astype(np.int64)
+    return t[:, 0], t[:, 1]
+
+
+def _neighbours(tx, ty):
+    """Keys of the 3x3 tiles around each (tx, ty), shape (9 * n,)"""
+    return _tile_keys((tx[None, :] + _NX[:, None]).ravel(), (ty[None, :] + _NY[:, None]).ravel())
+
+
+class PartitionPlan:
+    """Static split of the network into ``partitions`` groups of sections.
+
+    Sections are ordered west to east and cut into contiguous groups, so
+    most neighbours share a partition. Every tile a section overlaps is
+    owned by that section's partition; trains belong to the partition
+    owning their tile, with trains outside all sections falling to
+    partition 0.
+    """
+
+    def __init__(self, sections, partitions, tile=TILE_SIZE):
+        self.tile = tile
+        ordered = sorted(sections.values(), key=lambda s: (
+            (s['bounds'][0][1] + s['bounds'][1][1]) / 2, (s['bounds'][0][0] + s['bounds'][1][0]) / 2))
+        self.partitions = max(1, min(partitions, len(ordered) or 1))
+        self.section_part: Dict[str, int] = {}
+        owner: Dict[int, int] = {}
+        for p, group in enumerate(np.array_split(np.arange(len(ordered)), self.partitions)):
+            for k in group.tolist():
+                section = ordered[k]
+                self.section_part[section['id']] = p
+                (lat0, lon0), (lat1, lon1) = section['bounds']
+                tx = np.arange(np.floor(lat0 / tile), np.floor(lat1 / tile) + 1, dtype=np.int64)
+                ty = np.arange(np.floor(lon0 / tile), np.floor(lon1 / tile) + 1, dtype=np.int64)
+                for key in _tile_keys(np.repeat(tx, len(ty)), np.tile(ty, len(tx))).tolist():
+                    owner.setdefault(key, p)
+        self.tile_keys = np.array(sorted(owner), dtype=np.int64)
+        self.tile_part = np.array([owner[k] for k in self.tile_keys.tolist()], dtype=np.int64)
+
+    def owners(self, points):
+        """Partition owning each point"""
+        tx, ty = _tiles(points, self.tile)
+        keys = _tile_keys(tx, ty)
+        if not len(self.tile_keys):
+            return np.zeros(len(keys), dtype=np.int64)
+        slot = np.minimum(np.searchsorted(self.tile_keys, keys), len(self.tile_keys) - 1)
+        return np.where(self.tile_keys[slot] == keys, self.tile_part[slot], 0)
+
+    def halo(self, owner, pos, next_pos):
+        """(rows, partitions): foreign trains each partition must see this tick.
+
+        A partition sees every train in a tile next to where one of its
+        own trains is or is heading. Tiles are far larger than the
+        conflict radius, so this covers every interaction.
+        """
+        P = self.partitions
+        tx, ty = _tiles(pos, self.tile)
+        keys = _tile_keys(tx, ty)
+        # Compact ids for the tiles that hold trains
+        tiles, tile_id = np.unique(keys, return_inverse=True)
+        nx, ny = _tiles(next_pos, self.tile)
+        wants_x = np.concatenate([tx, nx])
+        wants_y = np.concatenate([ty, ny])
+        wants_p = np.concatenate([owner, owner])
+        # Deduplicate (tile, partition) before expanding to neighbours
+        base = np.unique(np.stack([wants_x, wants_y, wants_p], axis=1), axis=0)
+        near = _neighbours(base[:, 0], base[:, 1])
+        near_p = np.tile(base[:, 2], 9)
+        slot = np.minimum(np.searchsorted(tiles, near), len(tiles) - 1)
+        hit = tiles[slot] == near
+        codes = np.unique(slot[hit] * P + near_p[hit])
+        # Every train in a wanted tile goes to the wanting partitions
+        lo = np.searchsorted(codes, tile_id * P)
+        hi = np.searchsorted(codes, tile_id * P + P)
+        counts = hi - lo
+        rows = np.repeat(np.arange(len(keys)), counts)
+        start = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        parts = codes[np.arange(len(rows)) + start] % P
+        keep = parts != owner[rows]
+        return rows[keep], parts[keep]
+
+
+def _worker(conn, tracks):
+    """Partition process: steps the trains it is sent and places its own trains on blocks.
+
+    Trains are sent as this partition's own rows followed by the halo,
+    with their rows in the coordinator's state; only own trains move and
+    only they are placed, so each block's occupants are the union of what
+    every partition reports for it.
+    """
+    ts = TrainState()
+    occupancy = BlockOccupancy(tracks)
+    running_code = status_code('running')
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            return
+        for route in msg['routes']:
+            ts.intern_route(route)
+        n = len(msg['idx'])
+        if msg['ids'] is not None:
+            ts.ids = msg['ids']
+            ts.index = {t: row for row, t in enumerate(ts.ids)}
+            ts.meta = [{}] * n
+            ts.structure += 1
+            if len(ts._data['idx']) < n:
+                ts._data = {name: np.zeros(max(1, 2 * n), dtype=arr.dtype) for name, arr in ts._data.items()}
+            ts._n = n
+        for name in ('idx', 'dist', 'speed', 'max_speed', 'delay', 'route'):
+            ts._data[name][:n] = msg[name]
+        running = msg['running']
+        ts._data['status'][:n] = np.where(running, running_code, running_code + 1)
+        ts.touch()
+        own = msg['own']
+        movable = msg['movable']
+        movers = np.flatnonzero(movable[:own])
+        # Halo trains moving in their own partition still settle head-on
+        # blocks with ours, by global row as the single-process tick does
+        observers = own + np.flatnonzero(movable[own:])
+        stalled, _, conflicts = step_trains(ts, GridIndex(ts.positions()), running, movers, msg['dt'],
+                                            observers=observers, rank=msg['rows'])
+        if msg['ids'] is not None:
+            mine = set(ts.ids[:own])
+            for train_id in [t for t in occupancy.placed if t not in mine]:
+                occupancy.remove(train_id)
+        ids, route, idx = ts.ids, ts.route, ts.idx
+        for row in range(own):
+            occupancy.place(ids[row], ts.routes, int(route[row]), int(idx[row]))
+        conn.send({
+            'idx': ts.idx[:own].copy(),
+            'dist': ts.dist[:own].copy(),
+            'speed': ts.speed[:own].copy(),
+            'delay': ts.delay[:own].copy(),
+            'stalled': len(stalled),
+            'conflicts': conflicts,
+            'blocks': {occupancy.block_ids[b]: list(occupancy.occupants[b]) for b in occupancy.drain_dirty()}
+        })
+
+
+class PartitionedSimulator(DemoSimulator):
+    """Simulator whose tick is split across one process per group of sections.
+
+    The coordinator keeps the authoritative TrainState and everything
+    built on it (broadcasts, KPIs, recommendations). Each tick it sends
+    every partition its own trains plus a halo of nearby foreign trains,
+    the partitions move their trains and place them on blocks in
+    parallel, and the results are scattered back and merged per block. Trains change
+    partition simply by being sent to whichever one owns their tile.
+
+    A worker that dies is replaced and the tick retried from the
+    coordinator's state, which nothing has touched yet; if the fresh
+    workers fail too the simulator carries on in a single process.
+    """
+
+    def __init__(self, trains=None, tracks=None, sections=None, partitions=None, autostart=True, **kwargs):
+        super().__init__(trains, tracks, sections, autostart=False, **kwargs)
+        self.requested_partitions = partitions or multiprocessing.cpu_count()
+        self.workers = []
+        self._spawn()
+        if autostart:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    def _spawn(self):
+        """Plan the partitions and start one worker per partition on the current network"""
+        self.plan = PartitionPlan(self.sections, self.requested_partitions)
+        ctx = multiprocessing.get_context('spawn')
+        self.workers = []
+        # block id -> partition -> the occupants that partition reported
+        self._occupants: Dict[str, Dict[int, List[str]]] = {}
+        for p in range(self.plan.partitions):
+            parent, child = ctx.Pipe()
+            tracks = {b: dict(t) for b, t in self.tracks.items()}
+            proc = ctx.Process(target=_worker, args=(child, tracks), name=f'sim-partition-{p}', daemon=True)
+            proc.start()
+            self.workers.append({'conn': parent, 'proc': proc, 'rows': None, 'routes': 0})
+        self._routes_key = None
+
+    def _stop_workers(self):
+        for w in self.workers:
+            try:
+                w['conn'].send(None)
+            except OSError:
+                pass
+            w['proc'].join(timeout=1)
+            if w['proc'].is_alive():
+                w['proc'].terminate()
+        self.workers = []
+
+    def _respawn(self):
+        """Replace every worker; blocks are reported afresh by the new ones"""
+        self._stop_workers()
+        for block_id in self._occupants:
+            self.occupancy.assign(block_id, [])
+        self._spawn()
+
+    def _fall_back(self):
+        """Stop using workers and place every train on the coordinator's own blocks"""
+        self._stop_workers()
+        self.occupancy.reset()
+        self.occupancy.sync(self.trains)
+
+    def load_state(self, trains, tracks=None, sections=None):
+        # Workers hold their own copy of the blocks; start over with fresh ones
+        super().load_state(trains, tracks, sections)
+        self._stop_workers()
+        self._spawn()
+
+    def _step(self, dt=TICK_SECONDS):
+        if not self.workers:
+            return super()._step(dt)
+        ts = self.trains
+        if not len(ts):
+            return
+        pos = ts.positions()
+        next_pos = ts.locate(ts.dist + ts.speed * dt / 3600.0)[1]
+        owner = self.plan.owners(pos)
+        halo_rows, halo_parts = self.plan.halo(owner, pos, next_pos)
+        running = ts.status == status_code('running')
+        movable = np.zeros(len(ts), dtype=bool)
+        movable[self._wait_at_closures(np.flatnonzero(running), dt)] = True
+        try:
+            outs = self._exchange(owner, halo_rows, halo_parts, running, movable, dt)
+        except (EOFError, OSError) as e:
+            log.warning('Partition worker failed (%s: %s); respawning the workers', type(e).__name__, e)
+            self._respawn()
+            try:
+                outs = self._exchange(owner, halo_rows, halo_parts, running, movable, dt)
+            except (EOFError, OSError) as e:
+                log.error('Respawned partition workers failed (%s: %s); continuing in a single process',
+                          type(e).__name__, e)
+                self._fall_back()
+                self._move(np.flatnonzero(movable), dt)
+                return
+
+        stalled = 0
+        conflicts: Dict[str, List[Any]] = {}
+        changed = set()
+        for p, (own, out) in enumerate(outs):
+            ts.idx[own] = out['idx']
+            ts.dist[own] = out['dist']
+            ts.speed[own] = out['speed']
+            ts.delay[own] = out['delay']
+            stalled += out['stalled']
+            conflicts.update(out['conflicts'])
+            for block_id, occupants in out['blocks'].items():
+                parts = self._occupants.setdefault(block_id, {})
+                if occupants:
+                    parts[p] = occupants
+                else:
+                    parts.pop(p, None)
+                changed.add(block_id)
+        for block_id in changed:
+            parts = self._occupants[block_id]
+            self.occupancy.assign(block_id, [t for p in sorted(parts) for t in parts[p]])
+        ts.touch()
+        self._log_conflicts(stalled, conflicts)
+
+    def _exchange(self, owner, halo_rows, halo_parts, running, movable, dt):
+        """Send each worker its trains and collect its results, as (own rows, result) per partition"""
+        ts = self.trains
+        # Routes are only ever appended, unless the whole state was replaced
+        if self._routes_key != id(ts):
+            self._routes_key = id(ts)
+            for w in self.workers:
+                w['routes'] = 0
+                w['rows'] = None
+
+        order = np.argsort(owner, kind='stable')
+        bounds = np.searchsorted(owner[order], np.arange(self.plan.partitions + 1))
+        horder = np.argsort(halo_parts, kind='stable')
+        hbounds = np.searchsorted(halo_parts[horder], np.arange(self.plan.partitions + 1))
+        own_rows = []
+        for p, w in enumerate(self.workers):
+            own = order[bounds[p]:bounds[p + 1]]
+            rows = np.concatenate([own, halo_rows[horder[hbounds[p]:hbounds[p + 1]]]])
+            changed = w['rows'] is None or w['structure'] != ts.structure or not np.array_equal(w['rows'], rows)
+            w['rows'], w['structure'] = rows, ts.structure
+            w['conn'].send({
+                'ids': [ts.ids[r] for r in rows.tolist()] if changed else None,
+                'own': len(own),
+                'routes': ts.routes[w['routes']:],
+                'idx': ts.idx[rows], 'dist': ts.dist[rows], 'speed': ts.speed[rows], 'max_speed': ts.max_speed[rows],
+                'delay': ts.delay[rows], 'route': ts.route[rows], 'running': running[rows], 'movable': movable[rows],
+                'rows': rows, 'dt': dt
+            })
+            w['routes'] = len(ts.routes)
+            own_rows.append(own)
+
+        # Gather every result before applying any, so a failed worker leaves the state untouched
+        return [(own, w['conn'].recv()) for own, w in zip(own_rows, self.workers)]
+
+    def close(self):
+        self._stop_workers()
+        super().close()
+
+
+def make_simulator(partitions=1, **kwargs):
+    """A PartitionedSimulator when more than one partition is asked for, else a plain DemoSimulator"""
+    if partitions > 1:
+        return PartitionedSimulator(partitions=partitions, **kwargs)
+    return DemoSimulator(**kwargs)
@@ -0,0 +1,176 @@
+from typing import List, Optional
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+# Gap between routes on the shared distance axis, so one search never
+# lands a train on the next route
+_ROUTE_GAP_KM = 1.0
+
+
+def segment_lengths(points):
+    """Great-circle length in km of each segment of an (n, 2) [lat, lon] polyline"""
+    p = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+    lat0, lon0, lat1, lon1 = p[:-1, 0], p[:-1, 1], p[1:, 0], p[1:, 1]
+    a = np.sin((lat1 - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat1) * np.sin((lon1 - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def bearings(points):
+    """Initial compass bearing in degrees of each segment of a polyline"""
+    p = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+    lat0, lon0, lat1, lon1 = p[:-1, 0], p[:-1, 1], p[1:, 0], p[1:, 1]
+    y = np.sin(lon1 - lon0) * np.cos(lat1)
+    x = np.cos(lat0) * np.sin(lat1) - np.sin(lat0) * np.cos(lat1) * np.cos(lon1 - lon0)
+    return np.degrees(np.arctan2(y, x)) % 360.0
+
+
+class RouteGeometry:
+    """Interned routes compiled once into flat arrays for motion along them.
+
+    Each route is stored as its waypoints plus the cumulative distance to
+    every waypoint and the length and bearing of the segment starting
+    there. Routes are appended in interning order and laid end to end on
+    one distance axis, so locating any number of trains on any routes is
+    a single binary search over the cumulative distances.
+    """
+
+    def __init__(self):
+        self.points: List[np.ndarray] = []
+        self.cum: List[np.ndarray] = []
+        self.bearing: List[np.ndarray] = []
+        self._flat = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, route):
+        """Compile one route; returns its id"""
+        pts = np.asarray(route, dtype=np.float64).reshape(-1, 2)
+        lengths = segment_lengths(pts)
+        cum = np.zeros(len(pts))
+        np.cumsum(lengths, out=cum[1:])
+        bearing = np.zeros(len(pts))
+        if len(pts) > 1:
+            bearing[:-1] = bearings(pts)
+            bearing[-1] = bearing[-2]
+        self.points.append(pts)
+        self.cum.append(cum)
+        self.bearing.append(bearing)
+        self._flat = None
+        return len(self.points) - 1
+
+    @classmethod
+    def from_flat(cls, pts, lens):
+        """Compile many routes at once from their concatenated waypoints and lengths"""
+        geo = cls()
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+        lens = np.asarray(lens, dtype=np.int64)
+        if not len(lens):
+            return geo
+        starts = np.zeros(len(lens), dtype=np.int64)
+        np.cumsum(lens[:-1], out=starts[1:])
+        # Per-waypoint length and bearing of the segment starting there;
+        # segments running from one route into the next are zeroed
+        seg = np.zeros(len(pts))
+        bearing = np.zeros(len(pts))
+        if len(pts) > 1:
+            seg[:-1] = segment_lengths(pts)
+            bearing[:-1] = bearings(pts)
+        ends = starts + lens - 1
+        seg[ends[lens > 0]] = 0.0
+        bearing[ends[lens == 1]] = 0.0
+        bearing[ends[lens > 1]] = bearing[ends[lens > 1] - 1]
+        cum = np.zeros(len(pts))
+        np.cumsum(seg[:-1], out=cum[1:])
+        cum -= np.repeat(cum[np.minimum(starts, max(len(pts) - 1, 0))], lens)
+        cuts = starts[1:]
+        geo.points = np.split(pts, cuts)
+        geo.cum = np.split(cum, cuts)
+        geo.bearing = np.split(bearing, cuts)
+        return geo
+
+    @classmethod
+    def from_routes(cls, routes):
+        """Compile a list of routes ([[lat, lon], ...] each) in one pass"""
+        lens = [len(r) for r in routes]
+        pts = np.array([p for r in routes for p in r], dtype=np.float64).reshape(-1, 2)
+        return cls.from_flat(pts, lens)
+
+    def copy(self):
+        """Independent geometry sharing the compiled per-route arrays"""
+        twin = RouteGeometry()
+        twin.points, twin.cum, twin.bearing = list(self.points), list(self.cum), list(self.bearing)
+        twin._flat = self._flat
+        return twin
+
+    def flat(self):
+        """Concatenated arrays over every route, rebuilt only after new routes.
+
+        pts (N, 2), offs/lens/total/base per route, and per waypoint the
+        cumulative km on the shared axis ('axis') and the bearing.
+        """
+        if self._flat is None:
+            lens = np.array([len(p) for p in self.points], dtype=np.int64)
+            offs = np.zeros(len(lens), dtype=np.int64)
+            np.cumsum(lens[:-1], out=offs[1:])
+            total = np.array([c[-1] if len(c) else 0.0 for c in self.cum])
+            base = np.zeros(len(lens))
+            np.cumsum(total[:-1] + _ROUTE_GAP_KM, out=base[1:])
+            empty = np.zeros(0)
+            self._flat = {
+                'pts': np.concatenate(self.points) if self.points else np.zeros((0, 2)),
+                'offs': offs, 'lens': lens, 'total': total, 'base': base,
+                'axis': np.concatenate([c + b for c, b in zip(self.cum, base)]) if self.cum else empty,
+                'bearing': np.concatenate(self.bearing) if self.bearing else empty
+            }
+        return self._flat
+
+    def distance_at(self, rid, idx):
+        """Distance along route ``rid`` to waypoint ``idx`` (arrays or scalars)"""
+        f = self.flat()
+        idx = np.clip(idx, 0, np.maximum(f['lens'][rid] - 1, 0))
+        return f['axis'][f['offs'][rid] + idx] - f['base'][rid]
+
+    def locate(self, rid, dist, heading=False):
+        """Waypoint reached and position of trains ``dist`` km along routes ``rid``.
+
+        Returns (idx, points) - idx is the last waypoint passed, points are
+        interpolated along the segment - plus unit direction vectors in
+        [lat, lon] when ``heading`` is set.
+        """
+        f = self.flat()
+        rid = np.asarray(rid, dtype=np.int64)
+        offs, last = f['offs'][rid], f['offs'][rid] + f['lens'][rid] - 1
+        key = f['base'][rid] + np.clip(dist, 0.0, f['total'][rid])
+        k = np.clip(np.searchsorted(f['axis'], key, side='right') - 1, offs, last)
+        seg = np.maximum(np.minimum(k, last - 1), offs)
+        nxt = np.minimum(seg + 1, last)
+        pts, axis = f['pts'], f['axis']
+        span = axis[nxt] - axis[seg]
+        frac = np.clip(np.divide(key - axis[seg], span, out=np.zeros(len(span)), where=span > 0), 0.0, 1.0)
+        delta = pts[nxt] - pts[seg]
+        points = pts[seg] + frac[:, None] * delta
+        if not heading:
+            return k - offs, points
+        norm = np.hypot(delta[:, 0], delta[:, 1])
+        unit = np.divide(delta, norm[:, None], out=np.zeros_like(delta), where=norm[:, None] > 0)
+        return k - offs, points, unit
+
+    def summary(self):
+        """Id, waypoint count and length of every route"""
+        f = self.flat()
+        return [{'id': rid, 'waypoints': int(n), 'length_km': round(float(t), 3)}
+                for rid, (n, t) in enumerate(zip(f['lens'].tolist(), f['total'].tolist()))]
+
+    def describe(self, rid) -> Optional[dict]:
+        """Geometry of one route for clients: waypoints, cumulative km and bearings"""
+        if not 0 <= rid < len(self.points):
+            return None
+        return {
+            'id': rid,
+            'points': self.points[rid].tolist(),
+            'cum_km': np.round(self.cum[rid], 3).tolist(),
+            'bearing': np.round(self.bearing[rid], 1).tolist(),
+            'length_km': round(float(self.cum[rid][-1]), 3) if len(self.cum[rid]) else 0.0
+        }
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from . import headless
+
+log = logging.getLogger(__name__)
+
+# Simulated seconds a scenario worker runs between deadline checks
+CHUNK_SECONDS = 60.0
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def executor():
+    """Shared process pool, one worker per core, created on first use"""
+    global _pool
+    if _pool is None:
+        # spawn: forking a threaded server process is not safe
+        ctx = multiprocessing.get_context('spawn')
+        _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=ctx)
+    return _pool
+
+
+def warm_up():
+    """Start every worker now so the first request doesn't pay process start-up"""
+    pool = executor()
+    for _ in range(pool._max_workers):
+        pool.submit(os.getpid)
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def apply_plan(sim, plan: Dict[str, Any]):
+    """Apply one candidate intervention to a (forked) simulator"""
+    action = plan['action']
+    if action == 'none':
+        return
+    if action == 'schedule':
+        for train_id, seconds in plan['value']:
+            sim.hold(train_id, seconds)
+        return
+    train = sim.trains[plan['train']]
+    if action == 'hold':
+        sim.hold(plan['train'], plan['value'])
+    elif action == 'speed':
+        train['max_speed'] = plan['value']
+        train['speed'] = min(train['speed'], plan['value'])
+    elif action == 'reroute':
+        rid, idx = plan['value']
+        train['route'] = sim.trains.routes[rid]
+        train['idx'] = idx
+    else:
+        raise ValueError(f'unknown plan action {action}')
+
+
+def describe(plan: Dict[str, Any]) -> str:
+    action = plan['action']
+    if action == 'hold':
+        return f"Hold {plan['train']} for {plan['value'] / 60:.0f} min to clear the conflict"
+    if action == 'speed':
+        return f"Limit {plan['train']} to {plan['value']:.0f} km/h"
+    if action == 'reroute':
+        return f"Reroute {plan['train']} via route {plan['value'][0]}"
+    if action == 'schedule':
+        return f"Apply optimized sequence holding {len(plan['value'])} trains"
+    return 'No intervention needed; current plan is best'
+
+
+def reroute_options(sim, train_id):
+    """(route id, waypoint idx) of other routes passing through the train's current waypoint"""
+    ts = sim.trains
+    train = ts[train_id]
+    here = train['route'][train['idx']]
+    own = int(ts.route[ts.index[train_id]])
+    out = []
+    for rid, route in enumerate(ts.routes):
+        if rid == own:
+            continue
+        for idx, point in enumerate(route[:-1]):
+            if point == here:
+                out.append([rid, idx])
+                break
+    return out
+
+
+def candidate_plans(sim, max_conflicts=5, hold_seconds=(60.0, 180.0), rec=None) -> List[Dict[str, Any]]:
+    """The do-nothing baseline plus hold/slow/reroute plans for trains in current conflicts.
+
+    With a recommendation ``rec`` from the optimizer, its joint hold
+    schedule is evaluated as one more plan.
+    """
+    plans: List[Dict[str, Any]] = [{'action': 'none'}]
+    holds = [[a['train'], a['hold_min'] * 60.0] for a in (rec or {}).get('actions', []) if a['action'] == 'hold']
+    if holds:
+        plans.append({'action': 'schedule', 'value': holds})
+    seen = set()
+    for conflict in sim._detect_conflicts()[:max_conflicts]:
+        for train_id in conflict['trains']:
+            if train_id in seen or train_id not in sim.trains:
+                continue
+            seen.add(train_id)
+            for seconds in hold_seconds:
+                plans.append({'action': 'hold', 'train': train_id, 'value': seconds})
+            max_speed = sim.trains[train_id]['max_speed']
+            plans.append({'action': 'speed', 'train': train_id, 'value': max(10.0, max_speed * 0.5)})
+            for option in reroute_options(sim, train_id):
+                plans.append({'action': 'reroute', 'train': train_id, 'value': option})
+    return plans
+
+
+def score(result: Dict[str, Any]) -> float:
+    """Lower is better: accumulated delay, penalised by conflicts, credited for throughput"""
+    return result['total_delay'] + 0.5 * result['conflict_events'] - 5.0 * result['trains_finished']
+
+
+def evaluate(twin, plan, horizon_s, deadline):
+    """Worker entry point: apply ``plan`` and run ``twin`` until the horizon or the deadline"""
+    apply_plan(twin, plan)
+    remaining = horizon_s
+    while remaining > 0 and time.time() < deadline:
+        chunk = min(CHUNK_SECONDS, remaining)
+        twin.run_headless(chunk)
+        remaining -= chunk
+    out = headless.summarize(twin)
+    out['plan'] = plan
+    out['complete'] = remaining <= 0
+    return out
+
+
+async def run_plans(sim, plans, horizon_s, budget_s, seed=None):
+    """Evaluate ``plans`` on forks of ``sim`` across the process pool within ``budget_s``.
+
+    Each plan runs on an identically seeded fork so random events match.
+    Workers stop at the deadline and report partial runs; plans still
+    queued when the budget expires are cancelled and counted in
+    ``timed_out``. Plans whose worker raised are listed in ``errors``.
+    """
+    if seed is None:
+        seed = sim.rng.randrange(2**32)
+    twin = sim.fork(seed)
+    started = time.time()
+    deadline = started + budget_s
+    loop = asyncio.get_running_loop()
+    pool = executor()
+    futures = [loop.run_in_executor(pool, evaluate, twin, plan, horizon_s, deadline) for plan in plans]
+    # Small grace period for workers to return after the cooperative deadline
+    done, pending = await asyncio.wait(futures, timeout=budget_s + 0.25)
+    for f in pending:
+        f.cancel()
+    results, errors = [], []
+    for plan, f in zip(plans, futures):
+        if f in pending:
+            continue
+        error = f.exception()
+        if error is None:
+            results.append(f.result())
+            continue
+        log.error('scenario plan %s failed', plan, exc_info=error)
+        errors.append({'plan': plan, 'error': f'{type(error).__name__}: {error}'})
+    return {
+        'seed': seed,
+        'horizon_s': horizon_s,
+        'results': results,
+        'errors': errors,
+        'evaluated': len(results),
+        'submitted': len(plans),
+        'timed_out': len(pending),
+        'elapsed_ms': round((time.time() - started) * 1000, 1)
+    }
+
+
+def best_plan(run: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Best completed result, falling back to partial runs if none finished"""
+    results = [r for r in run['results'] if r['complete']] or run['results']
+    return min(results, key=score) if results else None
@@ -0,0 +1,119 @@
+import math
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+
+# Tile size (degrees) of the coarse grid used to route trains to subscribers
+TILE_SIZE = 0.5
+# Areas kept built, least recently used dropped first; clients can ask for any bounds
+AREA_CACHE_SIZE = 128
+
+_OFFSET = 1 << 20
+
+
+def _tile_keys(tx, ty):
+    return ((tx + _OFFSET) << 32) | (ty + _OFFSET)
+
+
+def clamp_bounds(bounds):
+    """[[lat_min, lon_min], [lat_max, lon_max]] from two corners, clamped to valid coordinates.
+
+    Raises ValueError unless ``bounds`` is two [lat, lon] pairs of finite numbers.
+    """
+    if not isinstance(bounds, (list, tuple)) or len(bounds) != 2:
+        raise ValueError('bounds must be [[lat, lon], [lat, lon]]')
+    for corner in bounds:
+        if (not isinstance(corner, (list, tuple)) or len(corner) != 2
+                or not all(isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v)
+                           for v in corner)):
+            raise ValueError('bounds must be [[lat, lon], [lat, lon]]')
+    (lat0, lon0), (lat1, lon1) = bounds
+    lat = sorted(min(90.0, max(-90.0, float(v))) for v in (lat0, lat1))
+    lon = sorted(min(180.0, max(-180.0, float(v))) for v in (lon0, lon1))
+    return [[lat[0], lon[0]], [lat[1], lon[1]]]
+
+
+class Area:
+    """A subscribed region: a named section or an ad-hoc lat/lon bounding box"""
+
+    def __init__(self, key, bounds, tiles, blocks):
+        self.key = key
+        self.bounds = bounds
+        self.tiles = tiles
+        self.blocks = blocks
+
+    def contains(self, points):
+        (lat0, lon0), (lat1, lon1) = self.bounds
+        return ((points[:, 0] >= lat0) & (points[:, 0] <= lat1)
+                & (points[:, 1] >= lon0) & (points[:, 1] <= lon1))
+
+
+class SectionIndex:
+    """Coarse tile grid mapping sections and bounding boxes to trains and blocks.
+
+    Trains are bucketed by tile once per state version; an area then
+    collects rows only from the tiles it overlaps, so the cost of serving
+    a subscriber grows with the trains in its area, not the whole network.
+    """
+
+    def __init__(self, sections: Dict[str, Dict[str, Any]], tracks: Dict[str, Dict[str, Any]], tile=TILE_SIZE):
+        self.sections = sections
+        self.tile = tile
+        self.block_ids: List[str] = list(tracks)
+        self._block_ends = np.array(
+            [t['from'] + t['to'] for t in tracks.values()], dtype=np.float64).reshape(-1, 4)
+        self._areas: 'OrderedDict[Any, Area]' = OrderedDict()
+        self._buckets = None
+
+    def area(self, section_id: Optional[str] = None, bounds=None) -> Optional[Area]:
+        """Area for a section id or [[lat_min, lon_min], [lat_max, lon_max]] bounds.
+
+        Bounds are clamped to valid coordinates (see clamp_bounds, which
+        raises ValueError for malformed ones).
+        """
+        if section_id is not None:
+            section = self.sections.get(section_id)
+            if section is None:
+                return None
+            key, bounds = ('section', section_id), section['bounds']
+        else:
+            bounds = clamp_bounds(bounds)
+            key = ('bounds', tuple(bounds[0]), tuple(bounds[1]))
+        area = self._areas.get(key)
+        if area is not None:
+            self._areas.move_to_end(key)
+        else:
+            (lat0, lon0), (lat1, lon1) = bounds
+            tx = np.arange(np.floor(lat0 / self.tile), np.floor(lat1 / self.tile) + 1, dtype=np.int64)
+            ty = np.arange(np.floor(lon0 / self.tile), np.floor(lon1 / self.tile) + 1, dtype=np.int64)
+            tiles = _tile_keys(np.repeat(tx, len(ty)), np.tile(ty, len(tx)))
+            area = Area(key, bounds, tiles, None)
+            ends = self._block_ends
+            inside = area.contains(ends[:, :2]) | area.contains(ends[:, 2:])
+            area.blocks = set(np.flatnonzero(inside).tolist())
+            self._areas[key] = area
+            if len(self._areas) > AREA_CACHE_SIZE:
+                self._areas.popitem(last=False)
+        return area
+
+    def bucket(self, version, positions):
+        """Sort train rows by tile; reused until ``version`` changes"""
+        if self._buckets is None or self._buckets[0] != version:
+            t = np.floor(positions / self.tile).astype(np.int64)
+            keys = _tile_keys(t[:, 0], t[:, 1])
+            order = np.argsort(keys, kind='stable')
+            self._buckets = (version, keys[order], order, positions)
+        return self._buckets
+
+    def rows(self, area: Area, version, positions):
+        """Train rows inside ``area``, in ascending row order"""
+        _, keys, order, positions = self.bucket(version, positions)
+        lo = np.searchsorted(keys, area.tiles, side='left')
+        hi = np.searchsorted(keys, area.tiles, side='right')
+        if not (hi - lo).any():
+            return np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([order[a:b] for a, b in zip(lo.tolist(), hi.tolist()) if b > a])
+        rows = rows[area.contains(positions[rows])]
+        rows.sort()
+        return rows
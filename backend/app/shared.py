@@ -0,0 +1,551 @@
+"""Multi-process serving: one simulator process, many API/WebSocket workers.
+
+The simulator process publishes every tick into a shared-memory double
+buffer (:class:`SnapshotPublisher`) and executes commands sent over a
+local socket (:class:`CommandServer`). Workers run a :class:`SimReplica`,
+which mirrors the published state for reads and fan-out and forwards
+anything that changes state back to the simulator.
+"""
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+import numpy as np
+
+from .clock import SimClock
+from .events import EventScheduler
+from .metrics import PROCESS, lap
+from .occupancy import BlockOccupancy
+from .simulator import TICK_FAMILIES, DemoSimulator
+from .trainstate import STATUS_NAMES, TrainState, status_code
+
+log = logging.getLogger(__name__)
+
+SIM_SHM_NAME = os.getenv("SIM_SHM_NAME", "train-sim")
+SIM_SHM_SIZE = int(os.getenv("SIM_SHM_MB", "32")) << 20
+SIM_SOCKET = os.getenv("SIM_SOCKET", "/tmp/train-sim.sock")
+SIM_AUTHKEY = os.getenv("SIM_AUTHKEY", "dev-secret").encode()
+
+# How often workers look for a new snapshot (wall seconds)
+POLL_INTERVAL = 0.02
+# How long a worker waits for the simulator process to come up
+CONNECT_TIMEOUT = 30.0
+
+# Segment header: magic, version (publish count), active buffer, buffer size
+_HEADER = struct.Struct('<8sQII')
+_MAGIC = b'TSNAP001'
+# Buffer header: seqlock counter (odd while being written), static version,
+# plan version, train count, static, plan and dynamic blob lengths
+_BUFFER = struct.Struct('<QQQIIII')
+# Published columns, widest dtype first so every array stays aligned
+_FIELDS = (('idx', np.int64), ('speed', np.float64), ('max_speed', np.float64),
+           ('delay', np.float64), ('dist', np.float64), ('route', np.int32), ('status', np.int8))
+
+# Simulator methods workers may invoke; everything else is served from the replica
+COMMANDS = ('control_train', 'trigger_event', 'execute_commands', 'accept_recommendation',
+            'request_approval', 'approve_ticket', 'log_audit', 'hold', 'schedule_events',
+            'cancel_event', 'upcoming_events', 'import_network')
+# Read-only simulator methods answered from state only the simulator process keeps
+QUERIES = ('kpi_trends', 'history_page', 'render_metrics')
+
+
+def _dumps(obj):
+    return json.dumps(obj, default=str).encode()
+
+
+def _attach(name):
+    shm = SharedMemory(name=name)
+    # Only the creator may unlink the segment; stop this process's tracker from doing it at exit
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SnapshotPublisher:
+    """Writes the simulator's state into alternating halves of a shared segment.
+
+    Each half carries its own seqlock counter, so a reader can tell when
+    the half it mapped is being rewritten (two publishes later) and retry.
+    Per-train metadata and routes are only re-encoded when the train set
+    changes, and the plan (scheduled events, speed restrictions and
+    closures, which forks start from) only when it does.
+    """
+
+    def __init__(self, sim, name=SIM_SHM_NAME, size=SIM_SHM_SIZE):
+        self.sim = sim
+        try:
+            SharedMemory(name=name).unlink()  # stale segment from a crashed run
+        except FileNotFoundError:
+            pass
+        self.shm = SharedMemory(name=name, create=True, size=size)
+        self.half = (size - _HEADER.size) // 2 // 8 * 8
+        self.version = 0
+        self.active = 1
+        self.static_version = 0
+        self._static_key = None
+        self._static = b''
+        self.plan_version = 0
+        self._plan_key = None
+        self._plan = b''
+        _HEADER.pack_into(self.shm.buf, 0, _MAGIC, 0, 0, self.half)
+
+    def _static_blob(self):
+        ts = self.sim.trains
+        key = (id(ts), ts.structure, self.sim.network_version)
+        if key != self._static_key:
+            self._static_key = key
+            self.static_version += 1
+            self._static = _dumps({
+                'ids': ts.ids, 'meta': ts.meta, 'routes': ts.routes,
+                'tracks': self.sim.tracks, 'sections': self.sim.sections,
+                'network': self.sim.network_version
+            })
+        return self._static
+
+    def _plan_blob(self):
+        sim = self.sim
+        closed = sorted(sim.occupancy.closed)
+        # Events only get new sequence numbers and only ever leave, so the
+        # count and next number change whenever the pending set does;
+        # restrictions start and end through scheduled events
+        key = (id(sim.scheduler), sim.scheduler.next_seq, len(sim.scheduler), sim.network_version, closed)
+        if key != self._plan_key:
+            self._plan_key = key
+            self.plan_version += 1
+            self._plan = _dumps({
+                'scheduler': sim.scheduler.state(),
+                'restrictions': sim.restrictions,
+                'base_max_speed': sim.base_max_speed,
+                'closed': [sim.occupancy.block_ids[b] for b in closed]
+            })
+        return self._plan
+
+    def publish(self, messages=()):
+        sim = self.sim
+        ts = sim.trains
+        n = len(ts)
+        static = self._static_blob()
+        plan = self._plan_blob()
+        dynamic = _dumps({
+            'version': sim.state_version(),
+            'clock': [sim.clock.now, sim.clock.epoch],
+            'status_names': STATUS_NAMES,
+            'metrics': sim.system_metrics,
+            'active_recommendation': sim.active_recommendation,
+            'pending_tickets': {k: t for k, t in sim.pending_tickets.items() if t['status'] == 'PENDING'},
+            'holds': sim.holds,
+            'stats': sim.stats,
+            'messages': list(messages)
+        })
+        size = (_BUFFER.size + sum(n * np.dtype(dt).itemsize for _, dt in _FIELDS)
+                + len(static) + len(plan) + len(dynamic))
+        if size > self.half:
+            raise RuntimeError(f'snapshot of {size} bytes exceeds shared buffer half of {self.half}; raise SIM_SHM_MB')
+        target = 1 - self.active
+        base = _HEADER.size + target * self.half
+        buf = self.shm.buf
+        seq = struct.unpack_from('<Q', buf, base)[0]
+        struct.pack_into('<Q', buf, base, seq + 1)  # odd: being written
+        offset = base + _BUFFER.size
+        for name, dt in _FIELDS:
+            arr = np.frombuffer(buf, dtype=dt, count=n, offset=offset)
+            arr[:] = getattr(ts, name)
+            offset += arr.nbytes
+        buf[offset:offset + len(static)] = static
+        offset += len(static)
+        buf[offset:offset + len(plan)] = plan
+        offset += len(plan)
+        buf[offset:offset + len(dynamic)] = dynamic
+        _BUFFER.pack_into(buf, base, seq + 2, self.static_version, self.plan_version, n,
+                          len(static), len(plan), len(dynamic))
+        self.active = target
+        self.version += 1
+        _HEADER.pack_into(buf, 0, _MAGIC, self.version, target, self.half)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class Snapshot:
+    """One published state; ``columns`` are views into shared memory, valid while :meth:`valid` holds"""
+
+    def __init__(self, buf, base, seq, version, static_version, columns, static, dynamic,
+                 plan_version=None, plan=None):
+        self._buf, self._base, self._seq = buf, base, seq
+        self.version = version
+        self.static_version = static_version
+        self.columns = columns
+        self.static = static
+        self.dynamic = dynamic
+        self.plan_version = plan_version
+        self.plan = plan
+
+    def valid(self):
+        return struct.unpack_from('<Q', self._buf, self._base)[0] == self._seq
+
+
+class SnapshotReader:
+    """Maps the simulator's shared segment read-only and decodes snapshots"""
+
+    def __init__(self, name=SIM_SHM_NAME):
+        self.shm = _attach(name)
+        self._static_version = None
+        self._static = None
+        self._plan_version = None
+        self._plan = None
+
+    def read(self) -> Optional[Snapshot]:
+        """Latest snapshot, or None if nothing was published yet or every attempt raced the writer"""
+        buf = self.shm.buf
+        for _ in range(3):
+            magic, version, active, half = _HEADER.unpack_from(buf, 0)
+            if magic != _MAGIC or version == 0:
+                return None
+            base = _HEADER.size + active * half
+            seq, static_version, plan_version, n, static_len, plan_len, dynamic_len = _BUFFER.unpack_from(buf, base)
+            if seq % 2:
+                continue
+            offset = base + _BUFFER.size
+            columns = {}
+            for name, dt in _FIELDS:
+                columns[name] = np.frombuffer(buf, dtype=dt, count=n, offset=offset)
+                offset += columns[name].nbytes
+            static = self._static
+            if static_version != self._static_version:
+                static = json.loads(bytes(buf[offset:offset + static_len]))
+            offset += static_len
+            plan = self._plan
+            if plan_version != self._plan_version:
+                plan = json.loads(bytes(buf[offset:offset + plan_len]))
+            offset += plan_len
+            dynamic = json.loads(bytes(buf[offset:offset + dynamic_len]))
+            snap = Snapshot(buf, base, seq, version, static_version, columns, static, dynamic, plan_version, plan)
+            if snap.valid():
+                self._static_version, self._static = static_version, static
+                self._plan_version, self._plan = plan_version, plan
+                return snap
+        return None
+
+    def close(self):
+        self.shm.close()
+
+
+class CommandServer:
+    """Runs worker commands on the simulator's event loop, one thread per connection"""
+
+    def __init__(self, sim, address=SIM_SOCKET, authkey=SIM_AUTHKEY, on_change=None):
+        self.sim = sim
+        self.address = address
+        self.authkey = authkey
+        self.on_change = on_change
+        self.loop = asyncio.get_running_loop()
+        if os.path.exists(address):
+            os.unlink(address)
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        self.thread = threading.Thread(target=self._accept, name='sim-commands', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return  # listener closed
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                future = asyncio.run_coroutine_threadsafe(self._execute(method, args, kwargs), self.loop)
+                try:
+                    conn.send(('ok', future.result()))
+                except Exception as e:
+                    conn.send(('error', f'{type(e).__name__}: {e}'))
+
+    async def _execute(self, method, args, kwargs):
+        if method == 'audit_query':
+            return self.sim.audit.query(*args, **kwargs)
+        if method in QUERIES:
+            return getattr(self.sim, method)(*args, **kwargs)
+        if method not in COMMANDS:
+            raise ValueError(f'unknown command {method}')
+        result = getattr(self.sim, method)(*args, **kwargs)
+        if asyncio.iscoroutine(result):
+            result = await result
+        if self.on_change is not None:
+            self.on_change()
+        return result
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class CommandClient:
+    """Blocking request/response channel to the simulator process"""
+
+    def __init__(self, address=SIM_SOCKET, authkey=SIM_AUTHKEY):
+        self.address = address
+        self.authkey = authkey
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        with self.lock:
+            if self.conn is None:
+                self.conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            try:
+                self.conn.send((method, args, kwargs))
+                status, result = self.conn.recv()
+            except (EOFError, OSError):
+                self.conn = None
+                raise
+        if status == 'error':
+            raise RuntimeError(result)
+        return result
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class RemoteAudit:
+    """Audit log facade for workers; queries run against the simulator's log"""
+
+    def __init__(self, commands):
+        self.commands = commands
+
+    def query(self, **kwargs):
+        return self.commands.call('audit_query', **kwargs)
+
+    def close(self):
+        pass
+
+
+class SimReplica(DemoSimulator):
+    """Read-only mirror of the simulator process inside an API/WebSocket worker.
+
+    Polls the shared snapshot, loads it into a local TrainState (one copy
+    per column per tick) and broadcasts frames to this worker's own
+    clients. Reads (KPIs, conflicts, status, optimizer runs on forks) are
+    computed locally; methods that change state are forwarded.
+    """
+
+    def __init__(self, reader: SnapshotReader, commands: CommandClient, autostart=True):
+        self.reader = reader
+        self.commands = commands
+        snap = reader.read()
+        if snap is None:
+            raise RuntimeError('simulator process has not published a snapshot yet')
+        now, epoch = snap.dynamic['clock']
+        tracks = {k: dict(t) for k, t in snap.static['tracks'].items()}
+        super().__init__(TrainState(), tracks, snap.static['sections'],
+                         clock=SimClock(start=now, epoch=epoch), autostart=False)
+        self.audit = RemoteAudit(commands)
+        # Audit entries are sent in order by one thread on a connection of its own
+        self._audit_pool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='replica-audit')
+        self._audit_client = CommandClient(commands.address, commands.authkey)
+        self.snapshot_version = None
+        self._static_version = None
+        self._plan_version = None
+        self._network_version = snap.static['network']
+        self._apply(snap)
+        if autostart:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    @classmethod
+    def connect(cls, name=SIM_SHM_NAME, address=SIM_SOCKET, timeout=CONNECT_TIMEOUT):
+        """Attach to a running simulator process, waiting up to ``timeout`` for it to start"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                reader = SnapshotReader(name)
+                if reader.read() is not None:
+                    # Built at import time; the server's lifespan starts it with sim.start()
+                    return cls(reader, CommandClient(address), autostart=False)
+                reader.close()
+            except FileNotFoundError:
+                pass
+            if time.time() >= deadline:
+                raise RuntimeError(f'no simulator snapshot at {name!r}; start it with python -m app.sim_server')
+            time.sleep(0.2)
+
+    def _apply(self, snap: Snapshot):
+        ts = self.trains
+        dyn = snap.dynamic
+        lut = np.array([status_code(name) for name in dyn['status_names']], dtype=np.int8)
+        columns = {name: arr.copy() for name, arr in snap.columns.items()}
+        if not snap.valid():
+            return False  # overwritten while copying; pick up the next one
+        columns['status'] = lut[columns['status']]
+        rebuilt = snap.static_version != self._static_version
+        if rebuilt:
+            ts.load(snap.static['ids'], snap.static['meta'], snap.static['routes'], columns)
+            self._static_version = snap.static_version
+            if snap.static['network'] != self._network_version:
+                # A new network was loaded: take its blocks and sections too
+                self._network_version = snap.static['network']
+                tracks = {k: dict(t) for k, t in snap.static['tracks'].items()}
+                self.load_state(ts, tracks, snap.static['sections'])
+            else:
+                # Route ids may have been renumbered; start occupancy over
+                self.occupancy = BlockOccupancy(self.tracks)
+                self.occupancy.sync(ts)
+        else:
+            moved = np.flatnonzero(ts.idx != columns['idx'])
+            for name, arr in columns.items():
+                ts._data[name][:len(ts)] = arr
+            ts.touch()
+            self.occupancy.sync(ts, moved.tolist())
+        if rebuilt or snap.plan_version != self._plan_version:
+            self._apply_plan(snap.plan)
+            self._plan_version = snap.plan_version
+        self.clock.now, self.clock.epoch = dyn['clock']
+        self.system_metrics = dyn['metrics']
+        self.active_recommendation = dyn['active_recommendation']
+        self.pending_tickets = dyn['pending_tickets']
+        self.holds = dyn['holds']
+        self.stats = dyn['stats']
+        # Share the simulator's version so ETags agree across workers
+        self.version = dyn['version']
+        self._memo.clear()
+        self.snapshot_version = snap.version
+        return True
+
+    def _apply_plan(self, plan):
+        # Mirrored so forks taken here (what-if runs) see the same future as the simulator's
+        self.scheduler = EventScheduler.from_state(plan['scheduler'])
+        self.restrictions = plan['restrictions']
+        self.base_max_speed = plan['base_max_speed']
+        closed = set(plan['closed'])
+        for b in list(self.occupancy.closed):
+            block_id = self.occupancy.block_ids[b]
+            if block_id not in closed:
+                self.occupancy.close(block_id, closed=False)
+        for block_id in closed:
+            if self.occupancy.block_index.get(block_id) not in self.occupancy.closed:
+                self.occupancy.close(block_id)
+
+    def sync(self):
+        """Apply a newer snapshot if there is one; returns its tick messages, or None"""
+        snap = self.reader.read()
+        if snap is None or snap.version == self.snapshot_version:
+            return None
+        if not self._apply(snap):
+            return None
+        return snap.dynamic['messages']
+
+    def state_version(self):
+        return self.version
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            messages = self.sync()
+            if messages is None:
+                continue
+            t = time.perf_counter()
+            await self.broadcast_state()
+            for msg in messages:
+                await self.broadcast(msg)
+            lap(self._broadcast_seconds.labels(), t)
+
+    def advance(self, dt=None):
+        raise RuntimeError('replicas do not advance; the simulator process owns the clock')
+
+    def close(self):
+        self._audit_pool.submit(self._audit_client.close)
+        self._audit_pool.shutdown(wait=True)
+        self.commands.close()
+        self.reader.close()
+
+    # -- forwarded to the simulator process -------------------------------
+    def control_train(self, train_id, action, value=None):
+        return self.commands.call('control_train', train_id, action, value)
+
+    def trigger_event(self, event_type, data=None):
+        return self.commands.call('trigger_event', event_type, data)
+
+    async def _call_off_loop(self, method, *args):
+        # Wait off the event loop, on a connection of its own so other calls aren't held up
+        def call():
+            client = CommandClient(self.commands.address, self.commands.authkey)
+            try:
+                return client.call(method, *args)
+            finally:
+                client.close()
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
+    async def execute_commands(self, commands):
+        # Answered only after the simulator's next tick
+        return await self._call_off_loop('execute_commands', commands)
+
+    async def import_network(self, path):
+        # Loading takes seconds
+        return await self._call_off_loop('import_network', path)
+
+    def schedule_events(self, events):
+        return self.commands.call('schedule_events', events)
+
+    def cancel_event(self, event_id):
+        return self.commands.call('cancel_event', event_id)
+
+    def upcoming_events(self, limit=50, event_type=None, until=None):
+        return self.commands.call('upcoming_events', limit, event_type, until)
+
+    async def accept_recommendation(self, rec_id, user='controller'):
+        return await self._call_off_loop('accept_recommendation', rec_id, user)
+
+    def request_approval(self, payload):
+        return self.commands.call('request_approval', payload)
+
+    def approve_ticket(self, ticket_id, approved=True, comment=""):
+        return self.commands.call('approve_ticket', ticket_id, approved, comment)
+
+    def log_audit(self, action, payload):
+        # Also called from inside synchronous reads (generate_recommendation),
+        # so the entry is sent in the background and not returned
+        future = self._audit_pool.submit(self._audit_client.call, 'log_audit', action, payload)
+        future.add_done_callback(self._audit_sent)
+        return None
+
+    @staticmethod
+    def _audit_sent(future):
+        error = future.exception()
+        if error is not None:
+            log.error('Forwarding an audit entry failed', exc_info=error)
+
+    def hold(self, train_id, seconds):
+        return self.commands.call('hold', train_id, seconds)
+
+    async def kpi_trends(self, since=None, until=None, points=200):
+        return await self._call_off_loop('kpi_trends', since, until, points)
+
+    def history_page(self, since, until=None, gap=0.0, limit=100):
+        return self.commands.call('history_page', since, until, gap, limit)
+
+    async def render_metrics(self, include=None):
+        # Tick timings come from the simulator process; client and broadcast families are this worker's
+        if include is None:
+            return (await self._call_off_loop('render_metrics', TICK_FAMILIES)
+                    + self.metrics.render(exclude=TICK_FAMILIES) + PROCESS.render())
+        remote = [name for name in include if name in TICK_FAMILIES]
+        text = await self._call_off_loop('render_metrics', remote) if remote else ''
+        return text + self.metrics.render([name for name in include if name not in TICK_FAMILIES])
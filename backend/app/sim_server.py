@@ -0,0 +1,60 @@
+"""Authoritative simulator process for multi-worker serving.
+
+Run ``python -m app.sim_server`` next to ``SIM_MODE=worker uvicorn
+app.main:app --workers N``; see :mod:`app.shared`.
+"""
+import asyncio
+import os
+import signal
+
+from .checkpoint import Checkpointer, restore_latest
+from .network import load as read_network
+from .shared import CommandServer, SnapshotPublisher
+from .partition import make_simulator
+
+AUDIT_LOG_PATH = os.getenv("AUDIT_LOG_PATH", "audit.jsonl")
+# Where tick history spills once over its memory budget; empty for a temp dir
+HISTORY_DIR = os.getenv("HISTORY_DIR", "")
+# Processes to split the simulation tick across (see app.partition)
+SIM_PARTITIONS = int(os.getenv("SIM_PARTITIONS", "1"))
+# Periodic state checkpoints, restored on startup; empty disables them
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+# Network to load on startup when there is no checkpoint (see app.network); empty for the demo
+NETWORK_PATH = os.getenv("NETWORK_PATH", "")
+
+
+async def serve():
+    sim = make_simulator(SIM_PARTITIONS, audit_path=AUDIT_LOG_PATH or None, history_dir=HISTORY_DIR or None,
+                         autostart=False)
+    checkpointer = None
+    restored = restore_latest(sim, CHECKPOINT_DIR) if CHECKPOINT_DIR else None
+    if restored is None and NETWORK_PATH:
+        sim.load_network(read_network(NETWORK_PATH))
+    if CHECKPOINT_DIR:
+        checkpointer = Checkpointer(sim, CHECKPOINT_DIR)
+        sim.tick_hooks.append(checkpointer)
+    publisher = SnapshotPublisher(sim)
+    sim.tick_hooks.append(publisher.publish)
+    publisher.publish()
+    sim.start()
+    server = CommandServer(sim, on_change=publisher.publish)
+    server.start()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        publisher.close()
+        if checkpointer is not None:
+            checkpointer.close()
+        sim.close()
+
+
+def main():
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,198 +1,1106 @@
 import asyncio
-import json
+import concurrent.futures
+import copy
+import logging
+import math
 import time
 import uuid
 import random
 from typing import Dict, Any
 
-class ClientWrapper:
-    def __init__(self, ws):
-        self.ws = ws
-    async def send_json(self, msg: Dict[str, Any]):
-        await self.ws.send_text(json.dumps(msg))
+import numpy as np
 
-class DemoSimulator:
-    def __init__(self):
-        # Enhanced train system with more realistic data
-        self.trains: Dict[str, Dict[str, Any]] = {
-            'T1': {
-                'id': 'T1', 'label': 'Express 101', 'type': 'passenger',
-                'route': [[20.0,74.5],[20.0,75.0],[20.0,75.5],[20.0,76.0]], 
-                'idx': 0, 'speed': 60, 'max_speed': 80, 'priority': 'high',
-                'passengers': 450, 'status': 'running', 'delay': 0
-            },
-            'T2': {
-                'id': 'T2', 'label': 'Freight 202', 'type': 'freight',
-                'route': [[19.8,75.5],[20.0,75.0],[20.2,74.5],[20.4,74.0]], 
-                'idx': 0, 'speed': 50, 'max_speed': 60, 'priority': 'medium',
-                'cargo': 'containers', 'status': 'running', 'delay': 0
-            },
-            'T3': {
-                'id': 'T3', 'label': 'Local 303', 'type': 'passenger',
-                'route': [[20.1,74.0],[20.0,74.5],[20.0,75.0],[20.0,75.5]], 
-                'idx': 0, 'speed': 45, 'max_speed': 70, 'priority': 'low',
-                'passengers': 120, 'status': 'running', 'delay': 0
-            }
-        }
-        
-        # Dynamic track system
-        self.tracks = {
-            'B1': {'id': 'B1', 'from': [20.0, 74.5], 'to': [20.0, 75.0], 'status': 'free', 'capacity': 1, 'speed_limit': 80},
-            'B2': {'id': 'B2', 'from': [20.0, 75.0], 'to': [20.0, 75.5], 'status': 'free', 'capacity': 1, 'speed_limit': 80},
-            'B3': {'id': 'B3', 'from': [20.0, 75.5], 'to': [20.0, 76.0], 'status': 'free', 'capacity': 1, 'speed_limit': 80},
-            'B4': {'id': 'B4', 'from': [19.8, 75.5], 'to': [20.0, 75.0], 'status': 'free', 'capacity': 1, 'speed_limit': 60},
-            'B5': {'id': 'B5', 'from': [20.0, 75.0], 'to': [20.2, 74.5], 'status': 'free', 'capacity': 1, 'speed_limit': 60}
+from .audit import AuditLog
+from .broadcast import ClientWrapper, FrameBuilder
+from .commands import CommandQueue, EVENT_ACTIONS, TRAIN_ACTIONS, train_fields
+from .events import DISPATCH_LIMIT, EventScheduler, event_spec
+from .forecast import FORECAST_HORIZON_S, HEADWAY, IMMINENT_S, Forecaster
+from .history import HistoryStore
+from .metrics import PROCESS, Registry, lap
+from .network import NetworkError, block_adjacency, load as read_network
+from .clock import SimClock, TICK_SECONDS
+from .occupancy import BlockOccupancy
+from .optimizer import Optimizer
+from .sections import SectionIndex
+from .spatial import GridIndex
+from .trainstate import TrainState, status_code
+from .wire import Frame, PACKED, available_formats
+
+log = logging.getLogger(__name__)
+
+# Simulated seconds between system metric refreshes
+METRICS_INTERVAL = 2.0
+
+# Tick phases timed by sim_tick_phase_seconds, in the order a live tick runs them
+TICK_PHASES = ('commands', 'events', 'step', 'conflicts', 'recommendation', 'metrics', 'random_events',
+               'forecast', 'history', 'hooks')
+# Attributes set by DemoSimulator._init_metrics, left out when pickling
+_METRIC_ATTRS = ('metrics', '_tick_seconds', '_phases', '_drift', '_lag', '_broadcast_seconds', '_send_seconds',
+                 '_dropped_total')
+# Background forecast thread and its pending job, never pickled
+_FORECAST_ATTRS = ('_forecast_pool', '_forecast_job')
+# Families only the process running the tick loop can fill (see SimReplica.render_metrics)
+TICK_FAMILIES = ('sim_tick_seconds', 'sim_tick_phase_seconds', 'sim_tick_drift_seconds', 'sim_clock_lag_seconds',
+                 'sim_ticks_total', 'sim_command_queue_depth', 'sim_scheduled_events', 'sim_audit_write_backlog',
+                 'sim_audit_dropped_total')
+# Simulated seconds between forecast broadcasts
+FORECAST_INTERVAL = 5.0
+# Forecast conflicts sent per broadcast
+FORECAST_TOP = 50
+# Random 'new_train' events stop adding trains beyond this many
+RANDOM_TRAIN_LIMIT = 50
+
+
+def demo_network():
+    """Fresh copies of the built-in demo trains, tracks and sections"""
+    # Enhanced train system with more realistic data
+    trains = {
+        'T1': {
+            'id': 'T1', 'label': 'Express 101', 'type': 'passenger',
+            'route': [[20.0,74.5],[20.0,75.0],[20.0,75.5],[20.0,76.0]], 
+            'idx': 0, 'speed': 60, 'max_speed': 80, 'priority': 'high',
+            'passengers': 450, 'status': 'running', 'delay': 0
+        },
+        'T2': {
+            'id': 'T2', 'label': 'Freight 202', 'type': 'freight',
+            'route': [[19.8,75.5],[20.0,75.0],[20.2,74.5],[20.4,74.0]], 
+            'idx': 0, 'speed': 50, 'max_speed': 60, 'priority': 'medium',
+            'cargo': 'containers', 'status': 'running', 'delay': 0
+        },
+        'T3': {
+            'id': 'T3', 'label': 'Local 303', 'type': 'passenger',
+            'route': [[20.1,74.0],[20.0,74.5],[20.0,75.0],[20.0,75.5]], 
+            'idx': 0, 'speed': 45, 'max_speed': 70, 'priority': 'low',
+            'passengers': 120, 'status': 'running', 'delay': 0
         }
+    }
+    
+    # Dynamic track system
+    tracks = {
+        'B1': {'id': 'B1', 'from': [20.0, 74.5], 'to': [20.0, 75.0], 'status': 'free', 'capacity': 1, 'speed_limit': 80},
+        'B2': {'id': 'B2', 'from': [20.0, 75.0], 'to': [20.0, 75.5], 'status': 'free', 'capacity': 1, 'speed_limit': 80},
+        'B3': {'id': 'B3', 'from': [20.0, 75.5], 'to': [20.0, 76.0], 'status': 'free', 'capacity': 1, 'speed_limit': 80},
+        'B4': {'id': 'B4', 'from': [19.8, 75.5], 'to': [20.0, 75.0], 'status': 'free', 'capacity': 1, 'speed_limit': 60},
+        'B5': {'id': 'B5', 'from': [20.0, 75.0], 'to': [20.2, 74.5], 'status': 'free', 'capacity': 1, 'speed_limit': 60}
+    }
+
+    # Dispatcher sections; clients may subscribe to one of these or to a bounding box
+    sections = {
+        'S1': {'id': 'S1', 'name': 'Western corridor', 'bounds': [[19.5, 73.5], [20.5, 75.0]]},
+        'S2': {'id': 'S2', 'name': 'Eastern corridor', 'bounds': [[19.5, 75.0], [20.5, 76.5]]}
+    }
+    return trains, tracks, sections
+
+
+def step_trains(ts, grid, running, movers, dt=TICK_SECONDS, observers=None, rank=None):
+    """Move trains ``movers`` ``speed * dt`` along their routes, or stall them behind a running train.
+
+    ``grid`` indexes the current positions and ``running`` flags the
+    trains that count as obstacles; only obstacles ahead in the direction
+    of travel stall a train, and of two trains blocking each other the
+    one with the lower ``rank`` (default: row) goes first. ``observers``
+    are rows moving elsewhere (another partition's trains): they take
+    part in that tie-break but are not moved. Returns the stalled rows,
+    the rows that passed a waypoint and the conflicts per stalled train id.
+    """
+    total = ts.route_totals()
+    movers = movers[ts.dist[movers] < total[movers]]
+    query = movers
+    if observers is not None:
+        observers = observers[ts.dist[observers] < total[observers]]
+        query = np.concatenate([movers, observers])
+    want = np.minimum(ts.dist + ts.speed * dt / 3600.0, total)
+    _, next_pos, heading = ts.locate(want, heading=True)
+
+    # Check where each train would get to against where the others are now
+    ii, jj, dist = grid.query(next_pos[query], HEADWAY)
+    ii = query[ii]
+    pos = grid.points
+    ahead = ((pos[jj] - pos[ii]) * heading[ii]).sum(axis=1) > 0
+    keep = running[jj] & (ii != jj) & ahead
+    ii, jj, dist = ii[keep], jj[keep], dist[keep]
+    mutual = np.isin(jj * len(ts) + ii, ii * len(ts) + jj)
+    if rank is None:
+        keep = ~mutual | (ii > jj)
+    else:
+        keep = ~mutual | (rank[ii] > rank[jj])
+    if observers is not None:
+        is_mover = np.zeros(len(ts), dtype=bool)
+        is_mover[movers] = True
+        keep &= is_mover[ii]
+    ii, jj, dist = ii[keep], jj[keep], dist[keep]
+    blocked = np.zeros(len(ts), dtype=bool)
+    blocked[ii] = True
+    stalled = movers[blocked[movers]]
+    moving = movers[~blocked[movers]]
+
+    # Conflict ahead - slow down and accumulate delay
+    ts.speed[stalled] = np.maximum(10, ts.speed[stalled] * 0.5)
+    ts.delay[stalled] += dt / 60.0
+    # Normal movement; delay is made up at half the rate it accrues
+    ts.dist[moving] = want[moving]
+    idx = ts.geometry.locate(ts.route[moving], want[moving])[0]
+    advanced = moving[idx != ts.idx[moving]]
+    ts.idx[moving] = idx
+    ts.speed[moving] = np.minimum(ts.max_speed[moving], ts.speed[moving] + 5)
+    ts.delay[moving] = np.maximum(0, ts.delay[moving] - 0.5 * dt / 60.0)
+    ts.touch()
+
+    conflicts: Dict[str, list] = {}
+    for a, b, d in zip(ii.tolist(), jj.tolist(), dist.tolist()):
+        conflicts.setdefault(ts.ids[a], []).append({
+            'train': ts.ids[b],
+            'distance': d,
+            'severity': 'high' if d < 0.02 else 'medium'
+        })
+    return stalled, advanced, conflicts
+
+
+class DemoSimulator:
+    def __init__(self, trains=None, tracks=None, sections=None, seed=None, clock=None, autostart=True, audit_path=None,
+                 history_dir=None):
+        demo_trains, demo_tracks, demo_sections = demo_network()
+        if trains is None:
+            trains = demo_trains
+        self.trains = trains if isinstance(trains, TrainState) else TrainState(trains)
+        self.tracks = demo_tracks if tracks is None else tracks
+        self.sections = demo_sections if sections is None else sections
+        # Seeded RNG and simulated clock make headless runs reproducible
+        self.rng = random.Random(seed)
+        self.clock = clock or SimClock()
+        self.occupancy = BlockOccupancy(self.tracks)
+        self.occupancy.sync(self.trains)
+        self.section_index = SectionIndex(self.sections, self.tracks)
+        # Blocks sharing an endpoint, CSR over occupancy.block_ids; built on first use
+        self.adjacency = None
+        # Bumped whenever tracks or sections are replaced
+        self.network_version = 0
         
         self.clients = set()
-        self.audit = []
+        # One frame builder per subscribed area; None is the whole network
+        self.views: Dict[Any, FrameBuilder] = {None: FrameBuilder()}
+        self._id_frame = None
+        # Bounded in memory; persisted to ``audit_path`` when given
+        self.audit = AuditLog(path=audit_path)
+        # Per-tick train states and metrics; spills to ``history_dir`` (None: a temp dir)
+        self.history = HistoryStore(history_dir)
         self.active_recommendation = None
+        self.optimizer = Optimizer()
+        self.forecaster = Forecaster()
         self.pending_tickets: Dict[str, Any] = {}
+        # Control commands applied together at the start of the next tick
+        self.command_queue = CommandQueue()
+        # Disruptions and commands scheduled for later simulated times
+        self.scheduler = EventScheduler()
+        # Active speed restrictions by event id, and the unrestricted max_speed they cap
+        self.restrictions: Dict[str, Any] = {}
+        self.base_max_speed: Dict[str, float] = {}
+        # Spatial index and conflict lists, valid for one TrainState version
+        self._conflict_cache: Dict[str, Any] = {}
+        # Readable-state version (ETags) and results memoized for it
+        self.version = 0
+        self._version_key = None
+        self._memo: Dict[Any, Any] = {}
         self.system_metrics = {
             'total_trains': len(self.trains),
             'active_conflicts': 0,
             'system_load': 0.0,
             'efficiency_score': 1.0
         }
+        # Trains held until a simulated time: train id -> release time
+        self.holds: Dict[str, float] = {}
+        self.stats = {'ticks': 0, 'conflict_events': 0}
+        self._next_metrics = self.clock.now + METRICS_INTERVAL
+        # None turns periodic forecasts off (headless what-if forks)
+        self.forecast_interval = FORECAST_INTERVAL
+        self._next_forecast = self.clock.now + FORECAST_INTERVAL
+        # The live loop projects periodic forecasts on a snapshot in a
+        # background thread, publishing each on the tick after it finishes;
+        # headless runs forecast inline so they stay deterministic
+        self.forecast_in_background = False
+        self._forecast_pool = None
+        self._forecast_job = None
+        self._next_event = self.clock.now + self.rng.uniform(10, 30)
+        
+        # Called with each tick's messages, e.g. to publish shared snapshots
+        self.tick_hooks: list = []
+        self._task = None
+        self._init_metrics()
         
         # Start real-time simulation
-        loop = asyncio.get_event_loop()
-        loop.create_task(self._tick())
-        loop.create_task(self._update_metrics())
-        loop.create_task(self._generate_events())
+        if autostart:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    def __getstate__(self):
+        # Forks are pickled to scenario workers; metrics hold scrape-time
+        # callables and only describe this process, so each copy starts its own
+        state = self.__dict__.copy()
+        for name in _METRIC_ATTRS + _FORECAST_ATTRS:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._forecast_pool = self._forecast_job = None
+        self._init_metrics()
+
+    def _init_metrics(self):
+        # Hot-path timings and queue depths, rendered by render_metrics()
+        m = self.metrics = Registry()
+        self._tick_seconds = m.histogram('sim_tick_seconds', 'Wall time of one simulation tick (advance)')
+        phases = m.histogram('sim_tick_phase_seconds', 'Wall time of each phase of a tick', ('phase',))
+        self._phases = {name: phases.labels(name) for name in TICK_PHASES}
+        self._drift = m.histogram('sim_tick_drift_seconds',
+                                  'How much later than its clock-paced interval each live tick started')
+        self._lag = m.gauge('sim_clock_lag_seconds', 'Wall time the live loop has fallen behind its clock in total')
+        self._lag.set(0.0)
+        self._broadcast_seconds = m.histogram('sim_broadcast_seconds',
+                                              'Wall time to fan one tick out to every client queue')
+        self._send_seconds = m.histogram('sim_ws_send_seconds',
+                                         'Time from queueing a frame for a client to the socket write finishing',
+                                         ('format',))
+        self._dropped_total = m.counter('sim_ws_frames_dropped_total', 'Frames dropped from full client queues')
+        self._dropped_total.labels()
+        m.counter('sim_ticks_total', 'Ticks advanced', fn=lambda: self.stats['ticks'])
+        m.gauge('sim_trains', 'Trains in the simulation', fn=lambda: len(self.trains))
+        m.gauge('sim_ws_clients', 'Connected WebSocket clients', fn=lambda: len(self.clients))
+        m.gauge('sim_ws_queued_frames', 'Frames waiting in client send queues',
+                fn=lambda: sum(len(c.queue) for c in self.clients))
+        m.gauge('sim_command_queue_depth', 'Control commands waiting for the next tick',
+                fn=lambda: len(self.command_queue))
+        m.gauge('sim_scheduled_events', 'Events scheduled for later simulated times',
+                fn=lambda: len(self.scheduler))
+        m.gauge('sim_audit_write_backlog', 'Audit entries waiting for the background writer',
+                fn=lambda: self.audit.writer.queue.qsize() if self.audit.writer is not None else 0)
+        m.counter('sim_audit_dropped_total', 'Audit entries dropped because the background writer was backed up',
+                  fn=lambda: self.audit.writer.dropped if self.audit.writer is not None else 0)
+
+    def render_metrics(self, include=None):
+        """Prometheus text for this simulator, or only the families in ``include``.
+
+        The full rendering also carries the process-wide families (HTTP
+        latency, encoding time).
+        """
+        if include is not None:
+            return self.metrics.render(include)
+        return self.metrics.render() + PROCESS.render()
+
+    def fork(self, seed=None):
+        """Headless copy of the current state for what-if runs"""
+        clock = SimClock(start=self.clock.now, epoch=self.clock.epoch, rate=None)
+        twin = DemoSimulator(self.trains.copy(), copy.deepcopy(self.tracks), self.sections,
+                             seed=seed, clock=clock, autostart=False)
+        twin.holds = dict(self.holds)
+        twin.forecast_interval = None
+        twin.history = None
+        twin.scheduler = self.scheduler.copy()
+        twin.restrictions = dict(self.restrictions)
+        twin.base_max_speed = dict(self.base_max_speed)
+        for b in self.occupancy.closed:
+            twin.occupancy.close(self.occupancy.block_ids[b])
+        twin.active_recommendation = copy.deepcopy(self.active_recommendation)
+        return twin
+
+    def load_state(self, trains, tracks=None, sections=None):
+        """Swap in another TrainState (and optionally network) in place.
+
+        Everything derived from the old state is rebuilt and connected
+        clients are sent a fresh keyframe on the next broadcast.
+        """
+        self.trains = trains
+        if tracks is not None:
+            self.tracks = tracks
+            self.adjacency = None
+        if sections is not None:
+            self.sections = sections
+        if tracks is not None or sections is not None:
+            self.network_version += 1
+        self.occupancy = BlockOccupancy(self.tracks)
+        self.occupancy.sync(trains)
+        self.section_index = SectionIndex(self.sections, self.tracks)
+        self.views = {None: FrameBuilder()}
+        self._id_frame = None
+        self._conflict_cache = {}
+        self.forecaster = Forecaster()
+        # A forecast still running projects the old trains; drop it
+        self._forecast_job = None
+        self.system_metrics['total_trains'] = len(trains)
+        for c in self.clients:
+            c.area = self._resolve_area(c.area)
+            c.resync = True
+        self.bump()
+
+    def _resolve_area(self, area):
+        """The same subscription on the current SectionIndex: its blocks and
+        tiles are rebuilt, and a section no longer there widens to the whole network"""
+        if area is None:
+            return None
+        kind, *rest = area.key
+        if kind == 'section':
+            return self.section_index.area(section_id=rest[0])
+        return self.section_index.area(bounds=area.bounds)
+
+    def load_network(self, network):
+        """Hot-swap to an imported network (see app.network); returns its summary.
+
+        Trains, blocks and sections are replaced together, and events,
+        restrictions, holds and closures of the old network are dropped.
+        The clock, the audit log and pending approvals carry on.
+        Timetabled departures become holds from now.
+        """
+        self.load_state(network.trains, network.tracks, network.sections)
+        self.adjacency = network.adjacency
+        now = self.clock.now
+        self.holds = {train_id: now + s for train_id, s in network.departures.items()}
+        self.scheduler = EventScheduler()
+        self.restrictions = {}
+        self.base_max_speed = {}
+        self.active_recommendation = None
+        self.log_audit('network_loaded', network.summary)
+        return network.summary
+
+    async def import_network(self, path):
+        """Load a network file (see app.network.load) off the loop, then swap it in"""
+        try:
+            network = await asyncio.to_thread(read_network, path)
+        except NetworkError as e:
+            return {"error": str(e), "errors": e.errors}
+        except OSError as e:
+            return {"error": f"Cannot read network: {e}"}
+        return {"status": "success", "network": self.load_network(network)}
+
+    def adjacent_blocks(self, block_id):
+        """Ids of the blocks sharing an endpoint with ``block_id``, or None for unknown blocks"""
+        b = self.occupancy.block_index.get(block_id)
+        if b is None:
+            return None
+        if self.adjacency is None:
+            ends = [p for t in self.tracks.values() for p in (t['from'], t['to'])]
+            _, nodes = np.unique(np.array(ends, dtype=np.float64).reshape(-1, 2).view(np.complex128).ravel(),
+                                 return_inverse=True)
+            self.adjacency = block_adjacency(nodes.ravel(), len(self.tracks))
+        indptr, indices = self.adjacency
+        ids = self.occupancy.block_ids
+        return [ids[j] for j in indices[indptr[b]:indptr[b + 1]].tolist()]
 
     def register_client(self, ws):
-        c = ClientWrapper(ws)
+        c = ClientWrapper(ws, send_seconds=self._send_seconds, dropped_total=self._dropped_total.labels())
+        c.start()
         self.clients.add(c)
         return c
 
     def unregister_client(self, client):
+        client.stop()
         self.clients.discard(client)
 
-    def get_positions(self):
+    def subscribe(self, client, payload, fmt=None):
+        """Limit a client to a section (``{'section': id}``) or ``{'bounds': [[lat, lon], [lat, lon]]}``.
+
+        Any other payload subscribes to the whole network. ``fmt`` switches
+        the client's wire format. Returns None, or an error message for an
+        unknown section, malformed bounds or an unavailable format, leaving
+        the subscription as it was.
+        """
+        if fmt is not None and fmt not in available_formats():
+            return f'Unknown format: {fmt}'
+        area = None
+        if isinstance(payload, dict) and payload.get('section') is not None:
+            area = self.section_index.area(section_id=payload['section'])
+            if area is None:
+                return 'Section not found'
+        elif isinstance(payload, dict) and payload.get('bounds') is not None:
+            try:
+                area = self.section_index.area(bounds=payload['bounds'])
+            except ValueError as e:
+                return str(e)
+        if fmt is not None:
+            client.format = fmt
+        client.area = area
+        self.send_keyframe(client)
+        return None
+
+    def send_keyframe(self, client):
+        """Queue full routes/positions/tracks so the client can apply later deltas"""
+        client.resync = False
+        area = client.area
+        view = self._view(area)
+        if area is None:
+            frames = view.keyframe(self)
+        else:
+            frames = view.keyframe(self, self._area_rows(area), area.blocks)
+        self._send_ids(client)
+        for frame in frames:
+            client.send_frame(frame)
+
+    def id_frame(self):
+        """Train-id dictionary that packed frames index into; rebuilt when trains are added or removed"""
+        ts = self.trains
+        if self._id_frame is None or self._id_frame[0] != ts.structure:
+            self._id_frame = (ts.structure, Frame({'type': 'train_ids', 'payload': {'structure': ts.structure, 'ids': list(ts.ids)}}))
+        return self._id_frame[1]
+
+    def _send_ids(self, client):
+        if client.format == PACKED and client.ids_structure != self.trains.structure:
+            client.ids_structure = self.trains.structure
+            client.send_frame(self.id_frame())
+
+    def _view(self, area):
+        key = None if area is None else area.key
+        view = self.views.get(key)
+        if view is None:
+            view = self.views[key] = FrameBuilder()
+        return view
+
+    def _area_rows(self, area):
+        return self.section_index.rows(area, self.trains.changes, self.position_array())
+
+    def position_array(self):
+        """Current train positions as an (n, 2) array, cached per state version"""
+        return self._spatial()['grid'].points
+
+    def get_positions(self, rows=None):
+        ts = self.trains
+        pos = self.position_array()
+        speed = ts.speed
+        route = ts.route
         out = {}
-        for k,v in self.trains.items():
-            route = v['route']
-            idx = v['idx']
-            pos = route[idx]
-            out[k] = { 'id':k, 'label': v['label'], 'route': route, 'position': pos, 'speed': v['speed'], 'next_section':'secX' }
+        for row in (range(len(ts)) if rows is None else rows.tolist()):
+            k = ts.ids[row]
+            out[k] = { 'id':k, 'label': ts.meta[row].get('label', k), 'route_id': int(route[row]), 'position': pos[row].tolist(), 'speed': speed[row].item(), 'next_section':'secX' }
         return out
 
-    async def _tick(self):
-        # Real-time train movement simulation
+    def section_status(self, section_id):
+        """Trains, blocks and conflicts inside one section, or None if unknown"""
+        area = self.section_index.area(section_id=section_id)
+        if area is None:
+            return None
+        positions = self.get_positions(self._area_rows(area))
+        conflicts = [c for c in self._detect_conflicts() if any(t in positions for t in c['trains'])]
+        return {
+            'section_id': section_id,
+            'section': self.sections[section_id],
+            'positions': positions,
+            'tracks': FrameBuilder.tracks_for(self, area.blocks),
+            'conflicts': conflicts
+        }
+
+    def _step(self, dt=TICK_SECONDS):
+        """Advance all running trains by one tick using batched array operations"""
+        ts = self.trains
+        running = np.flatnonzero(ts.status == status_code('running'))
+        if not len(running):
+            return
+        self._move(self._wait_at_closures(running, dt), dt)
+
+    def _move(self, movers, dt=TICK_SECONDS):
+        """Step the trains in rows ``movers``, none of them held at a closure"""
+        ts = self.trains
+        cache = self._spatial()
+        stalled, advanced, conflicts = step_trains(ts, cache['grid'], cache['running'], movers, dt)
+        self._log_conflicts(len(stalled), conflicts)
+
+        # Only trains that reached a new waypoint change block occupancy
+        self.occupancy.sync(ts, advanced.tolist())
+
+    def _wait_at_closures(self, running, dt=TICK_SECONDS):
+        """Stop trains about to enter a block under maintenance; returns the rest"""
+        if not self.occupancy.closed:
+            return running
+        ts = self.trains
+        want = ts.dist[running] + ts.speed[running] * dt / 3600.0
+        ahead = ts.geometry.locate(ts.route[running], want)[1]
+        waiting = self.occupancy.closed_ahead(ahead, running)
+        if not len(waiting):
+            return running
+        ts.speed[waiting] = 0
+        ts.delay[waiting] += dt / 60.0
+        ts.touch()
+        return np.setdiff1d(running, waiting)
+
+    def _log_conflicts(self, stalled, conflicts):
+        self.stats['conflict_events'] += stalled
+        for train_id, found in conflicts.items():
+            self.log_audit('conflict_detected', {
+                'train': train_id,
+                'conflicts': found,
+                'action': 'speed_reduced'
+            })
+
+    def advance(self, dt=TICK_SECONDS):
+        """Advance the simulation by one tick of ``dt`` simulated seconds.
+
+        Pure state update with no I/O, shared by the live loop and headless
+        runs. Returns the messages the tick produced, for broadcasting.
+        """
+        phases = self._phases
+        started = t = time.perf_counter()
+        self.clock.advance(dt)
+        now = self.clock.now
+        self.stats['ticks'] += 1
+        self._apply_commands()
+        t = lap(phases['commands'], t)
+        messages = self._dispatch_events(now)
+        self._release_holds(now)
+        t = lap(phases['events'], t)
+        
+        # Update train positions with realistic movement
+        self._step(dt)
+        t = lap(phases['step'], t)
+        
+        # Generate recommendations based on real-time conditions
+        conflicts = self._detect_all_conflicts()
+        t = lap(phases['conflicts'], t)
+        if conflicts and not self.active_recommendation:
+            rec = self.generate_recommendation()
+            self.active_recommendation = rec
+            messages.append({'type':'recommendation','payload':rec})
+        t = lap(phases['recommendation'], t)
+        
+        if now >= self._next_metrics:
+            self._next_metrics += METRICS_INTERVAL
+            self._update_metrics()
+            messages.append({'type': 'metrics', 'payload': self.system_metrics})
+            if self.history is not None:
+                self.history.record_metrics(now, dict(self.system_metrics, **self.kpis()))
+        t = lap(phases['metrics'], t)
+        
+        if now >= self._next_event:
+            self._next_event = now + self.rng.uniform(10, 30)  # Random intervals
+            messages.append({'type': 'event', 'payload': self._generate_event()})
+        self.bump()
+        t = lap(phases['random_events'], t)
+        if self.forecast_interval and now >= self._next_forecast:
+            self._next_forecast += self.forecast_interval
+            if not self.forecast_in_background:
+                forecast = self.forecast_conflicts(limit=FORECAST_TOP)
+                messages.append({'type': 'forecast', 'payload': forecast})
+                imminent = [c for c in forecast['conflicts'] if c['time_s'] <= IMMINENT_S]
+                if imminent and not self.active_recommendation:
+                    self.active_recommendation = self.generate_recommendation()
+                    messages.append({'type': 'recommendation', 'payload': self.active_recommendation})
+            elif self._forecast_job is None:
+                self._start_forecast()
+        if self._forecast_job is not None and self._forecast_job.done():
+            self._publish_forecast(messages)
+        t = lap(phases['forecast'], t)
+        if self.history is not None:
+            self.history.record(self)
+        self._tick_seconds.observe(lap(phases['history'], t) - started)
+        return messages
+
+    def kpi_trends(self, since=None, until=None, points=200):
+        """Recorded metrics and KPIs over a window of simulated time, by default the last hour"""
+        until = self.clock.now if until is None else until
+        since = until - 3600.0 if since is None else since
+        return dict(self.history.trends(since, until, points), history=self.history.summary())
+
+    def history_page(self, since, until=None, gap=0.0, limit=100):
+        """Recorded train states from ``since`` for replay; see HistoryStore.page"""
+        return self.history.page(since, self.clock.now if until is None else until, gap, limit)
+
+    def forecast_conflicts(self, horizon_s=FORECAST_HORIZON_S, limit=100):
+        """Conflicts projected within ``horizon_s`` simulated seconds, soonest first"""
+        def build():
+            t0 = time.perf_counter()
+            total, found = self.forecaster.forecast(self.trains, self.occupancy, self.holds,
+                                                    self.clock.now, horizon_s, limit)
+            return {
+                'now': self.clock.now,
+                'horizon_s': horizon_s,
+                'total': total,
+                'conflicts': found,
+                'compute_ms': round((time.perf_counter() - t0) * 1000, 2)
+            }
+        return self.memo(('forecast', horizon_s, limit), build)
+
+    def _start_forecast(self):
+        """Project the periodic forecast on a snapshot of the trains and blocks in the background thread"""
+        if self._forecast_pool is None:
+            self._forecast_pool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='forecast')
+            # Its own route tables, apart from the ones on-demand forecasts use
+            self._background_forecaster = Forecaster()
+        forecaster, occupancy = self._background_forecaster, self.occupancy.copy()
+        ts, holds, now = self.trains.copy(), dict(self.holds), self.clock.now
+
+        def build():
+            t0 = time.perf_counter()
+            total, found = forecaster.forecast(ts, occupancy, holds, now, FORECAST_HORIZON_S)
+            return {
+                'now': now,
+                'horizon_s': FORECAST_HORIZON_S,
+                'total': total,
+                'conflicts': found,
+                'compute_ms': round((time.perf_counter() - t0) * 1000, 2)
+            }
+        self._forecast_job = self._forecast_pool.submit(build)
+
+    def _publish_forecast(self, messages):
+        """Broadcast the finished background forecast and act on its imminent conflicts"""
+        job, self._forecast_job = self._forecast_job, None
+        try:
+            forecast = job.result()
+        except Exception:
+            log.exception('Background forecast failed')
+            return
+        messages.append({'type': 'forecast', 'payload': dict(forecast, conflicts=forecast['conflicts'][:FORECAST_TOP])})
+        imminent = [c for c in forecast['conflicts'] if c['time_s'] <= IMMINENT_S]
+        if imminent and not self.active_recommendation:
+            self.active_recommendation = self.generate_recommendation(ahead=imminent)
+            messages.append({'type': 'recommendation', 'payload': self.active_recommendation})
+
+    def start(self):
+        """Make sure the live loop runs on the current event loop.
+
+        Servers construct the simulator with ``autostart=False`` and call
+        this from their lifespan hook, after any checkpoint is restored; it
+        is a no-op when the loop is already running here.
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.run())
+
+    async def run(self):
+        # Real-time train movement simulation, paced by the clock
+        self.forecast_in_background = True
+        woke = None
         while True:
-            await asyncio.sleep(1.0)  # Faster updates for more dynamic feel
-            
-            # Update train positions with realistic movement
-            for train_id, train in self.trains.items():
-                if train['status'] == 'running':
-                    # Calculate movement based on speed and track conditions
-                    current_pos = train['route'][train['idx']]
-                    next_idx = min(len(train['route'])-1, train['idx']+1)
-                    next_pos = train['route'][next_idx]
-                    
-                    # Check for conflicts before moving
-                    conflicts = self._check_track_conflicts(train_id, next_pos)
-                    if conflicts:
-                        # Handle conflict - slow down or stop
-                        train['speed'] = max(10, train['speed'] * 0.5)
-                        train['delay'] += 1
-                        self.log_audit('conflict_detected', {
-                            'train': train_id, 
-                            'conflicts': conflicts,
-                            'action': 'speed_reduced'
-                        })
-                    else:
-                        # Normal movement
-                        train['idx'] = next_idx
-                        train['speed'] = min(train['max_speed'], train['speed'] + 5)
-                        train['delay'] = max(0, train['delay'] - 0.5)
-                    
-                    # Update track status
-                    self._update_track_status(train_id, current_pos)
+            await self.clock.wait(TICK_SECONDS)
+            # Drift: wake-up interval beyond the paced one (the sleep does not absorb tick cost)
+            now = time.perf_counter()
+            if woke is not None and self.clock.rate:
+                drift = max(0.0, now - woke - TICK_SECONDS / self.clock.rate)
+                self._drift.observe(drift)
+                self._lag.labels().inc(drift)
+            woke = now
+            messages = self.advance()
+            t = time.perf_counter()
+            for hook in self.tick_hooks:
+                hook(messages)
+            t = lap(self._phases['hooks'], t)
             
             # Broadcast real-time updates
-            await self.broadcast_positions()
-            await self.broadcast_track_status()
-            
-            # Generate recommendations based on real-time conditions
-            conflicts = self._detect_all_conflicts()
-            if conflicts and not self.active_recommendation:
-                rec = self.generate_recommendation()
-                self.active_recommendation = rec
-                await self.broadcast({'type':'recommendation','payload':rec})
+            await self.broadcast_state()
+            for msg in messages:
+                await self.broadcast(msg)
+            lap(self._broadcast_seconds.labels(), t)
 
-    async def broadcast_positions(self):
-        payload = self.get_positions()
-        await self.broadcast({'type':'positions','payload':payload})
+    def run_headless(self, duration, dt=TICK_SECONDS):
+        """Advance ``duration`` simulated seconds as fast as possible; returns ticks run"""
+        ticks = int(round(duration / dt))
+        for _ in range(ticks):
+            self.advance(dt)
+        return ticks
 
-    async def broadcast(self, msg):
+    def hold(self, train_id, seconds):
+        """Stop a train for ``seconds`` of simulated time, booking it as planned delay.
+
+        Only a running (or already held) train becomes 'held' and resumes on
+        release; a stopped or emergency-stopped train keeps its status, so
+        the hold ending never restarts it.
+        """
+        train = self.trains[train_id]
+        if train['status'] in ('running', 'held'):
+            train['status'] = 'held'
+        train['speed'] = 0
+        train['delay'] += seconds / 60.0
+        self.holds[train_id] = self.clock.now + seconds
+
+    def _release_holds(self, now):
+        for train_id, until in list(self.holds.items()):
+            if until <= now:
+                del self.holds[train_id]
+                if train_id in self.trains and self.trains[train_id]['status'] == 'held':
+                    self.trains[train_id]['status'] = 'running'
+
+    def _new_id(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    async def broadcast_state(self):
+        """Send this tick's position and track frames to each subscribed area"""
+        dirty = self.occupancy.drain_dirty()
+        groups: Dict[Any, list] = {}
         for c in list(self.clients):
-            try:
-                await c.send_json(msg)
-            except Exception:
+            if c.closed:
                 self.unregister_client(c)
-
-    def generate_recommendation(self):
-        # Enhanced AI logic for train optimization
-        positions = self.get_positions()
-        trains = list(positions.values())
-        
-        # Check for conflicts and generate intelligent recommendations
-        conflicts = self._detect_conflicts(trains)
-        
-        if conflicts:
-            # Generate conflict-based recommendation
-            conflict = conflicts[0]  # Take first conflict
-            if len(conflict['trains']) >= 2:
-                train1, train2 = conflict['trains'][0], conflict['trains'][1]
-                summary = f'Hold {train2}; allow {train1} to pass via primary route'
-                time_saved = 8.2  # Estimated time saved
             else:
-                summary = f'Adjust speed for {conflict["trains"][0]} to avoid congestion'
-                time_saved = 3.1
+                groups.setdefault(None if c.area is None else c.area.key, []).append(c)
+        for key, clients in groups.items():
+            area = clients[0].area
+            view = self._view(area)
+            if area is None:
+                frames = view.position_frames(self) + view.track_frames(self, dirty)
+            else:
+                frames = view.position_frames(self, self._area_rows(area)) + view.track_frames(self, dirty, area.blocks)
+            self._fanout(frames, clients)
+        for key in [k for k in self.views if k is not None and k not in groups]:
+            del self.views[key]
+
+    async def broadcast(self, msg):
+        self._fanout([Frame(msg)])
+
+    def _fanout(self, frames, clients=None):
+        """Queue pre-serialized frames on clients without awaiting sockets"""
+        if not frames:
+            return
+        for c in list(self.clients if clients is None else clients):
+            if c.closed:
+                self.unregister_client(c)
+                continue
+            if c.resync:
+                self.send_keyframe(c)
+            self._send_ids(c)
+            for frame in frames:
+                c.send_frame(frame)
+
+    def generate_recommendation(self, section_id=None, ahead=None):
+        """Recommendation from jointly sequencing every current conflict (optionally one section's).
+
+        ``ahead`` are the imminent projected conflicts when the caller has
+        them already; by default they are forecast now.
+        """
+        conflicts = list(self._detect_conflicts())
+        # Sequence imminent projected conflicts too, before they cause slowdowns
+        if ahead is None:
+            ahead = self.forecast_conflicts(IMMINENT_S, limit=None)['conflicts']
+        seen = {tuple(sorted(c['trains'])) for c in conflicts}
+        for c in ahead:
+            pair = tuple(sorted(c['trains']))
+            if pair not in seen:
+                seen.add(pair)
+                conflicts.append(c)
+        if section_id is not None:
+            area = self.section_index.area(section_id=section_id)
+            inside = set() if area is None else {self.trains.ids[r] for r in self._area_rows(area).tolist()}
+            conflicts = [c for c in conflicts if any(t in inside for t in c['trains'])]
+        solution = self.optimizer.solve(self, conflicts)
+        holds = sorted((a for a in solution['actions'] if a['action'] == 'hold'),
+                       key=lambda a: -a['hold_min'] * a['weight'])
+
+        if holds:
+            first = holds[0]
+            summary = f"Hold {first['train']} {first['hold_min']:.1f} min; allow {first['after']} to pass first"
+            if len(holds) > 1:
+                summary += f' (+{len(holds) - 1} more holds)'
+        elif conflicts:
+            summary = 'Conflicting trains can proceed in their current order'
         else:
             # Proactive optimization
             summary = 'Optimize train spacing for improved throughput'
-            time_saved = 4.5
-        
-        rec = { 
-            'id': str(uuid.uuid4()), 
-            'summary': summary, 
-            'metric': { 'time_saved_min': time_saved },
-            'created_at': time.time(), 
+
+        rec = {
+            'id': self._new_id(),
+            'summary': summary,
+            'metric': { 'time_saved_min': solution['time_saved_min'] },
+            'created_at': self.clock.time(),
             'status': 'SUGGESTED',
-            'confidence': 0.87,
-            'conflicts_detected': len(conflicts)
+            'confidence': round(max(0.5, 1.0 - solution['optimality_gap']), 2),
+            'conflicts_detected': sum('time_s' not in c for c in conflicts),
+            'conflicts_projected': sum('time_s' in c for c in conflicts),
+            'actions': solution.pop('actions'),
+            'solve_time_ms': solution['solve_time_ms'],
+            'optimality_gap': solution['optimality_gap'],
+            'solver': solution
         }
+        if section_id is not None:
+            rec['section_id'] = section_id
         self.log_audit('recommendation_generated', rec)
         return rec
     
-    def _detect_conflicts(self, trains):
+    def _spatial(self):
+        """Grid index over current train positions, rebuilt once per state change"""
+        ts = self.trains
+        cache = self._conflict_cache
+        if cache.get('version') != ts.changes:
+            cache.clear()
+            cache['version'] = ts.changes
+            cache['grid'] = GridIndex(ts.positions())
+            cache['running'] = ts.status == status_code('running')
+        return cache
+
+    def _detect_conflicts(self, trains=None):
         """Detect potential conflicts between trains"""
+        if trains is None:
+            cache = self._spatial()
+            if 'pairs' not in cache:
+                cache['pairs'] = self._proximity_pairs(self.trains.ids, cache['grid'])
+            return cache['pairs']
+        ids = [t['id'] for t in trains]
+        grid = GridIndex([t['position'] for t in trains])
+        return self._proximity_pairs(ids, grid)
+
+    def _proximity_pairs(self, ids, grid):
+        # Simple conflict detection based on proximity
+        ii, jj, dist = grid.self_pairs(0.1)
         conflicts = []
+        for i, j, d in zip(ii.tolist(), jj.tolist(), dist.tolist()):
+            conflicts.append({
+                'trains': [ids[i], ids[j]],
+                'distance': d,
+                'severity': 'high' if d < 0.05 else 'medium'
+            })
+        return conflicts
+
+    async def execute_commands(self, commands):
+        """Queue commands for the next tick and wait for their per-command results"""
+        future = asyncio.get_running_loop().create_future()
+        self.command_queue.submit(commands, future)
+        return await future
+
+    def _apply_commands(self):
+        """Apply every queued command in submission order, all within this tick"""
+        for batch, future in self.command_queue.drain():
+            # One audit entry per batch rather than per command, so a large
+            # regulation change doesn't flush the audit ring
+            single = len(batch) == 1
+            results = [self._apply_safely(c, single) for c in batch]
+            if not single:
+                done = [c for c, r in zip(batch, results) if 'error' not in r]
+                counts: Dict[str, int] = {}
+                for c in done:
+                    counts[c['action']] = counts.get(c['action'], 0) + 1
+                self.log_audit('commands_applied', {
+                    'trains': sorted({c['train_id'] for c in done if isinstance(c.get('train_id'), str)}),
+                    'actions': counts,
+                    'failed': len(batch) - len(done)
+                })
+            if future is not None and not future.done():
+                future.set_result(results)
+
+    def _apply_safely(self, command, audit):
+        # A command that raises fails alone; the tick and the rest of the batch carry on
+        try:
+            return self.apply_command(command, audit)
+        except Exception as e:
+            log.exception('command %r failed', command)
+            return {"error": f"Command failed: {type(e).__name__}: {e}"}
+
+    def apply_command(self, command, audit=True):
+        """Apply one ``{'action', 'train_id', 'value', 'data'}`` command now"""
+        if not isinstance(command, dict):
+            return {"error": "Command must be an object"}
+        action = command.get('action')
+        if action in TRAIN_ACTIONS:
+            return self.control_train(command.get('train_id'), action, command.get('value'), audit)
+        if action in EVENT_ACTIONS:
+            return self.trigger_event(action, command.get('data'), audit)
+        return {"error": "Unknown action"}
+
+    def control_train(self, train_id, action, value=None, audit=True):
+        """Control individual train (speed, stop, start)"""
+        if train_id not in self.trains:
+            return {"error": "Train not found"}
         
-        # Simple conflict detection based on proximity
-        for i, train1 in enumerate(trains):
-            for j, train2 in enumerate(trains[i+1:], i+1):
-                pos1 = train1['position']
-                pos2 = train2['position']
-                
-                # Calculate distance between trains
-                distance = ((pos1[0] - pos2[0])**2 + (pos1[1] - pos2[1])**2)**0.5
-                
-                if distance < 0.1:  # Very close - potential conflict
-                    conflicts.append({
-                        'trains': [train1['id'], train2['id']],
-                        'distance': distance,
-                        'severity': 'high' if distance < 0.05 else 'medium'
-                    })
+        train = self.trains[train_id]
         
-        return conflicts
+        if action == "speed":
+            if not isinstance(value, (int, float)):
+                return {"error": "Speed needs a numeric value"}
+            train['speed'] = max(0, min(train['max_speed'], value))
+            if audit:
+                self.log_audit('train_speed_changed', {'train': train_id, 'new_speed': value})
+        elif action == "stop":
+            train['status'] = 'stopped'
+            train['speed'] = 0
+            if audit:
+                self.log_audit('train_stopped', {'train': train_id})
+        elif action == "start":
+            train['status'] = 'running'
+            if audit:
+                self.log_audit('train_started', {'train': train_id})
+        else:
+            return {"error": "Unknown action"}
+        
+        return {"status": "success", "train": dict(train)}
+
+    def trigger_event(self, event_type, data=None, audit=True):
+        """Manually trigger simulation events"""
+        if event_type == "add_train":
+            # Add a new train dynamically; ``data`` may override the defaults
+            n = len(self.trains) + 1
+            while f"T{n}" in self.trains:
+                n += 1
+            new_id = f"T{n}"
+            data = dict(data) if isinstance(data, dict) else {}
+            # Runs on one of the network's routes unless given its own waypoints
+            route_id = data.pop('route_id', None)
+            if 'route' in data:
+                route = data['route']
+                if not isinstance(route, list) or len(route) < 2 or not all(
+                        isinstance(p, (list, tuple)) and len(p) == 2 and all(
+                            isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in p)
+                        for p in route):
+                    return {"error": "Route must be a list of at least 2 [lat, lon] points"}
+            elif isinstance(route_id, int) and 0 <= route_id < len(self.trains.routes):
+                route = self.trains.routes[route_id]
+            elif route_id is None and self.trains.routes:
+                route = self.rng.choice(self.trains.routes)
+            else:
+                return {"error": "Route not found"}
+            data.pop('route', None)
+            fields, error = train_fields(data)
+            if error is not None:
+                return {"error": error}
+            if fields.get('idx', 0) >= len(route) - 1:
+                return {"error": "Train field 'idx' is past the end of the route"}
+            train = {
+                'label': f'Train {new_id}', 'type': 'passenger',
+                'idx': 0, 'speed': 40, 'max_speed': 70, 'priority': 'medium',
+                'passengers': 200, 'status': 'running', 'delay': 0
+            }
+            train.update(fields)
+            train['route'] = route
+            train['id'] = new_id
+            self.trains[new_id] = train
+            if audit:
+                self.log_audit('train_added', {'train': new_id})
+            return {"status": "success", "train": dict(self.trains[new_id])}
+        
+        elif event_type == "emergency_stop":
+            # Emergency stop all trains, one write per column
+            ts = self.trains
+            ts.status[:] = status_code('emergency_stop')
+            ts.speed[:] = 0
+            ts.touch()
+            if audit:
+                self.log_audit('emergency_stop', {'reason': 'manual_trigger'})
+            return {"status": "success", "message": "All trains stopped"}
+        
+        return {"error": "Unknown event type"}
+
+    def schedule_events(self, events):
+        """Schedule ``{'type', 'at' | 'in_s', 'data'}`` events; returns per-event results.
+
+        ``at`` is an absolute simulated second, ``in_s`` is relative to now.
+        Event data is checked and coerced here (see events.event_spec), so
+        a malformed event is refused instead of failing when it falls due.
+        """
+        results = []
+        for spec in events:
+            spec, error = event_spec(spec)
+            if error:
+                results.append({"error": error})
+                continue
+            at = spec['at'] if spec['at'] is not None else self.clock.now + spec['in_s']
+            results.append(self.scheduler.schedule(at, spec['type'], spec['data']))
+        self.log_audit('events_scheduled', {'count': sum('error' not in r for r in results)})
+        return results
+
+    def cancel_event(self, event_id):
+        event = self.scheduler.events.get(event_id)
+        if event is None or event.get('internal'):
+            return {"error": "Event not found"}
+        self.scheduler.cancel(event_id)
+        self.log_audit('event_cancelled', {'event_id': event_id, 'type': event['type']})
+        return {"status": "cancelled", "event": event}
+
+    def upcoming_events(self, limit=50, event_type=None, until=None):
+        return {
+            "now": self.clock.now,
+            "pending": len(self.scheduler),
+            "events": self.scheduler.upcoming(limit, event_type, until)
+        }
+
+    def _dispatch_events(self, now):
+        """Apply every event due by ``now`` (up to DISPATCH_LIMIT) as one batch"""
+        due = self.scheduler.due(now, DISPATCH_LIMIT)
+        if not due:
+            return []
+        # Like command batches, many events share one audit entry
+        single = len(due) == 1
+        results = [self._apply_event_safely(e, single) for e in due]
+        done = [e for e, r in zip(due, results) if 'error' not in r]
+        if not single:
+            counts: Dict[str, int] = {}
+            for e in done:
+                counts[e['type']] = counts.get(e['type'], 0) + 1
+            self.log_audit('events_dispatched', {'types': counts, 'failed': len(due) - len(done)})
+        return [{'type': 'event', 'payload': {
+            'type': 'scheduled',
+            'timestamp': self.clock.time(),
+            'count': len(done),
+            'events': [{'id': e['id'], 'type': e['type']} for e in done[:100]],
+            'description': f'{len(done)} scheduled event(s) applied'
+        }}] if done else []
+
+    def _apply_event_safely(self, event, audit):
+        # Like commands, an event that raises is dropped alone and the tick carries on
+        try:
+            return self._apply_event(event, audit)
+        except Exception as e:
+            log.exception('scheduled event %r failed', event)
+            return {"error": f"Event failed: {type(e).__name__}: {e}"}
+
+    def _apply_event(self, event, audit=True):
+        kind, data = event['type'], event['data']
+        if kind in TRAIN_ACTIONS or kind in EVENT_ACTIONS:
+            return self.apply_command(dict(data, action=kind), audit)
+        if kind == 'delay':
+            train_id = data.get('train_id')
+            if train_id not in self.trains:
+                return {"error": "Train not found"}
+            self.hold(train_id, float(data.get('minutes', 5)) * 60.0)
+            if audit:
+                self.log_audit('planned_delay', {'train': train_id, 'delay_minutes': data.get('minutes', 5)})
+            return {"status": "success"}
+        if kind == 'speed_restriction':
+            return self._restrict_speed(event, audit)
+        if kind == 'speed_restriction_end':
+            ended = self.restrictions.pop(data['restriction'], None)
+            self._apply_speed_caps(ended['trains'] if ended else [])
+            return {"status": "success"}
+        if kind == 'maintenance':
+            block_id = data.get('block_id')
+            if not self.occupancy.close(block_id):
+                return {"error": "Block not found"}
+            self.scheduler.schedule(self.clock.now + float(data.get('duration_s', 600)),
+                                    'maintenance_end', {'block_id': block_id}, internal=True)
+            if audit:
+                self.log_audit('maintenance_started', {'block': block_id, 'duration_s': data.get('duration_s', 600)})
+            return {"status": "success"}
+        if kind == 'maintenance_end':
+            self.occupancy.close(data['block_id'], closed=False)
+            if audit:
+                self.log_audit('maintenance_ended', {'block': data['block_id']})
+            return {"status": "success"}
+        return {"error": "Unknown event type"}
+
+    def _restrict_speed(self, event, audit=True):
+        """Cap max_speed of the listed trains, or those in a section, for ``duration_s``"""
+        data = event['data']
+        if 'section_id' in data:
+            area = self.section_index.area(data['section_id'])
+            if area is None:
+                return {"error": "Section not found"}
+            train_ids = [self.trains.ids[r] for r in self._area_rows(area).tolist()]
+        else:
+            train_ids = [t for t in data.get('train_ids', []) if t in self.trains]
+        limit = float(data.get('max_speed', 30))
+        self.restrictions[event['id']] = {'trains': train_ids, 'max_speed': limit}
+        self._apply_speed_caps(train_ids)
+        self.scheduler.schedule(self.clock.now + float(data.get('duration_s', 600)),
+                                'speed_restriction_end', {'restriction': event['id']}, internal=True)
+        if audit:
+            self.log_audit('speed_restriction', {'trains': train_ids, 'max_speed': limit})
+        return {"status": "success", "trains": len(train_ids)}
+
+    def _apply_speed_caps(self, train_ids):
+        """Set each train's max_speed to its own limit under the tightest active restriction"""
+        for train_id in train_ids:
+            if train_id not in self.trains:
+                self.base_max_speed.pop(train_id, None)
+                continue
+            train = self.trains[train_id]
+            base = self.base_max_speed.setdefault(train_id, train['max_speed'])
+            caps = [r['max_speed'] for r in self.restrictions.values() if train_id in r['trains']]
+            if caps:
+                train['max_speed'] = min([base] + caps)
+                train['speed'] = min(train['speed'], train['max_speed'])
+            else:
+                train['max_speed'] = self.base_max_speed.pop(train_id)
 
     def request_approval(self, payload):
-        ticket_id = str(uuid.uuid4())
-        ticket = { 'ticket_id': ticket_id, 'payload': payload, 'status': 'PENDING', 'created_at':time.time() }
+        ticket_id = self._new_id()
+        ticket = { 'ticket_id': ticket_id, 'payload': payload, 'status': 'PENDING', 'created_at':self.clock.time() }
         self.pending_tickets[ticket_id] = ticket
         self.log_audit('approval_requested', ticket)
         return ticket
@@ -213,14 +1121,47 @@ class DemoSimulator:
         self.log_audit('ticket_' + ('approved' if approved else 'rejected'), t)
         return t
 
+    def state_version(self):
+        """Monotonic version of the readable state.
+
+        Bumped once per tick and whenever trains or block occupancy change
+        in between, e.g. through control endpoints.
+        """
+        key = (id(self.trains), self.trains.changes, self.occupancy.version)
+        if key != self._version_key:
+            self._version_key = key
+            self.bump()
+        return self.version
+
+    def bump(self):
+        self.version += 1
+        self._memo.clear()
+
+    def memo(self, name, build):
+        """``build()`` computed at most once per state version"""
+        self.state_version()
+        if name not in self._memo:
+            self._memo[name] = build()
+        return self._memo[name]
+
+    def system_status(self):
+        return self.memo('system_status', lambda: {
+            "trains": self.memo('trains', self.trains.to_list),
+            "tracks": list(self.tracks.values()),
+            "metrics": self.system_metrics,
+            "active_conflicts": len(self._detect_all_conflicts()),
+            "timestamp": self.clock.time()
+        })
+
     def kpis(self):
+        return self.memo('kpis', self._kpis)
+
+    def _kpis(self):
         # Enhanced KPIs with real-time calculations
-        positions = self.get_positions()
-        trains = list(positions.values())
-        conflicts = self._detect_conflicts(trains)
+        conflicts = self._detect_conflicts()
         
         # Calculate dynamic KPIs based on current state
-        total_trains = len(trains)
+        total_trains = len(self.trains)
         active_conflicts = len(conflicts)
         
         # Punctuality decreases with conflicts
@@ -250,103 +1191,108 @@ class DemoSimulator:
 
     def _check_track_conflicts(self, train_id, position):
         """Check for conflicts at a specific position"""
+        ts = self.trains
+        cache = self._spatial()
+        _, jj, dist = cache['grid'].query([position], 0.05)
         conflicts = []
-        for other_train_id, other_train in self.trains.items():
-            if other_train_id != train_id and other_train['status'] == 'running':
-                other_pos = other_train['route'][other_train['idx']]
-                distance = ((position[0] - other_pos[0])**2 + (position[1] - other_pos[1])**2)**0.5
-                if distance < 0.05:  # Very close - potential conflict
-                    conflicts.append({
-                        'train': other_train_id,
-                        'distance': distance,
-                        'severity': 'high' if distance < 0.02 else 'medium'
-                    })
+        for j, d in zip(jj.tolist(), dist.tolist()):
+            if cache['running'][j] and ts.ids[j] != train_id:
+                conflicts.append({
+                    'train': ts.ids[j],
+                    'distance': d,
+                    'severity': 'high' if d < 0.02 else 'medium'
+                })
         return conflicts
     
-    def _update_track_status(self, train_id, position):
-        """Update track status based on train position"""
-        for track_id, track in self.tracks.items():
-            dist_to_start = ((position[0] - track['from'][0])**2 + (position[1] - track['from'][1])**2)**0.5
-            dist_to_end = ((position[0] - track['to'][0])**2 + (position[1] - track['to'][1])**2)**0.5
-            
-            if dist_to_start < 0.1 or dist_to_end < 0.1:
-                track['status'] = 'occupied'
-                track['occupied_by'] = train_id
-            else:
-                track['status'] = 'free'
-                track.pop('occupied_by', None)
-    
     def _detect_all_conflicts(self):
-        """Detect all current conflicts in the system"""
+        """Detect all current conflicts in the system.
+
+        Computed at most once per state version; the tick loop, metrics task
+        and REST handlers all read the same cached list.
+        """
+        ts = self.trains
+        cache = self._spatial()
+        if 'all' in cache:
+            return cache['all']
+        running = cache['running']
+        rows = np.flatnonzero(running)
+        ii, jj, dist = cache['grid'].query(cache['grid'].points[rows], 0.05)
+        keep = running[jj] & (rows[ii] != jj)
         all_conflicts = []
-        for train_id, train in self.trains.items():
-            if train['status'] == 'running':
-                conflicts = self._check_track_conflicts(train_id, train['route'][train['idx']])
-                all_conflicts.extend(conflicts)
+        for j, d in zip(jj[keep].tolist(), dist[keep].tolist()):
+            all_conflicts.append({
+                'train': ts.ids[j],
+                'distance': d,
+                'severity': 'high' if d < 0.02 else 'medium'
+            })
+        cache['all'] = all_conflicts
         return all_conflicts
     
-    async def broadcast_track_status(self):
-        """Broadcast current track status to all clients"""
-        await self.broadcast({'type': 'tracks', 'payload': list(self.tracks.values())})
+    def _update_metrics(self):
+        """Refresh system metrics; called every METRICS_INTERVAL simulated seconds"""
+        # Calculate real-time metrics
+        active_trains = int((self.trains.status == status_code('running')).sum())
+        conflicts = self._detect_all_conflicts()
+        occupied_tracks = self.occupancy.occupied()
+        
+        self.system_metrics.update({
+            'active_trains': active_trains,
+            'active_conflicts': len(conflicts),
+            'system_load': occupied_tracks / max(len(self.tracks), 1),
+            'efficiency_score': max(0.1, 1.0 - (len(conflicts) * 0.2))
+        })
     
-    async def _update_metrics(self):
-        """Continuously update system metrics"""
-        while True:
-            await asyncio.sleep(2.0)
-            
-            # Calculate real-time metrics
-            active_trains = sum(1 for t in self.trains.values() if t['status'] == 'running')
-            conflicts = self._detect_all_conflicts()
-            occupied_tracks = sum(1 for t in self.tracks.values() if t['status'] == 'occupied')
-            
-            self.system_metrics.update({
-                'active_trains': active_trains,
-                'active_conflicts': len(conflicts),
-                'system_load': occupied_tracks / len(self.tracks),
-                'efficiency_score': max(0.1, 1.0 - (len(conflicts) * 0.2))
+    def _generate_event(self):
+        """Apply one random event to make the system more dynamic"""
+        rng = self.rng
+        event_type = rng.choice(['delay', 'speed_change', 'new_train', 'maintenance'])
+        train_ids = list(self.trains.keys())
+        
+        if event_type == 'delay' and train_ids:
+            train_id = rng.choice(train_ids)
+            delay_minutes = rng.randint(2, 10)
+            self.trains[train_id]['delay'] += delay_minutes
+            self.log_audit('random_delay', {
+                'train': train_id,
+                'delay_minutes': delay_minutes,
+                'reason': 'operational_delay'
             })
-            
-            # Broadcast metrics update
-            await self.broadcast({'type': 'metrics', 'payload': self.system_metrics})
-    
-    async def _generate_events(self):
-        """Generate random events to make the system more dynamic"""
-        while True:
-            await asyncio.sleep(random.uniform(10, 30))  # Random intervals
-            
-            # Random events
-            event_type = random.choice(['delay', 'speed_change', 'new_train', 'maintenance'])
-            
-            if event_type == 'delay':
-                train_id = random.choice(list(self.trains.keys()))
-                delay_minutes = random.randint(2, 10)
-                self.trains[train_id]['delay'] += delay_minutes
-                self.log_audit('random_delay', {
-                    'train': train_id,
-                    'delay_minutes': delay_minutes,
-                    'reason': 'operational_delay'
-                })
-            
-            elif event_type == 'speed_change':
-                train_id = random.choice(list(self.trains.keys()))
-                speed_change = random.randint(-10, 10)
-                new_speed = max(20, min(self.trains[train_id]['max_speed'], 
-                                      self.trains[train_id]['speed'] + speed_change))
-                self.trains[train_id]['speed'] = new_speed
-                self.log_audit('speed_adjustment', {
-                    'train': train_id,
-                    'new_speed': new_speed,
-                    'change': speed_change
-                })
-            
-            # Broadcast event
-            await self.broadcast({'type': 'event', 'payload': {
-                'type': event_type,
-                'timestamp': time.time(),
-                'description': f'{event_type} event occurred'
-            }})
+        
+        elif event_type == 'speed_change' and train_ids:
+            train_id = rng.choice(train_ids)
+            speed_change = rng.randint(-10, 10)
+            new_speed = max(20, min(self.trains[train_id]['max_speed'], 
+                                  self.trains[train_id]['speed'] + speed_change))
+            self.trains[train_id]['speed'] = new_speed
+            self.log_audit('speed_adjustment', {
+                'train': train_id,
+                'new_speed': new_speed,
+                'change': speed_change
+            })
+        
+        elif event_type == 'new_train' and self.trains.routes and len(self.trains) < RANDOM_TRAIN_LIMIT:
+            route = rng.choice(self.trains.routes)
+            self.trigger_event('add_train', {'route': route, 'priority': rng.choice(['high', 'medium', 'low'])})
+        
+        elif event_type == 'maintenance' and self.tracks:
+            # Short unplanned closure, through the scheduler like planned ones
+            self.scheduler.schedule(self.clock.now, 'maintenance', {
+                'block_id': rng.choice(list(self.tracks)),
+                'duration_s': rng.randint(2, 10) * 60
+            })
+        
+        return {
+            'type': event_type,
+            'timestamp': self.clock.time(),
+            'description': f'{event_type} event occurred'
+        }
+
+    def close(self):
+        if self._forecast_pool is not None:
+            self._forecast_pool.shutdown(wait=False)
+        self.audit.close()
+        if self.history is not None:
+            self.history.close()
 
     def log_audit(self, action, payload):
-        entry = { 'ts': time.time(), 'action': action, 'payload': payload }
-        self.audit.append(entry)
-        self.audit = self.audit[-1000:]
+        return self.audit.append(action, payload, self.clock.time())
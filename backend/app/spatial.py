@@ -0,0 +1,73 @@
+import numpy as np
+
+# Cell size in degrees; matches the widest conflict threshold (0.1) so any
+# query up to that radius only has to look at the 3x3 neighbouring cells.
+CELL_SIZE = 0.1
+
+_OFFSET = 1 << 20
+_DX = np.repeat(np.arange(-1, 2), 3)
+_DY = np.tile(np.arange(-1, 2), 3)
+
+
+def _cell_keys(cx, cy):
+    return ((cx + _OFFSET) << 32) | (cy + _OFFSET)
+
+
+class GridIndex:
+    """Uniform grid over a set of points for near-neighbour queries.
+
+    Points are bucketed by cell and sorted by cell key, so building is
+    O(N log N) and a query touches only points in adjacent cells.
+    """
+
+    def __init__(self, points, cell=CELL_SIZE):
+        self.cell = cell
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        cx, cy = self._cells(self.points)
+        keys = _cell_keys(cx, cy)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts, self.counts = np.unique(
+            keys[self.order], return_index=True, return_counts=True)
+
+    def _cells(self, points):
+        c = np.floor(points / self.cell).astype(np.int64)
+        return c[:, 0], c[:, 1]
+
+    def query(self, points, radius):
+        """Return (i, j, dist) for points[i] within ``radius`` of indexed point j.
+
+        Pairs come back ordered by (i, j).
+        """
+        if radius > self.cell:
+            raise ValueError(f'radius {radius} exceeds grid cell size {self.cell}')
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        empty = np.zeros(0, dtype=np.int64)
+        if not len(points) or not len(self.keys):
+            return empty, empty, np.zeros(0)
+        cx, cy = self._cells(points)
+        # Visit query points in cell order so the key lookups below walk the
+        # index mostly forwards, which is far faster for large batches
+        by_cell = np.argsort(_cell_keys(cx, cy), kind='stable')
+        cx, cy = cx[by_cell], cy[by_cell]
+        # All nine neighbour cells of every query point in one batch
+        want = _cell_keys((cx[None, :] + _DX[:, None]).ravel(), (cy[None, :] + _DY[:, None]).ravel())
+        slot = np.minimum(np.searchsorted(self.keys, want), len(self.keys) - 1)
+        hit = np.flatnonzero(self.keys[slot] == want)
+        counts = self.counts[slot[hit]]
+        total = int(counts.sum())
+        if not total:
+            return empty, empty, np.zeros(0)
+        start = np.repeat(self.starts[slot[hit]] - (np.cumsum(counts) - counts), counts)
+        ii = by_cell[np.repeat(hit % len(points), counts)]
+        jj = self.order[np.arange(total) + start]
+        d = np.hypot(points[ii, 0] - self.points[jj, 0], points[ii, 1] - self.points[jj, 1])
+        keep = d < radius
+        ii, jj, d = ii[keep], jj[keep], d[keep]
+        sort = np.lexsort((jj, ii))
+        return ii[sort], jj[sort], d[sort]
+
+    def self_pairs(self, radius):
+        """Distinct pairs (i < j) of indexed points closer than ``radius``"""
+        ii, jj, d = self.query(self.points, radius)
+        keep = ii < jj
+        return ii[keep], jj[keep], d[keep]
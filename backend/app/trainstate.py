@@ -0,0 +1,281 @@
+from collections.abc import MutableMapping
+from typing import Dict, Any, List
+
+import numpy as np
+
+from .routes import RouteGeometry
+
+# Numeric per-train columns, stored as NumPy arrays (structure of arrays)
+COLUMNS = {
+    'idx': np.int64,
+    'speed': np.float64,
+    'max_speed': np.float64,
+    'delay': np.float64,
+    # Kilometres travelled along the route; idx is the last waypoint passed
+    'dist': np.float64,
+}
+
+# Keys held in columns (or derived from them) rather than in per-train metadata
+ARRAY_KEYS = ('id', 'route', 'status') + tuple(COLUMNS)
+
+# Fixed code table: status codes are stored as int8 and shared across processes
+# (checkpoints, shared-memory replicas), so the order must never change
+STATUS_NAMES = ('running', 'stopped', 'emergency_stop', 'held')
+_STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+
+
+class _Column:
+    """Descriptor exposing the live part of a column as a writable view"""
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj._data[self.name][:obj._n]
+
+
+class TrainView(MutableMapping):
+    """Dict-like view of one train backed by the TrainState arrays"""
+    __slots__ = ('_state', '_id')
+
+    def __init__(self, state, train_id):
+        self._state = state
+        self._id = train_id
+
+    def _row(self):
+        return self._state.index[self._id]
+
+    def __getitem__(self, key):
+        st = self._state
+        row = self._row()
+        if key == 'id':
+            return self._id
+        if key in COLUMNS:
+            return st._data[key][row].item()
+        if key == 'status':
+            return STATUS_NAMES[st._data['status'][row]]
+        if key == 'route':
+            return st.routes[st._data['route'][row]]
+        return st.meta[row][key]
+
+    def __setitem__(self, key, value):
+        st = self._state
+        row = self._row()
+        if key == 'id':
+            raise KeyError('train id is immutable')
+        st.touch()
+        if key in COLUMNS:
+            st._data[key][row] = value
+            # Keep the waypoint and the distance along the route in step
+            if key == 'idx':
+                st._data['dist'][row] = st.geometry.distance_at(st._data['route'][row], int(value))
+            elif key == 'dist':
+                st._data['idx'][row] = st.geometry.locate([st._data['route'][row]], [float(value)])[0][0]
+        elif key == 'status':
+            st._data['status'][row] = status_code(value)
+        elif key == 'route':
+            rid = st.intern_route(value)
+            st._data['route'][row] = rid
+            idx = min(int(st._data['idx'][row]), max(0, len(st.routes[rid]) - 1))
+            st._data['idx'][row] = idx
+            st._data['dist'][row] = st.geometry.distance_at(rid, idx)
+            st.structure += 1
+        else:
+            st.meta[row][key] = value
+
+    def __delitem__(self, key):
+        if key in ARRAY_KEYS:
+            raise KeyError(f'cannot delete {key}')
+        self._state.touch()
+        del self._state.meta[self._row()][key]
+
+    def __iter__(self):
+        yield from ARRAY_KEYS
+        yield from self._state.meta[self._row()]
+
+    def __len__(self):
+        return len(ARRAY_KEYS) + len(self._state.meta[self._row()])
+
+    def __repr__(self):
+        return f'TrainView({dict(self)!r})'
+
+
+def status_code(name):
+    try:
+        return _STATUS_CODES[name]
+    except KeyError:
+        raise ValueError(f'unknown train status {name!r}') from None
+
+
+class TrainState(MutableMapping):
+    """Structure-of-arrays train store.
+
+    Maps train id -> TrainView so existing dict-style code keeps working,
+    while the tick engine operates on whole columns at once.
+    """
+    idx = _Column()
+    speed = _Column()
+    max_speed = _Column()
+    delay = _Column()
+    dist = _Column()
+    status = _Column()
+    route = _Column()
+
+    def __init__(self, trains=None, capacity=64):
+        self._n = 0
+        # Bumped on every mutation so derived data (spatial index, conflicts) can be cached
+        self.changes = 0
+        # Bumped when trains are added/removed or rerouted
+        self.structure = 0
+        self._data = {name: np.zeros(capacity, dtype=dt) for name, dt in COLUMNS.items()}
+        self._data['status'] = np.zeros(capacity, dtype=np.int8)
+        self._data['route'] = np.zeros(capacity, dtype=np.int32)
+        self.ids: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.meta: List[Dict[str, Any]] = []
+        # Interned routes; trains on the same path share one entry
+        self.routes: List[List[List[float]]] = []
+        self._route_ids: Dict[tuple, int] = {}
+        # Compiled geometry of the interned routes, one entry per route id
+        self.geometry = RouteGeometry()
+        for train in (trains or {}).values():
+            self[train['id']] = train
+
+    def touch(self):
+        """Mark the state as changed after writing to the columns directly"""
+        self.changes += 1
+
+    # -- routes -----------------------------------------------------------
+    def intern_route(self, route):
+        key = tuple(tuple(p) for p in route)
+        rid = self._route_ids.get(key)
+        if rid is None:
+            rid = len(self.routes)
+            self.routes.append([list(p) for p in route])
+            self._route_ids[key] = rid
+            self.geometry.add(route)
+        return rid
+
+    def _flat_routes(self):
+        flat = self.geometry.flat()
+        return flat['pts'], flat['offs'], flat['lens']
+
+    def route_totals(self):
+        """Length in km of each train's route"""
+        return self.geometry.flat()['total'][self.route]
+
+    def route_lengths(self):
+        """Number of waypoints in each train's route"""
+        _, _, lens = self._flat_routes()
+        return lens[self.route]
+
+    def waypoints(self, idx):
+        """Coordinates of waypoint ``idx[i]`` on train i's route, shape (n, 2)"""
+        pts, offs, _ = self._flat_routes()
+        return pts[offs[self.route] + idx]
+
+    def locate(self, dist, heading=False):
+        """(idx, points[, heading]) of every train were it ``dist[i]`` km along its route"""
+        return self.geometry.locate(self.route, dist, heading)
+
+    def positions(self):
+        """Current coordinates, interpolated between waypoints"""
+        return self.locate(self.dist)[1]
+
+    # -- mapping interface ------------------------------------------------
+    def __getitem__(self, train_id):
+        if train_id not in self.index:
+            raise KeyError(train_id)
+        return TrainView(self, train_id)
+
+    def __setitem__(self, train_id, train):
+        if train_id in self.index:
+            del self[train_id]
+        self.touch()
+        self.structure += 1
+        if self._n == len(self._data['idx']):
+            for name, arr in self._data.items():
+                self._data[name] = np.concatenate([arr, np.zeros_like(arr)])
+        row = self._n
+        self._n += 1
+        self.ids.append(train_id)
+        self.index[train_id] = row
+        self.meta.append({k: v for k, v in train.items() if k not in ARRAY_KEYS})
+        for name in COLUMNS:
+            self._data[name][row] = train.get(name, 0)
+        self._data['status'][row] = status_code(train.get('status', 'running'))
+        rid = self.intern_route(train['route'])
+        self._data['route'][row] = rid
+        if 'dist' in train:
+            self._data['idx'][row] = self.geometry.locate([rid], [train['dist']])[0][0]
+        else:
+            self._data['dist'][row] = self.geometry.distance_at(rid, int(self._data['idx'][row]))
+
+    def __delitem__(self, train_id):
+        row = self.index.pop(train_id)
+        self.touch()
+        self.structure += 1
+        last = self._n - 1
+        if row != last:
+            # Swap the last row into the hole to keep columns dense
+            for arr in self._data.values():
+                arr[row] = arr[last]
+            moved = self.ids[last]
+            self.ids[row] = moved
+            self.meta[row] = self.meta[last]
+            self.index[moved] = row
+        self.ids.pop()
+        self.meta.pop()
+        self._n = last
+
+    def __iter__(self):
+        return iter(list(self.ids))
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, train_id):
+        return train_id in self.index
+
+    def copy(self):
+        """Independent copy of the train state; interned routes are shared"""
+        twin = TrainState(capacity=max(1, self._n))
+        twin._n = self._n
+        twin.changes = self.changes
+        twin.structure = self.structure
+        twin._data = {name: arr[:max(1, self._n)].copy() for name, arr in self._data.items()}
+        twin.ids = list(self.ids)
+        twin.index = dict(self.index)
+        twin.meta = [dict(m) for m in self.meta]
+        twin.routes = list(self.routes)
+        twin._route_ids = dict(self._route_ids)
+        twin.geometry = self.geometry.copy()
+        return twin
+
+    def load(self, ids, meta, routes, columns, geometry=None):
+        """Replace every train at once from per-train ``meta`` and column arrays.
+
+        ``columns`` holds the COLUMNS plus 'status' and 'route' (indexes into
+        ``routes``); used to mirror a state published by another process and
+        to restore checkpoints. ``geometry`` may pass the routes already compiled.
+        """
+        n = len(ids)
+        for name, arr in list(self._data.items()):
+            self._data[name] = np.zeros(max(1, n), dtype=arr.dtype)
+            self._data[name][:n] = columns[name][:n]
+        self._n = n
+        self.ids = list(ids)
+        self.index = {t: row for row, t in enumerate(self.ids)}
+        self.meta = [dict(m) for m in meta]
+        # Routes are never modified in place, so the waypoint lists can be shared
+        self.routes = list(routes)
+        self._route_ids = {tuple(map(tuple, r)): rid for rid, r in enumerate(self.routes)}
+        self.geometry = geometry or RouteGeometry.from_routes(self.routes)
+        self.touch()
+        self.structure += 1
+
+    def to_list(self):
+        """Plain-dict copies of every train, for JSON responses"""
+        return [dict(TrainView(self, i)) for i in self.ids]
+
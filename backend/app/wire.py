@@ -0,0 +1,102 @@
+import json
+import struct
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from .metrics import ENCODE_SECONDS
+
+try:
+    import msgpack
+except ImportError:  # optional; 'msgpack' is simply not offered without it
+    msgpack = None
+
+JSON, MSGPACK, PACKED = 'json', 'msgpack', 'packed'
+
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+
+# Packed positions frame: header followed by float32 rows of
+# (train index, lat, lon, speed). Train indexes refer to the latest
+# 'train_ids' dictionary; a row with NaN lat/lon removes that train.
+PACKED_MAGIC = b'TPOS'
+PACKED_VERSION = 1
+KIND_KEYFRAME, KIND_DELTA = 0, 1
+_HEADER = struct.Struct('<4sBBHII')  # magic, version, kind, reserved, seq, count
+
+
+def available_formats():
+    formats = [JSON, PACKED]
+    if msgpack is not None:
+        formats.insert(1, MSGPACK)
+    return formats
+
+
+def negotiate(requested: Optional[str], accept: Optional[str] = None) -> str:
+    """Pick a wire format from an explicit request or an Accept header, defaulting to JSON"""
+    if requested is None and accept and MSGPACK_MEDIA_TYPE in accept:
+        requested = MSGPACK
+    if requested in available_formats():
+        return requested
+    return JSON
+
+
+def pack_positions(kind, seq, rows, pos, speed, removed=()):
+    n, m = len(rows), len(removed)
+    arr = np.empty((n + m, 4), dtype='<f4')
+    arr[:n, 0] = rows
+    arr[:n, 1:3] = pos
+    arr[:n, 3] = speed
+    arr[n:, 0] = removed
+    arr[n:, 1:] = np.nan
+    return _HEADER.pack(PACKED_MAGIC, PACKED_VERSION, kind, 0, seq, n + m) + arr.tobytes()
+
+
+def unpack_positions(data: bytes):
+    """Inverse of pack_positions: (kind, seq, float32 array of shape (count, 4))"""
+    magic, version, kind, _, seq, count = _HEADER.unpack_from(data)
+    if magic != PACKED_MAGIC or version != PACKED_VERSION:
+        raise ValueError('not a packed positions frame')
+    arr = np.frombuffer(data, dtype='<f4', count=count * 4, offset=_HEADER.size)
+    return kind, seq, arr.reshape(count, 4)
+
+
+def encode(msg: Dict[str, Any], fmt: str):
+    if fmt == MSGPACK:
+        return msgpack.packb(msg)
+    return json.dumps(msg)
+
+
+class Frame:
+    """One outgoing message, encoded lazily and at most once per wire format.
+
+    ``msg`` may be a dict or a zero-argument callable building it, so the
+    dict is never built when every recipient takes the packed encoding.
+    Position frames also carry ``packed`` (kind, seq, rows, pos, speed,
+    removed rows) for the binary layout; other frames go out as JSON text
+    to packed clients.
+    """
+    __slots__ = ('_msg', 'packed', '_enc')
+
+    def __init__(self, msg, packed=None):
+        self._msg = msg
+        self.packed = packed
+        self._enc: Dict[str, Any] = {}
+
+    @property
+    def msg(self):
+        if callable(self._msg):
+            self._msg = self._msg()
+        return self._msg
+
+    def encode(self, fmt: str):
+        data = self._enc.get(fmt)
+        if data is None:
+            started = time.perf_counter()
+            if fmt == PACKED:
+                data = pack_positions(*self.packed) if self.packed else self.encode(JSON)
+            else:
+                data = encode(self.msg, fmt)
+            ENCODE_SECONDS.observe(time.perf_counter() - started, fmt)
+            self._enc[fmt] = data
+        return data
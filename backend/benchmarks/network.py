@@ -0,0 +1,65 @@
+"""Seeded synthetic networks for the benchmarks, in the app.network JSON Lines layout.
+
+Blocks of LINE_BLOCKS run end to end along parallel east-west lines;
+each line carries a handful of routes over parts of it, and trains are
+spread over the routes at random distances, so the same arguments always
+give the same network.
+"""
+import json
+import math
+import random
+
+from app.network import load
+
+# Blocks per line, each one waypoint step long
+LINE_BLOCKS = 100
+STEP_DEG = 0.1
+LINE_SPACING_DEG = 0.05
+ROUTES_PER_LINE = 8
+# Lines per dispatcher section
+SECTION_LINES = 10
+ORIGIN = (8.0, -150.0)
+
+
+def records(trains, blocks, seed=1):
+    """JSON-ready records for ``trains`` trains on ``blocks`` blocks, rounded up to whole lines"""
+    rng = random.Random(seed)
+    lines = max(1, math.ceil(blocks / LINE_BLOCKS))
+    lat0, lon0 = ORIGIN
+    lengths = []
+    for line in range(lines):
+        lat = round(lat0 + line * LINE_SPACING_DEG, 4)
+        for b in range(LINE_BLOCKS):
+            yield {'kind': 'block', 'id': f'L{line}B{b}',
+                   'from': [lat, round(lon0 + b * STEP_DEG, 4)], 'to': [lat, round(lon0 + (b + 1) * STEP_DEG, 4)],
+                   'capacity': 1, 'speed_limit': rng.choice((80.0, 100.0, 120.0))}
+        step_km = 111.32 * math.cos(math.radians(lat)) * STEP_DEG
+        for r in range(ROUTES_PER_LINE):
+            start = rng.randrange(LINE_BLOCKS // 2)
+            end = rng.randrange(start + LINE_BLOCKS // 4, LINE_BLOCKS + 1)
+            lengths.append((end - start) * step_km)
+            yield {'kind': 'route', 'id': f'L{line}R{r}',
+                   'points': [[lat, round(lon0 + i * STEP_DEG, 4)] for i in range(start, end + 1)]}
+    for s in range(0, lines, SECTION_LINES):
+        yield {'kind': 'section', 'id': f'S{s // SECTION_LINES}', 'name': f'Lines {s}-{s + SECTION_LINES - 1}',
+               'bounds': [[lat0 + s * LINE_SPACING_DEG - 0.01, lon0 - 0.01],
+                          [lat0 + (s + SECTION_LINES) * LINE_SPACING_DEG, lon0 + LINE_BLOCKS * STEP_DEG + 0.01]]}
+    for t in range(trains):
+        route = rng.randrange(len(lengths))
+        yield {'kind': 'train', 'id': f'T{t}', 'route_id': f'L{route // ROUTES_PER_LINE}R{route % ROUTES_PER_LINE}',
+               'priority': rng.choice(('high', 'medium', 'medium', 'low')),
+               'speed': rng.uniform(30, 60), 'max_speed': rng.choice((60.0, 80.0, 100.0)),
+               'dist': round(rng.uniform(0, 0.6) * lengths[route], 3)}
+
+
+def write(path, trains, blocks, seed=1):
+    """Write the network to ``path`` as JSON Lines; returns the path"""
+    with open(path, 'w') as f:
+        for record in records(trains, blocks, seed):
+            f.write(json.dumps(record) + '\n')
+    return path
+
+
+def build(path, trains, blocks, seed=1):
+    """Write the network to ``path`` and import it (an app.network.Network)"""
+    return load(write(path, trains, blocks, seed))
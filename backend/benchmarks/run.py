@@ -0,0 +1,337 @@
+"""Scaling benchmarks for the simulator, the WebSocket fan-out and the API.
+
+Run from ``backend/``::
+
+    python -m benchmarks.run [--quick] [--suite headless|tick|clients|http ...] [--out results.jsonl]
+
+Every case runs on a seeded synthetic network (benchmarks.network), so
+repeated runs on one machine measure the same work. Suites:
+
+* ``headless``: the built-in demo network replayed flat out with
+  ``run_headless``, as /api/simulate and the scenario workers run it;
+  ticks per second and the wall time a simulated day would take.
+* ``tick``: headless DemoSimulator ticks over a grid of train and block
+  counts; wall time per tick and the mean of each phase as recorded by
+  the simulator's own instrumentation (``sim_tick_phase_seconds``).
+* ``clients``: one network fanned out to N in-process WebSocket clients
+  per wire format; broadcast and drain time per tick and queue-to-socket
+  latency (``sim_ws_send_seconds``).
+* ``http``: the FastAPI app driven in-process (starlette TestClient):
+  network import, latency of the main read endpoints (client side and
+  ``http_request_seconds``), then live ``/ws/sim`` clients.
+
+Results are JSON lines, the first describing the environment. Histogram
+quantiles are bucket upper bounds, as a Prometheus scrape would give.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from app.clock import TICK_SECONDS
+from app.simulator import DemoSimulator
+from app.wire import available_formats
+from . import network
+
+QUICK = {
+    'headless': {'duration_s': 600.0},
+    'tick': {'trains': (500, 2000), 'blocks': (1000, 5000), 'ticks': 10},
+    'clients': {'trains': 1000, 'blocks': 2000, 'clients': (1, 10, 100), 'ticks': 10},
+    'http': {'trains': (500,), 'blocks': 1000, 'requests': 20, 'clients': (1, 5), 'frames': 5},
+}
+FULL = {
+    'headless': {'duration_s': 3600.0},
+    'tick': {'trains': (1000, 5000, 20000), 'blocks': (5000, 20000, 50000), 'ticks': 30},
+    'clients': {'trains': 5000, 'blocks': 10000, 'clients': (1, 10, 100, 1000), 'ticks': 20},
+    'http': {'trains': (1000, 10000), 'blocks': 10000, 'requests': 100, 'clients': (1, 10, 50), 'frames': 10},
+}
+# Ticks run before measuring, so first-use caches are built
+WARMUP_TICKS = 3
+ENDPOINTS = ('/api/health', '/api/kpis', '/api/trains', '/api/tracks', '/api/system/status',
+             '/api/conflicts/forecast', '/api/routes', '/api/metrics')
+# Simulated seconds per wall second while timing live /ws/sim clients
+LIVE_RATE = 20.0
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'suite': 'environment', 'python': platform.python_version(), 'platform': platform.platform(),
+            'machine': platform.machine(), 'cpus': os.cpu_count(), 'numpy': np.__version__,
+            'formats': list(available_formats()), 'commit': commit,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def summary(samples):
+    """Median, 95th percentile and maximum of wall-time samples, in ms"""
+    if not samples:
+        return {'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+    ordered = sorted(samples)
+    return {'p50_ms': ms(statistics.median(ordered)), 'p95_ms': ms(ordered[int(0.95 * (len(ordered) - 1))]),
+            'max_ms': ms(ordered[-1])}
+
+
+def snapshot(family):
+    """Copy of a histogram family's counts and sums, to diff against later"""
+    return {k: (list(c.counts), c.sum, c.count) for k, c in family.children.items()}
+
+
+def since(family, before):
+    """Per-label (bucket counts, sum, count) observed since ``before``"""
+    out = {}
+    for k, c in family.children.items():
+        counts, total, n = before.get(k, ([0] * len(c.counts), 0.0, 0))
+        out[k] = ([a - b for a, b in zip(c.counts, counts)], c.sum - total, c.count - n)
+    return out
+
+
+def quantile(bounds, counts, q):
+    """Upper bound (s) of the bucket holding the ``q`` quantile; None when empty or past the last bound"""
+    n = sum(counts)
+    if not n:
+        return None
+    rank, seen = q * n, 0
+    for bound, count in zip(bounds, counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+
+def histogram_summary(family, before, label=()):
+    counts, total, n = since(family, before).get(label, ([], 0.0, 0))
+    p50, p95 = quantile(family.buckets, counts, 0.5), quantile(family.buckets, counts, 0.95)
+    return {'count': n, 'mean_ms': ms(total / n) if n else None,
+            'p50_le_ms': ms(p50) if p50 is not None else None, 'p95_le_ms': ms(p95) if p95 is not None else None}
+
+
+def simulator(workdir, trains, blocks, seed):
+    """Headless simulator on a fresh synthetic network, plus its import time"""
+    started = time.perf_counter()
+    net = network.build(os.path.join(workdir, f'net-{trains}-{blocks}.jsonl'), trains, blocks, seed)
+    load_s = time.perf_counter() - started
+    sim = DemoSimulator(seed=seed, autostart=False, history_dir=os.path.join(workdir, f'history-{trains}-{blocks}'))
+    sim.load_network(net)
+    return sim, load_s
+
+
+def bench_headless(grid, seed, workdir):
+    sim = DemoSimulator(seed=seed, autostart=False, history_dir=os.path.join(workdir, 'history-demo'))
+    sim.run_headless(WARMUP_TICKS)
+    started = time.perf_counter()
+    ticks = sim.run_headless(grid['duration_s'])
+    wall = time.perf_counter() - started
+    yield {'suite': 'headless', 'trains': len(sim.trains), 'blocks': len(sim.tracks), 'ticks': ticks,
+           'wall_s': round(wall, 3), 'ticks_per_s': round(ticks / wall, 1),
+           'day_s': round(wall * 86400.0 / grid['duration_s'], 1)}
+    sim.close()
+
+
+def bench_tick(grid, seed, workdir):
+    for blocks in grid['blocks']:
+        for trains in grid['trains']:
+            sim, load_s = simulator(workdir, trains, blocks, seed)
+            sim.run_headless(WARMUP_TICKS)
+            phases = sim.metrics.families['sim_tick_phase_seconds']
+            before = snapshot(phases)
+            samples = []
+            for _ in range(grid['ticks']):
+                started = time.perf_counter()
+                sim.advance()
+                samples.append(time.perf_counter() - started)
+            spent = since(phases, before)
+            yield {'suite': 'tick', 'trains': trains, 'blocks': len(sim.tracks), 'ticks': len(samples),
+                   'import_ms': ms(load_s), **summary(samples),
+                   'ticks_per_s': round(len(samples) / sum(samples), 2),
+                   'phase_mean_ms': {k[0]: ms(total / n) for k, (_, total, n) in spent.items() if n},
+                   'conflict_events': sim.stats['conflict_events']}
+            sim.close()
+
+
+class NullSocket:
+    """Stands in for a WebSocket: counts what would be written, never blocks"""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_text(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+    async def send_bytes(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+
+async def fan_out(sim, n_clients, fmt, ticks):
+    sockets = [NullSocket() for _ in range(n_clients)]
+    clients = []
+    for ws in sockets:
+        client = sim.register_client(ws)
+        client.format = fmt
+        sim.send_keyframe(client)
+        clients.append(client)
+
+    async def drain():
+        while any(c.queue for c in clients):
+            await asyncio.sleep(0)
+    await drain()
+    sent_before = sum(ws.bytes for ws in sockets)
+    send = sim.metrics.families['sim_ws_send_seconds']
+    before = snapshot(send)
+    broadcast, drained = [], []
+    for _ in range(ticks):
+        messages = sim.advance()
+        started = time.perf_counter()
+        await sim.broadcast_state()
+        for msg in messages:
+            await sim.broadcast(msg)
+        queued = time.perf_counter()
+        await drain()
+        broadcast.append(queued - started)
+        drained.append(time.perf_counter() - queued)
+    for client in clients:
+        sim.unregister_client(client)
+    return {'broadcast': summary(broadcast), 'drain': summary(drained),
+            'send_latency': histogram_summary(send, before, (fmt,)),
+            'bytes_per_client_tick': round((sum(ws.bytes for ws in sockets) - sent_before) / n_clients / ticks),
+            'dropped': sum(c.dropped for c in clients)}
+
+
+def bench_clients(grid, seed, workdir):
+    sim, _ = simulator(workdir, grid['trains'], grid['blocks'], seed)
+    sim.run_headless(WARMUP_TICKS)
+    for fmt in available_formats():
+        for n in grid['clients']:
+            result = asyncio.run(fan_out(sim, n, fmt, grid['ticks']))
+            yield {'suite': 'clients', 'trains': grid['trains'], 'blocks': len(sim.tracks), 'clients': n,
+                   'format': fmt, 'ticks': grid['ticks'], **result}
+    sim.close()
+
+
+def bench_http(grid, seed, workdir):
+    # Settings are read when app.main is imported: no checkpoints, audit log in the work dir
+    os.environ.update({'CHECKPOINT_DIR': '', 'NETWORK_PATH': '', 'SIM_MODE': 'local', 'SIM_PARTITIONS': '1',
+                       'AUDIT_LOG_PATH': os.path.join(workdir, 'audit.jsonl'),
+                       'HISTORY_DIR': os.path.join(workdir, 'history-http')})
+    from fastapi.testclient import TestClient
+    from app import main
+    from app.metrics import HTTP_SECONDS
+
+    with TestClient(main.app) as http:
+        for trains in grid['trains']:
+            path = network.write(os.path.join(workdir, f'http-{trains}.jsonl'), trains, grid['blocks'], seed)
+            started = time.perf_counter()
+            with open(path, 'rb') as f:
+                imported = http.post('/api/network/import', content=f.read()).json()
+            yield {'suite': 'http', 'case': 'import', 'trains': trains, 'blocks': grid['blocks'],
+                   'ms': ms(time.perf_counter() - started), 'status': imported.get('status', imported.get('error'))}
+            for endpoint in ENDPOINTS:
+                before = snapshot(HTTP_SECONDS)
+                samples, size = [], 0
+                for _ in range(grid['requests']):
+                    started = time.perf_counter()
+                    r = http.get(endpoint)
+                    samples.append(time.perf_counter() - started)
+                    size = len(r.content)
+                server = [v for k, v in since(HTTP_SECONDS, before).items() if k[1] == endpoint and v[2]]
+                yield {'suite': 'http', 'case': 'get', 'endpoint': endpoint, 'trains': trains,
+                       'status': r.status_code, 'bytes': size, **summary(samples),
+                       'server_mean_ms': ms(sum(v[1] for v in server) / sum(v[2] for v in server)) if server else None}
+            etag = http.get('/api/kpis').headers.get('etag')
+            samples = []
+            for _ in range(grid['requests']):
+                started = time.perf_counter()
+                r = http.get('/api/kpis', headers={'If-None-Match': etag})
+                samples.append(time.perf_counter() - started)
+            yield {'suite': 'http', 'case': 'get', 'endpoint': '/api/kpis (If-None-Match)', 'trains': trains,
+                   'status': r.status_code, **summary(samples)}
+            yield from live_clients(http, main.sim, grid, trains)
+
+
+def live_clients(http, sim, grid, trains):
+    """Connect N /ws/sim clients and read frames while the loop runs at LIVE_RATE"""
+    rate = sim.clock.rate
+    sim.clock.rate = LIVE_RATE
+    # The tick already sleeping was paced at the old rate
+    time.sleep(TICK_SECONDS / rate if rate else 0)
+    send = sim.metrics.families['sim_ws_send_seconds']
+    fan = sim.metrics.families['sim_broadcast_seconds']
+    try:
+        for n in grid['clients']:
+            sockets, connect = [], []
+            try:
+                for _ in range(n):
+                    started = time.perf_counter()
+                    ws = http.websocket_connect('/ws/sim').__enter__()
+                    ws.receive()
+                    connect.append(time.perf_counter() - started)
+                    sockets.append(ws)
+                before, fan_before = snapshot(send), snapshot(fan)
+                started = time.perf_counter()
+                frames = 0
+                for _ in range(grid['frames']):
+                    for ws in sockets:
+                        ws.receive()
+                        frames += 1
+                elapsed = time.perf_counter() - started
+            finally:
+                for ws in sockets:
+                    ws.__exit__(None, None, None)
+            yield {'suite': 'http', 'case': 'websocket', 'trains': trains, 'clients': n,
+                   'connect': summary(connect), 'frames_per_s': round(frames / elapsed, 1),
+                   'send_latency': histogram_summary(send, before, ('json',)),
+                   'broadcast': histogram_summary(fan, fan_before)}
+    finally:
+        sim.clock.rate = rate
+
+
+SUITES = {'headless': bench_headless, 'tick': bench_tick, 'clients': bench_clients, 'http': bench_http}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true', help='small grids, for a smoke run')
+    parser.add_argument('--suite', action='append', choices=sorted(SUITES), help='suites to run (default: all)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='also append results to this file')
+    args = parser.parse_args(argv)
+    grids = QUICK if args.quick else FULL
+    out = open(args.out, 'a') if args.out else None
+
+    def emit(result):
+        line = json.dumps(result)
+        print(line, flush=True)
+        if out is not None:
+            out.write(line + '\n')
+            out.flush()
+    try:
+        emit(dict(environment(), quick=args.quick, seed=args.seed))
+        with tempfile.TemporaryDirectory(prefix='train-bench-') as workdir:
+            for name in args.suite or SUITES:
+                for result in SUITES[name](grids[name], args.seed, workdir):
+                    emit(result)
+    finally:
+        if out is not None:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+import os
+
+# The app builds its simulator on import; keep it off disk
+os.environ.setdefault('CHECKPOINT_DIR', '')
+os.environ.setdefault('AUDIT_LOG_PATH', '')
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import main  # noqa: E402
+from app.wire import MSGPACK, available_formats  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    # No lifespan: the tick loop stays stopped and tests advance the simulator themselves
+    return TestClient(main.app)
+
+
+def test_malformed_events_get_a_400(client):
+    before = len(main.sim.scheduler)
+    r = client.post('/api/events', json={'events': [{'type': 'delay', 'data': {'train_id': 'T1'}},
+                                                    {'type': 'delay', 'data': {'minutes': 'abc'}}]})
+    assert r.status_code == 400
+    assert r.json()['error'].startswith('Event 1:')
+    assert len(main.sim.scheduler) == before
+
+
+@pytest.mark.parametrize('path', ['/api/trains', '/api/tracks', '/api/kpis', '/api/system/status'])
+def test_unchanged_state_gets_a_304(client, path):
+    first = client.get(path)
+    assert first.status_code == 200
+    etag = first.headers['etag']
+    again = client.get(path, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.headers['etag'] == etag
+    assert not again.content
+    main.sim.advance()
+    fresh = client.get(path, headers={'If-None-Match': etag})
+    assert fresh.status_code == 200
+    assert fresh.headers['etag'] != etag
+    assert fresh.json()
+
+
+@pytest.mark.skipif(MSGPACK not in available_formats(), reason='msgpack is not installed')
+def test_etag_depends_on_the_format(client):
+    etag = client.get('/api/system/status').headers['etag']
+    packed = client.get('/api/system/status?format=msgpack', headers={'If-None-Match': etag})
+    assert packed.status_code == 200
+    assert packed.headers['etag'] != etag
@@ -0,0 +1,57 @@
+import json
+import threading
+import time
+
+from app import audit
+from app.audit import AuditLog, AuditWriter
+
+
+def test_entries_are_persisted_as_they_were_appended(tmp_path):
+    path = tmp_path / 'audit.jsonl'
+    audit = AuditLog(path=str(path))
+    payload = {'train_id': 'T1', 'minutes': 1}
+    audit.append('hold', payload, 0.0)
+    # The simulator keeps working on the dicts it logged
+    payload['minutes'] = 99
+    audit.close()
+    lines = path.read_text().splitlines()
+    assert [json.loads(line)['payload'] for line in lines] == [{'train_id': 'T1', 'minutes': 1}]
+
+
+def test_writer_survives_failed_writes(tmp_path):
+    # A directory cannot be opened for appending
+    writer = AuditWriter(str(tmp_path))
+    writer.put({'seq': 0, 'action': 'hold', 'payload': {}})
+    writer.put({'seq': 1, 'action': 'hold', 'payload': {}})
+    writer.close()
+    assert not writer.thread.is_alive()
+    assert writer.failed == 2 and writer.written == 0
+
+
+def test_put_never_blocks_and_counts_drops(tmp_path):
+    class Stalled(AuditWriter):
+        release = threading.Event()
+
+        def _run(self):
+            self.release.wait()
+            super()._run()
+    writer = Stalled(str(tmp_path / 'audit.jsonl'), backlog=2)
+    started = time.perf_counter()
+    for seq in range(5):
+        writer.put({'seq': seq, 'action': 'hold', 'payload': {}})
+    assert time.perf_counter() - started < 0.5
+    assert writer.dropped == 3
+    Stalled.release.set()
+    writer.close()
+    assert writer.written == 2
+
+
+def test_startup_loads_only_the_tail(tmp_path, monkeypatch):
+    monkeypatch.setattr(audit, 'TAIL_CHUNK', 64)
+    path = tmp_path / 'audit.jsonl'
+    path.write_text(''.join(json.dumps({'seq': seq, 'ts': seq, 'action': 'hold', 'payload': {'train_id': f'T{seq}'}})
+                            + '\n' for seq in range(500)))
+    log = AuditLog(capacity=10, path=str(path))
+    assert [e['payload']['train_id'] for e in log] == [f'T{seq}' for seq in range(490, 500)]
+    assert log.append('hold', {}, 0.0)['seq'] == 500
+    log.close()
@@ -0,0 +1,26 @@
+from app.broadcast import FrameBuilder
+from app.simulator import DemoSimulator
+
+
+def _routes(frames):
+    return [f.msg['payload'] for f in frames if f.msg['type'] == 'routes']
+
+
+def test_keyframe_routes_are_not_resent_on_the_first_tick():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    view = FrameBuilder()
+    assert len(_routes(view.keyframe(sim))[0]) == len(sim.trains.routes)
+    assert _routes(view.position_frames(sim)) == []
+    sim.close()
+
+
+def test_new_routes_still_reach_clients_following_the_view():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    view = FrameBuilder()
+    view.keyframe(sim)
+    view.position_frames(sim)
+    sim.trigger_event('add_train', {'route': [[21.0, 77.0], [21.0, 77.5]]})
+    # A client joining now gets a keyframe; the others only see the tick's frames
+    view.keyframe(sim)
+    assert list(_routes(view.position_frames(sim))[0]) == [len(sim.trains.routes) - 1]
+    sim.close()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from app import checkpoint
+from app.checkpoint import Checkpointer, read, restore_latest
+from app.simulator import DemoSimulator
+
+
+def busy_sim():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    sim.forecast_interval = None
+    sim.run_headless(30)
+    sim.occupancy.close(sim.occupancy.block_ids[0])
+    sim.hold('T1', 60.0)
+    sim.schedule_events([{'type': 'delay', 'in_s': 120, 'data': {'train_id': 'T2', 'minutes': 2}}])
+    return sim
+
+
+def test_restore_resumes_the_saved_state(tmp_path):
+    sim = busy_sim()
+    twin = DemoSimulator(seed=7, autostart=False, history_dir=None)
+    twin.forecast_interval = None
+    try:
+        Checkpointer(sim, str(tmp_path)).save()
+        assert restore_latest(twin, str(tmp_path))
+        a, b = sim.trains, twin.trains
+        assert a.ids == b.ids
+        for name in ('dist', 'speed', 'delay', 'idx', 'route', 'status'):
+            assert np.array_equal(getattr(a, name), getattr(b, name)), name
+        assert a.routes == b.routes
+        assert twin.tracks == sim.tracks
+        assert twin.occupancy.closed == sim.occupancy.closed
+        assert twin.scheduler.state() == sim.scheduler.state()
+        assert twin.holds == sim.holds
+        assert (twin.clock.now, twin.clock.epoch) == (sim.clock.now, sim.clock.epoch)
+        # Both carry on identically, scheduled delay and random events included
+        sim.run_headless(180)
+        twin.run_headless(180)
+        assert np.array_equal(sim.trains.dist, twin.trains.dist)
+        assert np.array_equal(sim.trains.delay, twin.trains.delay)
+        assert twin.tracks == sim.tracks
+    finally:
+        twin.close()
+        sim.close()
+
+
+def test_truncated_checkpoint_is_rejected(tmp_path):
+    sim = busy_sim()
+    try:
+        writer = Checkpointer(sim, str(tmp_path))
+        good = writer.save()
+        sim.run_headless(10)
+        bad = writer.save()
+        with open(bad, 'r+b') as f:
+            f.truncate(f.seek(0, 2) // 2)
+        with pytest.raises(ValueError):
+            read(bad)
+        twin = DemoSimulator(seed=7, autostart=False, history_dir=None)
+        try:
+            assert restore_latest(twin, str(tmp_path)) == good
+        finally:
+            twin.close()
+    finally:
+        sim.close()
+
+
+def test_other_format_version_is_rejected(tmp_path, monkeypatch):
+    sim = busy_sim()
+    try:
+        monkeypatch.setattr(checkpoint, '_MAGIC', b'TCKPT000')
+        path = Checkpointer(sim, str(tmp_path)).save()
+        monkeypatch.undo()
+        with pytest.raises(ValueError, match='format 000'):
+            read(path)
+        assert restore_latest(sim, str(tmp_path)) is None
+    finally:
+        sim.close()
@@ -0,0 +1,38 @@
+import asyncio
+
+from app.simulator import DemoSimulator
+
+
+def submit(sim, commands):
+    async def run():
+        future = asyncio.get_running_loop().create_future()
+        sim.command_queue.submit(commands, future)
+        sim.advance()
+        return await asyncio.wait_for(future, 1.0)
+    return asyncio.run(run())
+
+
+def test_add_train_rejects_bad_fields_without_adding_a_row():
+    sim = DemoSimulator(seed=1, autostart=False)
+    before = len(sim.trains)
+    for data in ({'speed': 'fast'}, {'max_speed': -5}, {'priority': 'urgent'}, {'status': 'flying'},
+                 {'idx': 99}, {'colour': 'red'}, {'route': [['a', 'b'], [1, 2]]}):
+        result = sim.trigger_event('add_train', data)
+        assert 'error' in result, data
+    assert len(sim.trains) == before
+    ok = sim.trigger_event('add_train', {'speed': 30, 'passengers': 10.0, 'label': 'X'})
+    assert ok['status'] == 'success' and ok['train']['speed'] == 30.0 and ok['train']['passengers'] == 10
+
+
+def test_failing_command_resolves_its_future_and_the_tick_carries_on():
+    sim = DemoSimulator(seed=1, autostart=False)
+    sim.control_train = lambda *a, **k: 1 / 0
+    results = submit(sim, [{'action': 'stop', 'train_id': 'T1'},
+                           {'action': 'add_train', 'data': {'speed': 'fast'}},
+                           {'action': 'add_train', 'data': {}}])
+    assert results[0]['error'].startswith('Command failed: ZeroDivisionError')
+    assert 'error' in results[1]
+    assert results[2]['status'] == 'success'
+    ticks = sim.stats['ticks']
+    sim.run_headless(5)
+    assert sim.stats['ticks'] == ticks + 5
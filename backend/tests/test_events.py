@@ -0,0 +1,54 @@
+import pickle
+
+import pytest
+
+from app.events import EventScheduler, check
+from app.simulator import DemoSimulator
+
+
+def test_copy_and_state_do_not_consume_sequence_numbers():
+    scheduler = EventScheduler()
+    scheduler.schedule(10.0, 'delay')
+    twin = scheduler.copy()
+    assert scheduler.state()['next_seq'] == 1
+    assert scheduler.schedule(20.0, 'delay')['id'] == 'E1'
+    assert twin.schedule(20.0, 'delay')['id'] == 'E1'
+    restored = EventScheduler.from_state(pickle.loads(pickle.dumps(scheduler.state())))
+    assert restored.schedule(30.0, 'delay')['id'] == 'E2'
+    assert [e['id'] for e in restored.due(30.0)] == ['E0', 'E1', 'E2']
+
+
+BAD_EVENTS = [
+    {'type': 'delay', 'data': {'train_id': 'T1', 'minutes': 'abc'}},
+    {'type': 'delay', 'data': {'minutes': 5}},
+    {'type': 'maintenance', 'data': {'block_id': 'B1', 'duration_s': 'x'}},
+    {'type': 'speed_restriction', 'data': {'max_speed': 'fast'}},
+    {'type': 'speed_restriction', 'data': {'train_ids': 5}},
+    {'type': 'speed_restriction', 'data': {'section_id': ['x']}},
+    {'type': 'speed_restriction', 'data': {'duration_s': float('inf')}},
+    {'type': 'stop', 'data': {'train_id': ['T1']}},
+    {'type': 'delay', 'in_s': 'soon', 'data': {'train_id': 'T1'}},
+    {'type': 'delay', 'data': 'T1'},
+]
+
+
+@pytest.mark.parametrize('spec', BAD_EVENTS)
+def test_malformed_events_are_refused_when_scheduled(spec):
+    assert check([spec]) is not None
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    assert 'error' in sim.schedule_events([spec])[0]
+    assert len(sim.scheduler) == 0
+    sim.close()
+
+
+def test_event_failing_when_due_is_dropped_and_the_tick_carries_on():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    # Events restored from older checkpoints never went through event_spec
+    for spec in BAD_EVENTS[:6]:
+        sim.scheduler.schedule(sim.clock.now, spec['type'], spec['data'])
+    good = sim.schedule_events([{'type': 'speed_restriction', 'data': {'train_ids': ['T1'], 'max_speed': 20}}])
+    assert 'error' not in good[0]
+    sim.run_headless(2)
+    assert len(sim.scheduler) == 1  # the restriction's end
+    assert sim.trains['T1']['max_speed'] == 20
+    sim.close()
@@ -0,0 +1,50 @@
+import numpy as np
+
+from app.simulator import FORECAST_TOP, DemoSimulator
+
+
+def test_background_forecast_matches_the_inline_one():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    sim.forecast_in_background = True
+    try:
+        while sim._forecast_job is None:
+            assert all(m['type'] != 'forecast' for m in sim.advance())
+        # The job projects the state it was started on
+        expected = sim.forecast_conflicts(limit=FORECAST_TOP)
+        sim._forecast_job.result(timeout=30)
+        published = [m['payload'] for m in sim.advance() if m['type'] == 'forecast']
+        assert len(published) == 1
+        assert published[0]['now'] == expected['now']
+        assert published[0]['total'] == expected['total']
+        assert published[0]['conflicts'] == expected['conflicts']
+        assert sim._forecast_job is None
+    finally:
+        sim.close()
+
+
+def test_headless_forecast_runs_inline():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    try:
+        messages = []
+        for _ in range(int(sim.forecast_interval) + 1):
+            messages += sim.advance()
+        assert any(m['type'] == 'forecast' for m in messages)
+        assert sim._forecast_job is None
+    finally:
+        sim.close()
+
+
+def test_occupancy_snapshot_is_independent():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    try:
+        snapshot = sim.occupancy.copy()
+        block_id = snapshot.block_ids[0]
+        count = snapshot.count.copy()
+        sim.occupancy.close(block_id)
+        sim.occupancy.reset()
+        assert not snapshot.closed
+        assert snapshot.tracks[block_id]['status'] != 'maintenance'
+        assert np.array_equal(snapshot.count, count)
+        assert snapshot.placed
+    finally:
+        sim.close()
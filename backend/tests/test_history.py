@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from app import history
+from app.history import HISTORY_MEMORY_BYTES, HistoryStore, decode, encode
+from app.simulator import DemoSimulator
+
+
+def recorded(ticks_before, ticks_after, **kwargs):
+    """Store of a run whose train set changes after ``ticks_before`` ticks"""
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    store = HistoryStore(**kwargs)
+    for _ in range(ticks_before):
+        sim.advance()
+        store.record(sim)
+    changed_at = sim.clock.now + 1.0
+    sim.trigger_event('add_train', {'label': 'Extra'})
+    for _ in range(ticks_after):
+        sim.advance()
+        store.record(sim)
+    return sim, store, changed_at
+
+
+def test_ids_follow_a_train_set_change_the_gap_skipped():
+    sim, store, changed_at = recorded(10, 10)
+    frames = store.page(0.0, sim.clock.now, gap=4.0)['frames']
+    # The change's own tick falls between two frames
+    assert changed_at not in [f['t'] for f in frames]
+    after = next(f for f in frames if f['t'] > changed_at)
+    assert [f['t'] for f in frames if 'ids' in f] == [frames[0]['t'], after['t']]
+    assert len(after['ids']) == len(sim.trains) and len(after['position']) == len(sim.trains)
+    sim.close()
+    store.close()
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int64, np.int32, np.int16, np.int8])
+def test_codec_round_trips(dtype):
+    rng = np.random.default_rng(1)
+    arr = (rng.normal(0, 1000, size=(50, 7)).cumsum(axis=0)).astype(dtype)
+    if np.dtype(dtype).kind == 'f':
+        arr[3, 2] = np.nan
+        arr[4, 1] = -0.0
+        arr[5, 0] = np.inf
+    out = decode(encode(arr), arr.dtype.str, arr.shape)
+    assert out.dtype == arr.dtype
+    assert out.tobytes() == arr.tobytes()
+
+
+def test_codec_round_trips_wrapping_integer_deltas():
+    arr = np.array([[127], [-128], [0], [127]], dtype=np.int8)
+    assert decode(encode(arr), arr.dtype.str, arr.shape).tolist() == arr.tolist()
+
+
+@pytest.mark.parametrize('memory_bytes', [HISTORY_MEMORY_BYTES, 0])
+def test_page_across_a_chunk_boundary_from_since(memory_bytes, monkeypatch):
+    monkeypatch.setattr(history, 'TRAIN_CHUNK_ROWS', 8)
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    store = HistoryStore(memory_bytes=memory_bytes)
+    live = []
+    for _ in range(20):
+        sim.advance()
+        store.record(sim)
+        live.append((sim.clock.now, np.round(sim.trains.speed * 10) / 10))
+    assert len(store.trains.chunks) == 2
+    assert (store.stats['spilled'] == 2) == (memory_bytes == 0)
+    # Starts inside the first chunk, ends in the open third one
+    first = store.page(5.0, sim.clock.now, limit=6)
+    rest = store.page(first['next'], sim.clock.now)
+    frames = first['frames'] + rest['frames']
+    assert [f['t'] for f in frames] == [t for t, _ in live if t >= 5.0]
+    assert first['frames'][0]['ids'] == rest['frames'][0]['ids'] == list(sim.trains.ids)
+    assert all('ids' not in f for f in frames[1:6] + rest['frames'][1:])
+    for f, (_, speed) in zip(frames, live[4:]):
+        assert f['speed'] == speed.tolist()
+    sim.close()
+    store.close()
+
+
+def test_train_set_change_in_the_middle_of_a_page():
+    sim, store, changed_at = recorded(5, 5)
+    frames = store.page(0.0, sim.clock.now)['frames']
+    change = next(i for i, f in enumerate(frames) if f['t'] == changed_at)
+    assert [i for i, f in enumerate(frames) if 'ids' in f] == [0, change]
+    assert len(frames[change]['ids']) == len(frames[change - 1]['position']) + 1
+    assert all(len(f['position']) == len(frames[change]['ids']) for f in frames[change:])
+    sim.close()
+    store.close()
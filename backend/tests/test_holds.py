@@ -0,0 +1,40 @@
+import pytest
+
+from app.simulator import DemoSimulator
+from app.trainstate import STATUS_NAMES, status_code
+
+
+def test_hold_releases_a_running_train():
+    sim = DemoSimulator(seed=1, autostart=False)
+    sim.hold('T1', 30.0)
+    assert sim.trains['T1']['status'] == 'held'
+    sim.run_headless(5)
+    assert sim.trains['T1']['status'] == 'held'
+    sim.run_headless(30)
+    assert sim.trains['T1']['status'] == 'running'
+    assert 'T1' not in sim.holds
+
+
+def test_scheduled_delay_never_restarts_a_stopped_train():
+    sim = DemoSimulator(seed=1, autostart=False)
+    sim.trigger_event('emergency_stop')
+    sim.control_train('T2', 'stop')
+    sim.schedule_events([{'type': 'delay', 'in_s': 1, 'data': {'train_id': 'T1', 'minutes': 1}},
+                         {'type': 'delay', 'in_s': 1, 'data': {'train_id': 'T2', 'minutes': 1}}])
+    delay = sim.trains['T1']['delay']
+    sim.run_headless(3)
+    assert sim.trains['T1']['delay'] >= delay + 1
+    sim.run_headless(120)
+    assert sim.trains['T1']['status'] == 'emergency_stop'
+    assert sim.trains['T2']['status'] in ('stopped', 'emergency_stop')
+    assert not sim.holds
+
+
+def test_status_codes_are_fixed():
+    assert status_code('held') == STATUS_NAMES.index('held')
+    with pytest.raises(ValueError):
+        status_code('parked')
+    assert 'parked' not in STATUS_NAMES
+    sim = DemoSimulator(seed=1, autostart=False)
+    with pytest.raises(ValueError):
+        sim.trains['T1']['status'] = 'parked'
@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from app.network import NetworkError, load
+from app.simulator import DemoSimulator
+
+
+def write_jsonl(path, records):
+    path.write_text(''.join(json.dumps(r) + '\n' for r in records))
+    return str(path)
+
+
+def test_network_without_blocks_is_rejected(tmp_path):
+    path = write_jsonl(tmp_path / 'net.jsonl', [
+        {'kind': 'route', 'id': 'R1', 'points': [[20.0, 75.0], [20.0, 75.5]]},
+        {'kind': 'train', 'id': 'T1', 'route_id': 'R1'},
+    ])
+    with pytest.raises(NetworkError) as e:
+        load(path)
+    assert 'network has no blocks' in e.value.errors
+
+
+def test_blocks_csv_with_only_a_header_is_rejected(tmp_path):
+    (tmp_path / 'blocks.csv').write_text('id,from_lat,from_lon,to_lat,to_lon\n')
+    (tmp_path / 'route_points.csv').write_text('route_id,sequence,lat,lon\nR1,0,20.0,75.0\nR1,1,20.0,75.5\n')
+    (tmp_path / 'trains.csv').write_text('id,route_id\nT1,R1\n')
+    with pytest.raises(NetworkError) as e:
+        load(str(tmp_path))
+    assert e.value.errors == ['network has no blocks']
+
+
+def test_metrics_survive_a_state_without_blocks():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    sim.load_state(sim.trains.copy(), {})
+    sim._update_metrics()
+    assert sim.system_metrics['system_load'] == 0.0
+    sim.close()
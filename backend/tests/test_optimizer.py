@@ -0,0 +1,50 @@
+import random
+import time
+
+from app.optimizer import Cluster, greedy, local_search
+
+
+def reference_greedy(cl):
+    # The original quadratic dispatch rule the heap version must reproduce
+    rem, done, order = set(range(len(cl.ids))), {}, []
+    while rem:
+        def start(i):
+            return max([cl.r[i]] + [done[j] for j in cl.nbr[i] if j in done])
+        best = min(rem, key=lambda i: (round(start(i), 3), -cl.w[i] / cl.p[i], cl.ids[i]))
+        done[best] = start(best) + cl.p[best]
+        order.append(best)
+        rem.discard(best)
+    return order
+
+
+def random_cluster(n, degree, seed):
+    rng = random.Random(seed)
+    ids = [f'T{k:05d}' for k in range(n)]
+    r = [rng.choice((0.0, 0.0, rng.uniform(0, 10))) for _ in ids]
+    p = [rng.uniform(2, 8) for _ in ids]
+    w = [rng.choice((1.0, 2.0, 3.0)) for _ in ids]
+    edges = {(a, b) for a in range(n) for b in rng.sample(range(n), min(n, degree)) if a < b}
+    return Cluster(ids, r, p, w, sorted(edges))
+
+
+def test_heap_greedy_matches_quadratic_rule():
+    for seed in range(20):
+        cl = random_cluster(60, 4, seed)
+        assert greedy(cl) == reference_greedy(cl)
+
+
+def test_greedy_falls_back_to_fifo_past_the_deadline():
+    cl = random_cluster(200, 3, 1)
+    fifo = sorted(range(200), key=lambda i: (cl.r[i], cl.ids[i]))
+    assert greedy(cl, deadline=time.perf_counter() - 1) == fifo
+
+
+def test_large_cluster_respects_the_budget():
+    cl = random_cluster(5000, 3, 2)
+    started = time.perf_counter()
+    deadline = started + 0.05
+    order = greedy(cl, deadline)
+    order, _, _ = local_search(cl, order, deadline)
+    cl.lower_bound(range(5000), {i: cl.r[i] for i in range(5000)}, deadline)
+    assert sorted(order) == list(range(5000))
+    assert time.perf_counter() - started < 0.5
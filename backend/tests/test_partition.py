@@ -0,0 +1,103 @@
+import numpy as np
+
+from app.partition import PartitionedSimulator
+from app.simulator import DemoSimulator
+
+
+def boundary_network():
+    """Head-on and following trains on one line crossing the partition boundary at lon 75.5"""
+    lon = [round(75.0 + 0.05 * k, 2) for k in range(21)]
+    tracks = {f'B{k}': {'id': f'B{k}', 'from': [20.0, a], 'to': [20.0, b], 'status': 'free', 'capacity': 1,
+                        'speed_limit': 80} for k, (a, b) in enumerate(zip(lon, lon[1:]))}
+    east = [[20.0, x] for x in lon]
+    west = east[::-1]
+    trains = {
+        'E1': {'id': 'E1', 'route': east[8:], 'idx': 1, 'speed': 60, 'max_speed': 80, 'status': 'running', 'delay': 0},
+        'W1': {'id': 'W1', 'route': west[8:], 'idx': 1, 'speed': 60, 'max_speed': 80, 'status': 'running', 'delay': 0},
+        'E2': {'id': 'E2', 'route': east[7:], 'idx': 0, 'speed': 40, 'max_speed': 60, 'status': 'running', 'delay': 0},
+        'W2': {'id': 'W2', 'route': west[7:], 'idx': 0, 'speed': 40, 'max_speed': 60, 'status': 'running', 'delay': 0},
+    }
+    sections = {
+        'S1': {'id': 'S1', 'name': 'West', 'bounds': [[19.5, 73.5], [20.5, 75.0]]},
+        'S2': {'id': 'S2', 'name': 'East', 'bounds': [[19.5, 75.0], [20.5, 76.5]]},
+    }
+    return trains, tracks, sections
+
+
+def quiet(sim):
+    # Random events would add trains; keep the comparison to the movement itself
+    sim._next_event = float('inf')
+    sim.forecast_interval = None
+    return sim
+
+
+def test_head_on_trains_across_partitions_match_single_process():
+    single = quiet(DemoSimulator(*boundary_network(), seed=1, autostart=False))
+    split = quiet(PartitionedSimulator(*boundary_network(), seed=1, autostart=False, partitions=2))
+    try:
+        owners = split.plan.owners(split.trains.positions())
+        assert set(owners.tolist()) == {0, 1}
+        start = single.trains.dist.copy()
+        for _ in range(300):
+            single.advance()
+            split.advance()
+        a, b = single.trains, split.trains
+        assert a.ids == b.ids
+        assert np.array_equal(a.dist, b.dist)
+        assert np.array_equal(a.delay, b.delay)
+        assert (a.dist - start).min() > 0, 'every train made progress'
+    finally:
+        split.close()
+        single.close()
+
+
+def kill_workers(sim):
+    for w in sim.workers:
+        w['proc'].kill()
+        w['proc'].join()
+
+
+def run_both(single, split, ticks):
+    for _ in range(ticks):
+        single.advance()
+        split.advance()
+
+
+def test_dead_worker_is_respawned():
+    single = quiet(DemoSimulator(*boundary_network(), seed=1, autostart=False))
+    split = quiet(PartitionedSimulator(*boundary_network(), seed=1, autostart=False, partitions=2))
+    try:
+        run_both(single, split, 50)
+        dead = split.workers[1]['proc']
+        dead.kill()
+        dead.join()
+        run_both(single, split, 100)
+        assert len(split.workers) == 2
+        assert dead not in [w['proc'] for w in split.workers]
+        assert np.array_equal(single.trains.dist, split.trains.dist)
+        assert split.tracks == single.tracks
+    finally:
+        split.close()
+        single.close()
+
+
+def test_falls_back_to_one_process_when_workers_keep_dying():
+    single = quiet(DemoSimulator(*boundary_network(), seed=1, autostart=False))
+    split = quiet(PartitionedSimulator(*boundary_network(), seed=1, autostart=False, partitions=2))
+    spawn = split._spawn
+
+    def spawn_dead():
+        spawn()
+        kill_workers(split)
+
+    try:
+        run_both(single, split, 50)
+        split._spawn = spawn_dead
+        kill_workers(split)
+        run_both(single, split, 100)
+        assert not split.workers
+        assert np.array_equal(single.trains.dist, split.trains.dist)
+        assert split.tracks == single.tracks
+    finally:
+        split.close()
+        single.close()
@@ -0,0 +1,39 @@
+import asyncio
+import pickle
+
+from app import headless, scenarios
+from app.simulator import DemoSimulator
+
+
+def test_fork_pickles_and_runs_like_the_original():
+    sim = DemoSimulator(seed=3, autostart=False)
+    sim.run_headless(5)
+    twin = sim.fork(seed=7)
+    copy = pickle.loads(pickle.dumps(twin))
+    twin.run_headless(60)
+    copy.run_headless(60)
+    assert headless.summarize(copy) == headless.summarize(twin)
+    assert copy.render_metrics(['sim_tick_seconds']).count('sim_tick_seconds_count 60') == 1
+
+
+def test_run_plans_evaluates_every_plan_in_the_pool():
+    sim = DemoSimulator(seed=3, autostart=False)
+    plans = [{'action': 'none'}, {'action': 'hold', 'train': 'T1', 'value': 60.0}]
+    try:
+        run = asyncio.run(scenarios.run_plans(sim, plans, 60.0, 20.0, seed=1))
+    finally:
+        scenarios.shutdown()
+    assert run['evaluated'] == run['submitted'] == 2
+    assert run['errors'] == [] and run['timed_out'] == 0
+
+
+def test_run_plans_reports_worker_errors():
+    sim = DemoSimulator(seed=3, autostart=False)
+    plans = [{'action': 'none'}, {'action': 'teleport', 'train': 'T1'}]
+    try:
+        run = asyncio.run(scenarios.run_plans(sim, plans, 60.0, 20.0, seed=1))
+    finally:
+        scenarios.shutdown()
+    assert run['evaluated'] == 1 and run['timed_out'] == 0
+    assert [e['plan']['action'] for e in run['errors']] == ['teleport']
+    assert 'unknown plan action' in run['errors'][0]['error']
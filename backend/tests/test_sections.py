@@ -0,0 +1,63 @@
+import pytest
+
+from app.broadcast import ClientWrapper
+from app.sections import AREA_CACHE_SIZE, SectionIndex
+from app.simulator import DemoSimulator
+
+
+def test_bounds_are_ordered_and_clamped():
+    index = SectionIndex({}, {'B1': {'from': [20.0, 75.0], 'to': [20.0, 75.5]}})
+    area = index.area(bounds=[[95, 200], [19, 74]])
+    assert area.bounds == [[19.0, 74.0], [90.0, 180.0]]
+    assert area.blocks == {0}
+
+
+@pytest.mark.parametrize('bounds', [[[0, 0]], [[0, 0], [1]], [[0, 'x'], [1, 1]], [[0, float('nan')], [1, 1]],
+                                    [[True, 0], [1, 1]], 'everywhere'])
+def test_malformed_bounds_are_rejected(bounds):
+    index = SectionIndex({}, {})
+    with pytest.raises(ValueError):
+        index.area(bounds=bounds)
+
+
+def test_area_cache_is_bounded():
+    index = SectionIndex({}, {})
+    first = index.area(bounds=[[0, 0], [1, 1]])
+    for k in range(AREA_CACHE_SIZE + 10):
+        index.area(bounds=[[0, k], [1, k + 1]])
+        # Recently used areas stay cached
+        assert index.area(bounds=[[0, 0], [1, 1]]) is first
+    assert len(index._areas) == AREA_CACHE_SIZE
+
+
+def test_subscribe_reports_bad_input_and_keeps_the_area():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    client = ClientWrapper(None)
+    assert sim.subscribe(client, {'bounds': [[19, 74], [21, 76]]}) is None
+    area = client.area
+    assert sim.subscribe(client, {'bounds': [[19, 74]]}) is not None
+    assert sim.subscribe(client, {'section': 'nowhere'}) == 'Section not found'
+    assert sim.subscribe(client, None, 'carrier-pigeon') is not None
+    assert client.area is area
+    sim.close()
+
+
+def test_load_state_resolves_subscriptions_on_the_new_network():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    trains, tracks, sections = sim.trains.copy(), dict(sim.tracks), dict(sim.sections)
+    by_section, by_bounds = ClientWrapper(None), ClientWrapper(None)
+    sim.clients.update((by_section, by_bounds))
+    sim.subscribe(by_section, {'section': 'S2'})
+    sim.subscribe(by_bounds, {'bounds': [[19, 74], [21, 76]]})
+    # Drop the first block so every later block index shifts
+    first = next(iter(tracks))
+    tracks.pop(first)
+    sim.load_state(trains, tracks, sections)
+    for client, area in ((by_section, sim.section_index.area(section_id='S2')),
+                         (by_bounds, sim.section_index.area(bounds=[[19, 74], [21, 76]]))):
+        assert client.area is area
+        assert max(client.area.blocks) < len(tracks)
+    sections.pop('S2')
+    sim.load_state(trains, tracks, sections)
+    assert by_section.area is None
+    sim.close()
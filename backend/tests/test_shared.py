@@ -0,0 +1,79 @@
+import asyncio
+import os
+from multiprocessing import resource_tracker
+
+import pytest
+
+from app.shared import CommandServer, SimReplica, SnapshotPublisher
+from app.simulator import DemoSimulator
+
+
+@pytest.fixture
+def published():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    publisher = SnapshotPublisher(sim, name=f'train-sim-test-{os.getpid()}', size=1 << 20)
+    publisher.publish()
+    yield sim, publisher
+    # Replicas attached in this process dropped the segment from its resource tracker
+    resource_tracker.register(publisher.shm._name, 'shared_memory')
+    publisher.close()
+    sim.close()
+
+
+def test_connect_leaves_starting_to_the_server(published):
+    sim, publisher = published
+    replica = SimReplica.connect(publisher.shm.name, address='/nonexistent/sim.sock', timeout=1)
+    try:
+        assert replica._task is None
+        assert len(replica.trains) == len(sim.trains)
+    finally:
+        replica.close()
+
+
+def test_replica_round_trips_run_off_the_event_loop(published, tmp_path):
+    sim, publisher = published
+
+    async def run():
+        server = CommandServer(sim, address=str(tmp_path / 'sim.sock'))
+        server.start()
+        replica = SimReplica.connect(publisher.shm.name, address=server.address, timeout=1)
+        try:
+            # Each would deadlock if it blocked the loop the server answers on
+            trends = await replica.kpi_trends()
+            assert 'history' in trends
+            assert 'sim_ticks_total' in await replica.render_metrics(['sim_ticks_total'])
+            assert await replica.accept_recommendation('nope') == {'status': 'not_found'}
+            assert replica.log_audit('replica_note', {'train_id': 'T1'}) is None
+            for _ in range(100):
+                if sim.audit.query(action='replica_note')['entries']:
+                    break
+                await asyncio.sleep(0.02)
+            assert sim.audit.query(action='replica_note')['entries']
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, replica.close)
+            server.close()
+    asyncio.run(run())
+
+
+def test_replica_forks_see_closures_and_scheduled_events(published):
+    sim, publisher = published
+    block = next(iter(sim.tracks))
+    sim.schedule_events([{'type': 'maintenance', 'data': {'block_id': block, 'duration_s': 60}},
+                         {'type': 'delay', 'in_s': 30, 'data': {'train_id': 'T1', 'minutes': 2}}])
+    sim.run_headless(1)
+    publisher.publish()
+    replica = SimReplica.connect(publisher.shm.name, address='/nonexistent/sim.sock', timeout=1)
+    try:
+        for source in (sim, replica):
+            twin = source.fork(seed=3)
+            assert [twin.occupancy.block_ids[b] for b in twin.occupancy.closed] == [block]
+            assert [e['type'] for e in twin.scheduler.upcoming()] == ['delay', 'maintenance_end']
+        # Changes reach replicas on the next snapshot
+        sim.run_headless(61)
+        publisher.publish()
+        replica.sync()
+        assert block not in [replica.occupancy.block_ids[b] for b in replica.occupancy.closed]
+        assert replica.occupancy.closed.keys() == sim.occupancy.closed.keys()
+        assert replica.scheduler.upcoming() == sim.scheduler.upcoming()
+    finally:
+        replica.close()
@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pytest
+
+from app.broadcast import FrameBuilder
+from app.simulator import DemoSimulator
+from app.wire import KIND_DELTA, KIND_KEYFRAME, PACKED, Frame, pack_positions, unpack_positions
+
+
+def test_packed_round_trip():
+    pos = np.array([[20.5, 75.25], [19.125, 76.0]])
+    data = pack_positions(KIND_DELTA, 42, np.array([3, 7]), pos, np.array([60.0, 0.0]), removed=[5])
+    kind, seq, rows = unpack_positions(data)
+    assert (kind, seq) == (KIND_DELTA, 42)
+    assert rows.dtype == np.float32 and rows.shape == (3, 4)
+    assert rows[:2, 0].tolist() == [3, 7]
+    assert np.array_equal(rows[:2, 1:3], pos.astype(np.float32))
+    assert rows[:2, 3].tolist() == [60.0, 0.0]
+    assert rows[2, 0] == 5 and np.isnan(rows[2, 1:]).all()
+
+
+def test_unpack_rejects_other_frames():
+    data = bytearray(pack_positions(KIND_KEYFRAME, 1, np.array([0]), np.zeros((1, 2)), np.zeros(1)))
+    data[4] += 1
+    with pytest.raises(ValueError):
+        unpack_positions(bytes(data))
+
+
+class PackedClient:
+    """Rebuilds train positions from what a packed client receives"""
+
+    def __init__(self):
+        self.ids = []
+        self.routes = {}
+        self.trains = {}
+
+    def receive(self, frame: Frame):
+        data = frame.encode(PACKED)
+        if isinstance(data, str):
+            msg = json.loads(data)
+            if msg['type'] == 'train_ids':
+                self.ids = msg['payload']['ids']
+            elif msg['type'] == 'routes':
+                self.routes.update({int(k): v for k, v in msg['payload'].items()})
+            return
+        kind, _, rows = unpack_positions(data)
+        if kind == KIND_KEYFRAME:
+            self.trains = {}
+        for row, lat, lon, speed in rows.tolist():
+            train_id = self.ids[int(row)]
+            if np.isnan(lat):
+                self.trains.pop(train_id, None)
+            else:
+                self.trains[train_id] = (lat, lon, speed)
+
+
+def test_packed_client_follows_new_routes_and_keyframes():
+    sim = DemoSimulator(seed=1, autostart=False, history_dir=None)
+    sim.forecast_interval = None
+    view, client = FrameBuilder(), PackedClient()
+    kinds = []
+
+    def tick():
+        sim.advance()
+        if client.ids != sim.trains.ids:
+            client.receive(sim.id_frame())
+        for frame in view.position_frames(sim):
+            client.receive(frame)
+            if frame.packed:
+                kinds.append(frame.packed[0])
+        expected = {t: (lat, lon, speed) for t, (lat, lon), speed
+                    in zip(sim.trains.ids, sim.position_array().tolist(), sim.trains.speed.tolist())}
+        assert client.trains.keys() == expected.keys()
+        for t, got in client.trains.items():
+            assert np.allclose(got, expected[t], rtol=1e-6), t
+
+    try:
+        client.receive(sim.id_frame())
+        for frame in view.keyframe(sim):
+            client.receive(frame)
+        for _ in range(3):
+            tick()
+        assert kinds[-1] == KIND_DELTA
+        sim.trigger_event('add_train', {'route': [[21.0, 77.0], [21.0, 77.5]]})
+        tick()
+        # A new train changes the id dictionary, so the tick goes out as a keyframe with its route
+        assert kinds[-1] == KIND_KEYFRAME
+        assert client.routes[len(sim.trains.routes) - 1] == sim.trains.routes[-1]
+        tick()
+        assert kinds[-1] == KIND_DELTA
+    finally:
+        sim.close()
@@ -20,13 +20,13 @@ const mockTracks: Track[] = [
   { id: "B4", from: [13.08, 80.27], to: [22.57, 88.36], status: "free" },
 ]
 
-export default function LiveMap() {
+export default function LiveMap({ section }: { section?: string } = {}) {
   const mapRef = useRef<HTMLDivElement>(null)
   const mapInstanceRef = useRef<any>(null)
   const [positions, setPositions] = useState<Record<string, LegacyTrain>>({})
   const [tracks, setTracks] = useState<Track[]>(mockTracks)
   const [isLoaded, setIsLoaded] = useState(false)
-  const { onMessage, status } = useSimWS()
+  const { onMessage, status } = useSimWS(section ? { section } : undefined)
 
   useEffect(() => {
     const loadLeaflet = async () => {
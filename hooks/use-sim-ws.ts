@@ -3,18 +3,29 @@
 import { useEffect, useRef, useState } from "react"
 
 export type WSMessage =
-  | { type: "positions"; payload: any }
+  | { type: "positions"; payload: any; keyframe?: boolean; seq?: number }
+  | { type: "positions_delta"; payload: { changed: Record<string, any>; removed: string[] }; seq?: number }
+  | { type: "routes"; payload: Record<string, [number, number][]> }
   | { type: "recommendation"; payload: any }
   | { type: "audit"; payload: any }
   | { type: "tracks"; payload: any }
+  | { type: "tracks_delta"; payload: { changed: any[] } }
   | { type: "metrics"; payload: any }
   | { type: "event"; payload: any }
+  | { type: "forecast"; payload: { now: number; horizon_s: number; total: number; conflicts: any[] } }
   | { type: string; payload?: any }
 
-export function useSimWS() {
+// Optional area filter sent with "subscribe"; omit for the whole network
+export type SimSubscription = { section: string } | { bounds: [[number, number], [number, number]] }
+
+export function useSimWS(subscription?: SimSubscription) {
   const [status, setStatus] = useState<"DISCONNECTED" | "CONNECTED">("DISCONNECTED")
   const wsRef = useRef<WebSocket | null>(null)
   const listenersRef = useRef<((msg: WSMessage) => void)[]>([])
+  // Frames after the first keyframe are deltas; keep the merged state here
+  const routesRef = useRef<Record<string, [number, number][]>>({})
+  const positionsRef = useRef<Record<string, any>>({})
+  const tracksRef = useRef<Record<string, any>>({})
 
   useEffect(() => {
     const defaultUrl = (location.protocol === "https:" ? "wss" : "ws") + "://" + location.hostname + ":8000/ws/sim"
@@ -24,20 +35,50 @@ export function useSimWS() {
 
     ws.onopen = () => {
       setStatus("CONNECTED")
-      ws.send(JSON.stringify({ type: "subscribe", payload: "trains" }))
+      ws.send(JSON.stringify({ type: "subscribe", payload: subscription ?? "trains" }))
     }
     ws.onclose = () => setStatus("DISCONNECTED")
     ws.onerror = () => setStatus("DISCONNECTED")
     ws.onmessage = (evt) => {
       try {
-        const msg: WSMessage = JSON.parse(evt.data)
-        listenersRef.current.forEach((fn) => fn(msg))
+        const msg = merge(JSON.parse(evt.data))
+        if (msg) listenersRef.current.forEach((fn) => fn(msg))
       } catch {
         // ignore malformed
       }
     }
     return () => ws.close()
-  }, [])
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [JSON.stringify(subscription)])
+
+  // Re-attach routes and fold deltas so listeners always see full "positions"/"tracks" payloads
+  function merge(msg: WSMessage): WSMessage | null {
+    switch (msg.type) {
+      case "routes":
+        Object.assign(routesRef.current, msg.payload)
+        return null
+      case "positions":
+        positionsRef.current = { ...msg.payload }
+        break
+      case "positions_delta":
+        positionsRef.current = { ...positionsRef.current, ...msg.payload.changed }
+        msg.payload.removed.forEach((id: string) => delete positionsRef.current[id])
+        break
+      case "tracks":
+        tracksRef.current = Object.fromEntries(msg.payload.map((t: any) => [t.id, t]))
+        return msg
+      case "tracks_delta":
+        msg.payload.changed.forEach((t: any) => (tracksRef.current[t.id] = t))
+        return { type: "tracks", payload: Object.values(tracksRef.current) }
+      default:
+        return msg
+    }
+    const payload: Record<string, any> = {}
+    for (const [id, p] of Object.entries(positionsRef.current)) {
+      payload[id] = { ...p, route: routesRef.current[p.route_id] ?? [] }
+    }
+    return { type: "positions", payload }
+  }
 
   function send(msg: WSMessage) {
     wsRef.current?.send(JSON.stringify(msg))